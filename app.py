@@ -1,4 +1,4 @@
-from flask import Flask, request, jsonify, render_template_string, send_file
+from flask import Flask, request, jsonify, render_template_string, send_file, Response, stream_with_context
 from flask_cors import CORS
 from openai import OpenAI
 import os
@@ -12,16 +12,39 @@ from docx.shared import Pt, RGBColor, Inches
 from docx.enum.text import WD_ALIGN_PARAGRAPH
 from reportlab.pdfbase import pdfmetrics
 from reportlab.pdfbase.ttfonts import TTFont
+from reportlab.lib.fonts import addMapping
 from reportlab.lib.pagesizes import A4
 from reportlab.lib.styles import getSampleStyleSheet, ParagraphStyle
 from reportlab.lib.units import inch
-from reportlab.platypus import SimpleDocTemplate, Paragraph, Spacer, Image as RLImage, PageBreak, Table, TableStyle
+from reportlab.platypus import SimpleDocTemplate, Paragraph, Spacer, Image as RLImage, PageBreak
 from reportlab.lib import colors
-from reportlab.lib.enums import TA_CENTER, TA_LEFT
-from PIL import Image
+from reportlab.lib.enums import TA_CENTER
+from PIL import Image, ImageChops, ImageDraw, ImageFont
 import io
-import urllib.request
 import gc
+import threading
+import uuid
+import hashlib
+import math
+import sqlite3
+import time
+import zlib
+import csv
+import heapq
+import tempfile
+import zipfile
+import gzip
+import multiprocessing
+from collections import Counter, OrderedDict
+from functools import lru_cache
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, as_completed, TimeoutError as FuturesTimeoutError
+from concurrent.futures.process import BrokenProcessPool
+
+# Brotli - необов'язкова залежність; без неї відповіді стискаються gzip
+try:
+    import brotli
+except ImportError:
+    brotli = None
 
 app = Flask(__name__)
 
@@ -38,6 +61,35 @@ def after_request(response):
         response.headers['Access-Control-Allow-Headers'] = 'Content-Type, Authorization, Accept'
     if 'Access-Control-Allow-Methods' not in response.headers:
         response.headers['Access-Control-Allow-Methods'] = 'GET, POST, PUT, DELETE, OPTIONS'
+    return compress_response(response)
+
+# Стиснення JSON-відповідей (потокові NDJSON не буферизуємо)
+COMPRESS_MIN_BYTES = int(os.getenv('COMPRESS_MIN_BYTES', '1024'))
+COMPRESS_MIMETYPES = ('application/json',)
+
+def compress_response(response):
+    """Стискає JSON-відповідь brotli або gzip відповідно до Accept-Encoding клієнта"""
+    if (response.mimetype not in COMPRESS_MIMETYPES or response.is_streamed or response.direct_passthrough
+            or response.status_code < 200 or response.status_code >= 300
+            or 'Content-Encoding' in response.headers):
+        return response
+    
+    # Якість з Accept-Encoding (q=0 - кодування заборонене)
+    accepted = request.accept_encodings
+    if brotli is not None and accepted['br'] > 0:
+        encoding = 'br'
+    elif accepted['gzip'] > 0:
+        encoding = 'gzip'
+    else:
+        return response
+    
+    data = response.get_data()
+    if len(data) < COMPRESS_MIN_BYTES:
+        return response
+    
+    response.set_data(brotli.compress(data, quality=5) if encoding == 'br' else gzip.compress(data, compresslevel=6))
+    response.headers['Content-Encoding'] = encoding
+    response.headers.add('Vary', 'Accept-Encoding')
     return response
 
 # Ініціалізація OpenAI клієнта
@@ -52,6 +104,13 @@ except Exception as e:
     print(f"Warning: OpenAI client initialization error: {e}")
     client = None
 
+# Модель OpenAI для аналізу пар
+OPENAI_MODEL = os.getenv('OPENAI_MODEL', 'gpt-4o')
+
+# Локальний каталог для кешів та даних, спільний для всіх воркерів
+DATA_DIR = os.getenv('DATA_DIR', '/tmp/trademark-checker')
+os.makedirs(DATA_DIR, exist_ok=True)
+
 class InstructionManager:
     def __init__(self, google_doc_url):
         self.doc_url = google_doc_url
@@ -95,61 +154,1323 @@ class InstructionManager:
 
 instruction_manager = InstructionManager(os.getenv('GOOGLE_DOC_URL', ''))
 
+class AnalysisCache:
+    """Дисковий кеш результатів аналізу пар ТМ (SQLite, спільний для воркерів)"""
+    
+    def __init__(self, db_path, ttl_hours=168, max_entries=5000, table='pair_cache'):
+        self.db_path = db_path
+        self.table = table
+        self.ttl_seconds = ttl_hours * 3600
+        self.max_entries = max_entries
+        self._init_db()
+    
+    def _connect(self):
+        conn = sqlite3.connect(self.db_path, timeout=30)
+        conn.execute('PRAGMA journal_mode=WAL')
+        return conn
+    
+    def _init_db(self):
+        with self._connect() as conn:
+            conn.execute(
+                f'CREATE TABLE IF NOT EXISTS {self.table} ('
+                'key TEXT PRIMARY KEY, result TEXT NOT NULL, '
+                'created REAL NOT NULL, accessed REAL NOT NULL)'
+            )
+            conn.execute(f'CREATE INDEX IF NOT EXISTS idx_{self.table}_accessed ON {self.table} (accessed)')
+    
+    def make_key(self, desired_tm, existing_tm, instructions, model, prompt='pair'):
+        """Будує ключ з нормалізованих даних обох марок, версії інструкцій, промпту (pair | batch), моделі та налаштувань аналізу"""
+        payload = {
+            'desired': normalize_mark_for_cache(desired_tm),
+            'existing': normalize_mark_for_cache(existing_tm),
+            'instructions': hashlib.sha256(instructions.encode('utf-8')).hexdigest(),
+            'model': model,
+            'prompt': prompt,
+            'prompt_version': PROMPT_VERSIONS[prompt],
+            'settings': pair_analysis_settings()
+        }
+        return hashlib.sha256(json.dumps(payload, sort_keys=True).encode('utf-8')).hexdigest()
+    
+    def get(self, key):
+        try:
+            with self._connect() as conn:
+                row = conn.execute(
+                    f'SELECT result, created FROM {self.table} WHERE key = ?', (key,)
+                ).fetchone()
+                if row is None:
+                    return None
+                if time.time() - row[1] > self.ttl_seconds:
+                    conn.execute(f'DELETE FROM {self.table} WHERE key = ?', (key,))
+                    return None
+                conn.execute(f'UPDATE {self.table} SET accessed = ? WHERE key = ?', (time.time(), key))
+                return json.loads(row[0])
+        except Exception as e:
+            print(f"⚠️ Помилка читання кешу: {e}")
+            return None
+    
+    def put(self, key, result):
+        now = time.time()
+        try:
+            with self._connect() as conn:
+                conn.execute(
+                    f'INSERT OR REPLACE INTO {self.table} (key, result, created, accessed) VALUES (?, ?, ?, ?)',
+                    (key, json.dumps(result, ensure_ascii=False), now, now)
+                )
+                # Видаляємо прострочені записи та найдавніше використані понад ліміт
+                conn.execute(f'DELETE FROM {self.table} WHERE created < ?', (now - self.ttl_seconds,))
+                conn.execute(
+                    f'DELETE FROM {self.table} WHERE key IN ('
+                    f'SELECT key FROM {self.table} ORDER BY accessed DESC LIMIT -1 OFFSET ?)',
+                    (self.max_entries,)
+                )
+        except Exception as e:
+            print(f"⚠️ Помилка запису в кеш: {e}")
+
+ANALYSIS_CACHE_ENABLED = os.getenv('ANALYSIS_CACHE_ENABLED', '1') == '1'
+# Версії промптів (окремої пари та пакетного): змініть при зміні промпту, щоб не віддавати старі результати з кешу.
+# Результати різних промптів кешуються під різними ключами
+PAIR_PROMPT_VERSION = 2
+BATCH_PROMPT_VERSION = 1
+PROMPT_VERSIONS = {'pair': PAIR_PROMPT_VERSION, 'batch': BATCH_PROMPT_VERSION}
+
+def pair_analysis_settings():
+    """Налаштування, від яких залежить результат аналізу пари (входять у ключ кешу)"""
+    return {
+        'local_visual': LOCAL_VISUAL_ENABLED,
+        'visual_thresholds': [VISUAL_IDENTICAL_SCORE, VISUAL_DISTINCT_SCORE],
+        'logo_descriptions': LOGO_DESCRIPTIONS_ENABLED,
+        'vision_detail': VISION_DETAIL,
+        'vision_max_tiles': VISION_MAX_TILES,
+        'vision_composite': VISION_COMPOSITE_ENABLED
+    }
+
+analysis_cache = AnalysisCache(
+    os.path.join(DATA_DIR, 'analysis_cache.sqlite3'),
+    ttl_hours=float(os.getenv('ANALYSIS_CACHE_TTL_HOURS', '168')),
+    max_entries=int(os.getenv('ANALYSIS_CACHE_MAX_ENTRIES', '5000'))
+)
+
+# Описи логотипів: один Vision-запит на унікальне зображення, далі порівнюємо тексти
+LOGO_DESCRIPTIONS_ENABLED = os.getenv('LOGO_DESCRIPTIONS_ENABLED', '0') == '1'
+logo_description_cache = AnalysisCache(
+    os.path.join(DATA_DIR, 'analysis_cache.sqlite3'),
+    ttl_hours=float(os.getenv('LOGO_DESCRIPTION_TTL_HOURS', '8760')),
+    max_entries=int(os.getenv('LOGO_DESCRIPTION_MAX_ENTRIES', '20000')),
+    table='logo_descriptions'
+)
+
+class SQLiteRecordStore:
+    """Спільне для воркерів сховище стиснених JSON-записів (SQLite у режимі WAL)"""
+    
+    def __init__(self, db_path, table):
+        self.db_path = db_path
+        self.table = table
+        self._init_db()
+    
+    def _connect(self):
+        conn = sqlite3.connect(self.db_path, timeout=30)
+        conn.execute('PRAGMA journal_mode=WAL')
+        return conn
+    
+    def _init_db(self):
+        with self._connect() as conn:
+            conn.execute(
+                f'CREATE TABLE IF NOT EXISTS {self.table} ('
+                'id TEXT PRIMARY KEY, record BLOB NOT NULL, created REAL NOT NULL)'
+            )
+            conn.execute(f'CREATE INDEX IF NOT EXISTS idx_{self.table}_created ON {self.table} (created)')
+    
+    def save(self, record_id, payload, created):
+        with self._connect() as conn:
+            conn.execute(
+                f'INSERT OR REPLACE INTO {self.table} (id, record, created) VALUES (?, ?, ?)',
+                (record_id, zlib.compress(payload, 6), created)
+            )
+    
+    def load(self, record_id, created_after=0):
+        """Повертає (payload, created) або None"""
+        with self._connect() as conn:
+            row = conn.execute(
+                f'SELECT record, created FROM {self.table} WHERE id = ? AND created >= ?',
+                (record_id, created_after)
+            ).fetchone()
+        return (zlib.decompress(row[0]), row[1]) if row else None
+    
+    def prune(self, created_before):
+        with self._connect() as conn:
+            return conn.execute(f'DELETE FROM {self.table} WHERE created < ?', (created_before,)).rowcount
+
+class AnalysisStorage:
+    """Сховище аналізів для експорту: LRU у пам'яті з бюджетом розміру поверх спільного сховища на диску"""
+    
+    def __init__(self, backend, memory_budget_mb=64, retention_hours=168):
+        self.backend = backend
+        self.memory_budget = int(memory_budget_mb * 1024 * 1024)
+        self.retention_seconds = retention_hours * 3600
+        self._memory = OrderedDict()
+        self._memory_bytes = 0
+        self._lock = threading.Lock()
+    
+    def _remember(self, analysis_id, record, size, created):
+        """Додає запис у пам'ять і витісняє найдавніше використані понад бюджет"""
+        with self._lock:
+            previous = self._memory.pop(analysis_id, None)
+            if previous is not None:
+                self._memory_bytes -= previous[1]
+            self._memory[analysis_id] = (record, size, created)
+            self._memory_bytes += size
+            while self._memory_bytes > self.memory_budget and len(self._memory) > 1:
+                _, (_, evicted_size, _) = self._memory.popitem(last=False)
+                self._memory_bytes -= evicted_size
+    
+    def put(self, analysis_id, record):
+        payload = json.dumps(record, ensure_ascii=False).encode('utf-8')
+        now = time.time()
+        # Пишемо одразу в спільне сховище: аналіз доступний іншим воркерам і переживе перезапуск
+        try:
+            self.backend.save(analysis_id, payload, now)
+            self.backend.prune(now - self.retention_seconds)
+        except Exception as e:
+            print(f"⚠️ Помилка запису аналізу {analysis_id} на диск: {e}")
+        self._remember(analysis_id, record, len(payload), now)
+    
+    def get(self, analysis_id):
+        with self._lock:
+            cached = self._memory.get(analysis_id)
+            if cached is not None:
+                self._memory.move_to_end(analysis_id)
+        if cached is not None and time.time() - cached[2] <= self.retention_seconds:
+            return cached[0]
+        
+        try:
+            stored = self.backend.load(analysis_id, created_after=time.time() - self.retention_seconds)
+        except Exception as e:
+            print(f"⚠️ Помилка читання аналізу {analysis_id}: {e}")
+            return None
+        if stored is None:
+            return None
+        
+        payload, created = stored
+        record = json.loads(payload)
+        print(f"📂 Аналіз {analysis_id} завантажено з диска")
+        self._remember(analysis_id, record, len(payload), created)
+        return record
+
+def new_analysis_id():
+    """Унікальний ID аналізу: час для зручного сортування + випадковий суфікс проти колізій"""
+    return f"{datetime.now().strftime('%Y%m%d%H%M%S')}-{uuid.uuid4().hex[:12]}"
+
 # Глобальне сховище для результатів аналізу
-analysis_storage = {}
+STORAGE_DB_PATH = os.getenv('STORAGE_DB_PATH', os.path.join(DATA_DIR, 'analyses.sqlite3'))
+analysis_storage = AnalysisStorage(
+    SQLiteRecordStore(STORAGE_DB_PATH, 'analyses'),
+    memory_budget_mb=float(os.getenv('ANALYSIS_STORAGE_MEMORY_MB', '64')),
+    retention_hours=float(os.getenv('ANALYSIS_RETENTION_HOURS', '168'))
+)
 
-def compress_image_base64(base64_string, max_size_kb=100):
-    """Стискає base64 зображення до вказаного розміру"""
-    try:
-        # Видаляємо data URL prefix
-        if ',' in base64_string:
-            header, data = base64_string.split(',', 1)
-        else:
-            data = base64_string
-            header = 'data:image/jpeg;base64'
+# Максимальна кількість пар ТМ, що аналізуються одночасно
+ANALYSIS_MAX_WORKERS = max(1, int(os.getenv('ANALYSIS_MAX_WORKERS', '4')))
+
+# Пакетний аналіз: кілька текстових пар в одному запиті до GPT
+BATCH_ANALYSIS_ENABLED = os.getenv('BATCH_ANALYSIS_ENABLED', '0') == '1'
+BATCH_MAX_SIZE = max(1, int(os.getenv('BATCH_MAX_SIZE', '8')))
+BATCH_INPUT_TOKEN_BUDGET = int(os.getenv('BATCH_INPUT_TOKEN_BUDGET', '12000'))
+BATCH_OUTPUT_TOKENS_PER_PAIR = int(os.getenv('BATCH_OUTPUT_TOKENS_PER_PAIR', '1500'))
+BATCH_MAX_OUTPUT_TOKENS = int(os.getenv('BATCH_MAX_OUTPUT_TOKENS', '16000'))
+
+# Фонові задачі аналізу: кількість одночасних задач та час зберігання завершених
+JOB_MAX_WORKERS = max(1, int(os.getenv('JOB_MAX_WORKERS', '2')))
+JOB_RETENTION_HOURS = float(os.getenv('JOB_RETENTION_HOURS', '24'))
+
+# Масова перевірка: розмір короткого списку для детального аналізу
+BULK_SHORTLIST_SIZE = int(os.getenv('BULK_SHORTLIST_SIZE', '30'))
+BULK_MAX_SHORTLIST = int(os.getenv('BULK_MAX_SHORTLIST', '200'))
+BULK_UPLOAD_DIR = os.path.join(DATA_DIR, 'uploads')
+os.makedirs(BULK_UPLOAD_DIR, exist_ok=True)
+
+analysis_jobs = {}
+jobs_lock = threading.Lock()
+job_executor = ThreadPoolExecutor(max_workers=JOB_MAX_WORKERS, thread_name_prefix='analysis-job')
+
+# Знімки задач у спільному сховищі: статус доступний з будь-якого воркера
+JOB_PUBLISH_INTERVAL = float(os.getenv('JOB_PUBLISH_INTERVAL', '1.0'))
+# Активні задачі перепубліковуються навіть без прогресу; застарілий знімок означає, що воркер перезапущено
+JOB_HEARTBEAT_INTERVAL = float(os.getenv('JOB_HEARTBEAT_INTERVAL', '10'))
+JOB_STALE_AFTER = JOB_HEARTBEAT_INTERVAL * 3
+job_store = SQLiteRecordStore(STORAGE_DB_PATH, 'jobs')
+job_published = {}
+job_heartbeat_thread = None
+job_publish_lock = threading.Lock()
+
+# Пули процесів для CPU-роботи (стиснення зображень, формування звітів): вона тримає GIL
+# і в потоках gunicorn гальмувала б усі інші запити. 0 процесів - виконувати в потоці запиту.
+# Зображення й звіти мають окремі пули: довгий експорт не блокує нормалізацію логотипів для аналізу
+IMAGE_POOL_WORKERS = int(os.getenv('IMAGE_POOL_WORKERS', '1'))
+IMAGE_POOL_MAX_PENDING = int(os.getenv('IMAGE_POOL_MAX_PENDING', '8'))
+EXPORT_POOL_WORKERS = int(os.getenv('EXPORT_POOL_WORKERS', '1'))
+EXPORT_POOL_MAX_PENDING = int(os.getenv('EXPORT_POOL_MAX_PENDING', '4'))
+IMAGE_TASK_TIMEOUT = float(os.getenv('IMAGE_TASK_TIMEOUT', '30'))
+EXPORT_TASK_TIMEOUT = float(os.getenv('EXPORT_TASK_TIMEOUT', '120'))
+
+class CPUTaskError(RuntimeError):
+    """Задачу не виконано в пулі: черга заповнена, вийшов час або пул аварійно зупинився"""
+
+class CPUTaskPool:
+    """Пул процесів з обмеженою чергою; потік запиту лише чекає на результат"""
+    
+    def __init__(self, workers, max_pending):
+        self.workers = workers
+        self.max_pending = max_pending
+        self._slots = threading.BoundedSemaphore(workers + max_pending) if workers > 0 else None
+        self._executor = None
+        self._lock = threading.Lock()
+    
+    @property
+    def enabled(self):
+        return self.workers > 0
+    
+    def _get_executor(self):
+        with self._lock:
+            if self._executor is None:
+                # spawn: fork процесу з потоками може успадкувати захоплені блокування
+                self._executor = ProcessPoolExecutor(
+                    max_workers=self.workers,
+                    mp_context=multiprocessing.get_context('spawn')
+                )
+            return self._executor
+    
+    def _reset(self, executor):
+        with self._lock:
+            if self._executor is executor:
+                self._executor = None
+        executor.shutdown(wait=False, cancel_futures=True)
+    
+    def run(self, fn, *args, timeout):
+        """Виконує fn(*args) у пулі; чекає на місце в черзі й на результат не довше timeout секунд"""
+        if not self.enabled:
+            return fn(*args)
         
-        # Декодуємо base64
-        img_data = base64.b64decode(data)
-        img = Image.open(io.BytesIO(img_data))
+        deadline = time.monotonic() + timeout
+        if not self._slots.acquire(timeout=timeout):
+            raise CPUTaskError(f"черга CPU-задач заповнена ({self.workers + self.max_pending})")
         
-        # Конвертуємо в RGB якщо потрібно
-        if img.mode in ('RGBA', 'LA', 'P'):
-            background = Image.new('RGB', img.size, (255, 255, 255))
-            if img.mode == 'P':
-                img = img.convert('RGBA')
-            background.paste(img, mask=img.split()[-1] if img.mode in ('RGBA', 'LA') else None)
-            img = background
+        executor = self._get_executor()
+        try:
+            future = executor.submit(fn, *args)
+        except BrokenProcessPool as e:
+            self._slots.release()
+            self._reset(executor)
+            raise CPUTaskError(f"пул процесів зупинився: {e}") from e
+        # Місце звільняється, лише коли процес справді завершив задачу
+        future.add_done_callback(lambda _: self._slots.release())
         
-        # Зменшуємо розмір якщо зображення занадто велике
-        max_dimension = 800
-        if max(img.size) > max_dimension:
-            ratio = max_dimension / max(img.size)
-            new_size = tuple(int(dim * ratio) for dim in img.size)
-            img = img.resize(new_size, Image.Resampling.LANCZOS)
+        try:
+            return future.result(timeout=max(0, deadline - time.monotonic()))
+        except FuturesTimeoutError as e:
+            future.cancel()
+            raise CPUTaskError(f"{fn.__name__} не завершилась за {timeout:g} с") from e
+        except BrokenProcessPool as e:
+            self._reset(executor)
+            raise CPUTaskError(f"пул процесів зупинився: {e}") from e
+
+image_pool = CPUTaskPool(IMAGE_POOL_WORKERS, IMAGE_POOL_MAX_PENDING)
+export_pool = CPUTaskPool(EXPORT_POOL_WORKERS, EXPORT_POOL_MAX_PENDING)
+
+# Параметри нормалізації зображень
+IMAGE_MAX_DIMENSION = 800
+JPEG_MAX_QUALITY = 85
+JPEG_MIN_QUALITY = 20
+
+def encode_jpeg(img, quality, optimize=False):
+    buffer = io.BytesIO()
+    img.save(buffer, format='JPEG', quality=quality, optimize=optimize)
+    return buffer.getvalue()
+
+def compress_image(source, max_size_kb=100, max_dimension=IMAGE_MAX_DIMENSION):
+    """Стискає зображення з файлового об'єкта; повертає (data URL, PIL-зображення)"""
+    source_size = source.seek(0, io.SEEK_END)
+    source.seek(0)
+    img = Image.open(source)
+    
+    # Розмір після зменшення (з збереженням пропорцій)
+    if max(img.size) > max_dimension:
+        ratio = max_dimension / max(img.size)
+        new_size = tuple(max(1, int(dim * ratio)) for dim in img.size)
+    else:
+        new_size = img.size
+    
+    # Зображення, вже зменшене в браузері: лише перевіряємо, що воно декодується, без перекодування
+    if (img.format == 'JPEG' and img.mode in ('RGB', 'L') and new_size == img.size
+            and source_size <= max_size_kb * 1024):
+        img.load()
+        source.seek(0)
+        print(f"✅ Зображення вже нормалізоване: {source_size/1024:.1f}KB, {img.size[0]}x{img.size[1]}")
+        return f"data:image/jpeg;base64,{base64.b64encode(source.read()).decode('utf-8')}", img
+    
+    # JPEG декодуємо одразу у зменшеному масштабі (1/2, 1/4, 1/8) - значно менше роботи
+    if img.format == 'JPEG' and new_size != img.size:
+        img.draft('RGB', new_size)
+    
+    # Конвертуємо в RGB якщо потрібно
+    if img.mode in ('RGBA', 'LA', 'P', 'PA'):
+        background = Image.new('RGB', img.size, (255, 255, 255))
+        if img.mode in ('P', 'PA'):
+            img = img.convert('RGBA')
+        background.paste(img, mask=img.split()[-1] if img.mode in ('RGBA', 'LA') else None)
+        img = background
+    elif img.mode not in ('RGB', 'L'):
+        img = img.convert('RGB')
+    
+    # Зменшуємо за один прохід: швидке цілочисельне зменшення + LANCZOS
+    if img.size != new_size:
+        img = img.resize(new_size, Image.Resampling.LANCZOS, reducing_gap=3.0)
+    
+    # Найчастіше (логотипи) зображення одразу вкладається в ліміт - одне кодування
+    max_bytes = max_size_kb * 1024
+    quality = JPEG_MAX_QUALITY
+    encoded = encode_jpeg(img, quality, optimize=True)
+    if len(encoded) > max_bytes:
+        # Бінарний пошук найвищої якості, що вкладається в ліміт (без optimize - швидше)
+        low, high = JPEG_MIN_QUALITY, JPEG_MAX_QUALITY - 1
+        quality = JPEG_MIN_QUALITY
+        while low <= high:
+            middle = (low + high) // 2
+            if len(encode_jpeg(img, middle)) <= max_bytes:
+                quality, low = middle, middle + 1
+            else:
+                high = middle - 1
+        # optimize лише зменшує розмір файлу для знайденої якості
+        encoded = encode_jpeg(img, quality, optimize=True)
+    
+    compressed_data = base64.b64encode(encoded).decode('utf-8')
+    print(f"🗜️ Стиснення: {source_size/1024:.1f}KB → {len(compressed_data)/1024:.1f}KB (якість: {quality})")
+    
+    return f"data:image/jpeg;base64,{compressed_data}", img
+
+def compress_image_base64(base64_string, max_size_kb=100, max_dimension=IMAGE_MAX_DIMENSION, return_image=False):
+    """Стискає base64 зображення до вказаного розміру (return_image - повернути також PIL-зображення)"""
+    try:
+        # Видаляємо data URL prefix
+        data = base64_string.split(',', 1)[1] if ',' in base64_string else base64_string
         
-        # Стискаємо до досягнення потрібного розміру
-        quality = 85
-        while quality > 20:
-            buffer = io.BytesIO()
-            img.save(buffer, format='JPEG', quality=quality, optimize=True)
-            size_kb = len(buffer.getvalue()) / 1024
+        result, img = compress_image(io.BytesIO(base64.b64decode(data)), max_size_kb, max_dimension)
+        return (result, img) if return_image else result
+    
+    except Exception as e:
+        print(f"⚠️ Помилка стиснення зображення: {e}")
+        return (base64_string, None) if return_image else base64_string
+
+# Таблиця транслітерації (використовується в PDF та для локального скринінгу)
+UKR_TO_LAT = {
+    'А':'A', 'Б':'B', 'В':'V', 'Г':'H', 'Ґ':'G', 'Д':'D', 'Е':'E', 'Є':'Ye', 
+    'Ж':'Zh', 'З':'Z', 'И':'Y', 'І':'I', 'Ї':'Yi', 'Й':'Y', 'К':'K', 'Л':'L', 
+    'М':'M', 'Н':'N', 'О':'O', 'П':'P', 'Р':'R', 'С':'S', 'Т':'T', 'У':'U', 
+    'Ф':'F', 'Х':'Kh', 'Ц':'Ts', 'Ч':'Ch', 'Ш':'Sh', 'Щ':'Shch', 'Ь':'', 
+    'Ю':'Yu', 'Я':'Ya', 'Ё':'Yo', 'Ы':'Y', 'Э':'E', 'Ъ':'',
+    'а':'a', 'б':'b', 'в':'v', 'г':'h', 'ґ':'g', 'д':'d', 'е':'e', 'є':'ye',
+    'ж':'zh', 'з':'z', 'и':'y', 'і':'i', 'ї':'yi', 'й':'y', 'к':'k', 'л':'l',
+    'м':'m', 'н':'n', 'о':'o', 'п':'p', 'р':'r', 'с':'s', 'т':'t', 'у':'u',
+    'ф':'f', 'х':'kh', 'ц':'ts', 'ч':'ch', 'ш':'sh', 'щ':'shch', 'ь':'',
+    'ю':'yu', 'я':'ya', 'ё':'yo', 'ы':'y', 'э':'e', 'ъ':'',
+    '₴':'UAH', '№':'#'
+}
+
+def translit(text):
+    """Транслітерація українського тексту"""
+    return ''.join(UKR_TO_LAT.get(char, char) for char in str(text))
+
+# Групи споріднених класів МКТП та їх вага спорідненості (0-1)
+NICE_CLASS_GROUPS = [
+    ({1, 2, 3, 4, 5}, 0.4),                # хімія, фарби, косметика, паливо, фармацевтика
+    ({3, 5, 10, 44}, 0.6),                 # косметика, ліки, медичні вироби та послуги
+    ({6, 7, 8, 19, 37}, 0.5),              # метали, машини, інструменти, будівництво
+    ({9, 38, 42}, 0.8),                    # електроніка, ПЗ, телеком, IT-послуги
+    ({9, 28, 41}, 0.5),                    # ігри, розваги, освіта
+    ({9, 15, 41}, 0.4),                    # музика та звукозапис
+    ({11, 20, 21, 24, 27}, 0.5),           # побутові прилади, меблі, посуд, текстиль
+    ({12, 37, 39}, 0.6),                   # транспорт, ремонт, перевезення
+    ({14, 18, 25, 26}, 0.7),               # прикраси, шкіряні вироби, одяг, аксесуари
+    ({22, 23, 24, 25}, 0.5),               # волокна, пряжа, тканини, одяг
+    ({16, 41}, 0.5),                       # друкована продукція, освіта
+    ({29, 30, 31}, 0.7),                   # продукти харчування
+    ({29, 30, 32, 43}, 0.5),               # харчування та ресторани
+    ({32, 33}, 0.8),                       # напої
+    ({32, 33, 43}, 0.6),                   # напої та заклади
+    ({34, 33}, 0.3),                       # тютюн та алкоголь
+    ({35, 36}, 0.4),                       # бізнес та фінанси
+    ({36, 45}, 0.3),                       # фінансові та юридичні послуги
+    ({39, 43}, 0.5),                       # подорожі та готелі
+    ({40, 42}, 0.3),                       # обробка матеріалів, технічні послуги
+]
+
+def build_class_relatedness():
+    """Матриця спорідненості 45x45 та бітові маски споріднених класів"""
+    matrix = [[0.0] * 46 for _ in range(46)]
+    for nice_class in range(1, 46):
+        matrix[nice_class][nice_class] = 1.0
+    for group, weight in NICE_CLASS_GROUPS:
+        for a in group:
+            for b in group:
+                if a != b:
+                    matrix[a][b] = max(matrix[a][b], weight)
+    related_bits = [0] * 46
+    for a in range(1, 46):
+        for b in range(1, 46):
+            if matrix[a][b] > 0:
+                related_bits[a] |= 1 << (b - 1)
+    return matrix, related_bits
+
+CLASS_RELATEDNESS, RELATED_CLASS_BITS = build_class_relatedness()
+
+def parse_nice_classes(classes):
+    """Розбирає рядок класів МКТП ("25, 35, 42") у множину номерів 1-45"""
+    return {int(c) for c in re.findall(r'\d+', str(classes or '')) if 1 <= int(c) <= 45}
+
+@lru_cache(maxsize=65536)
+def classes_to_bits(classes):
+    """Рядок класів МКТП -> 45-бітова маска (біт n-1 для класу n)"""
+    bits = 0
+    for nice_class in parse_nice_classes(classes):
+        bits |= 1 << (nice_class - 1)
+    return bits
+
+def bits_to_classes(bits):
+    return [nice_class for nice_class in range(1, 46) if bits >> (nice_class - 1) & 1]
+
+@lru_cache(maxsize=65536)
+def class_relatedness(bits_a, bits_b):
+    """Спорідненість (0-100) двох наборів класів: 100 при спільному класі, інакше максимум з матриці"""
+    if bits_a & bits_b:
+        return 100
+    score = 0.0
+    for a in bits_to_classes(bits_a):
+        if RELATED_CLASS_BITS[a] & bits_b:
+            for b in bits_to_classes(bits_b):
+                score = max(score, CLASS_RELATEDNESS[a][b])
+    return round(score * 100)
+
+def goods_services_score(desired_tm, existing_tm):
+    """Локальна оцінка спорідненості товарів/послуг за класами МКТП"""
+    bits_a = classes_to_bits(str(desired_tm.get('classes') or ''))
+    bits_b = classes_to_bits(str(existing_tm.get('classes') or ''))
+    known = bool(bits_a and bits_b)
+    return {
+        'known': known,
+        'shared_classes': bits_to_classes(bits_a & bits_b),
+        'relatedness': class_relatedness(bits_a, bits_b) if known else None
+    }
+
+def describe_goods_services_score(goods):
+    """Текстовий опис локальної оцінки спорідненості для звіту та промпту"""
+    if not goods['known']:
+        return "Класи МКТП вказані не для обох марок, локальна оцінка неможлива"
+    if goods['shared_classes']:
+        return f"Спільні класи МКТП: {', '.join(map(str, goods['shared_classes']))} (спорідненість 100%)"
+    if goods['relatedness']:
+        return f"Спільних класів немає, але класи споріднені (спорідненість {goods['relatedness']}%)"
+    return "Спільних або споріднених класів МКТП немає (спорідненість 0%)"
+
+# Попередній локальний скринінг пар (без звернення до GPT)
+TRIAGE_ENABLED = os.getenv('TRIAGE_ENABLED', '0') == '1'
+TRIAGE_THRESHOLD = float(os.getenv('TRIAGE_THRESHOLD', '40'))
+TRIAGE_IDENTICAL_SCORE = float(os.getenv('TRIAGE_IDENTICAL_SCORE', '90'))
+
+# Заміни буквосполучень перед побудовою фонетичного ключа
+PHONETIC_REPLACEMENTS = [
+    ('shch', 's'), ('sch', 's'), ('kh', 'h'), ('zh', 'z'), ('ts', 'z'), ('ch', 's'),
+    ('sh', 's'), ('ph', 'f'), ('ck', 'k'), ('qu', 'kv'), ('x', 'ks'), ('w', 'v')
+]
+
+# Групи приголосних, що звучать схоже (на кшталт Soundex)
+PHONETIC_GROUPS = {
+    'b': '1', 'p': '1', 'f': '1', 'v': '1',
+    'c': '2', 'g': '2', 'k': '2', 'q': '2', 'h': '2',
+    's': '3', 'z': '3', 'j': '3',
+    'd': '4', 't': '4',
+    'l': '5',
+    'm': '6', 'n': '6',
+    'r': '7'
+}
+
+def normalize_mark_name(name):
+    """Транслітерує назву та залишає лише латинські літери і цифри"""
+    return re.sub(r'[^a-z0-9]', '', translit(str(name or '')).lower())
+
+def levenshtein_distance(a, b):
+    """Відстань редагування між двома рядками"""
+    if len(a) < len(b):
+        a, b = b, a
+    previous = list(range(len(b) + 1))
+    for i, char_a in enumerate(a, 1):
+        current = [i]
+        for j, char_b in enumerate(b, 1):
+            current.append(min(
+                previous[j] + 1,
+                current[j - 1] + 1,
+                previous[j - 1] + (char_a != char_b)
+            ))
+        previous = current
+    return previous[-1]
+
+def edit_similarity(a, b):
+    """Схожість рядків (0-1) на основі відстані редагування"""
+    if not a and not b:
+        return 1.0
+    return 1 - levenshtein_distance(a, b) / max(len(a), len(b))
+
+def char_ngrams(text, n=2):
+    padded = f"^{text}$"
+    return {padded[i:i + n] for i in range(max(len(padded) - n + 1, 1))}
+
+def ngram_similarity(a, b, n=2):
+    """Коефіцієнт Дайса для множин символьних n-грам"""
+    grams_a, grams_b = char_ngrams(a, n), char_ngrams(b, n)
+    if not grams_a or not grams_b:
+        return 0.0
+    return 2 * len(grams_a & grams_b) / (len(grams_a) + len(grams_b))
+
+def phonetic_key(text):
+    """Фонетичний ключ: перший звук + групи приголосних без повторів"""
+    if not text:
+        return ''
+    for source, target in PHONETIC_REPLACEMENTS:
+        text = text.replace(source, target)
+    key = PHONETIC_GROUPS.get(text[0], text[0])
+    last = PHONETIC_GROUPS.get(text[0], '')
+    for char in text[1:]:
+        code = PHONETIC_GROUPS.get(char, '')
+        if code and code != last:
+            key += code
+        last = code
+    return key
+
+def prescreen_pair(desired_tm, existing_tm):
+    """Локальна оцінка схожості назв (фонетика, редагування, n-грами) у відсотках"""
+    name_a = normalize_mark_name(desired_tm.get('name'))
+    name_b = normalize_mark_name(existing_tm.get('name'))
+    
+    phonetic = edit_similarity(phonetic_key(name_a), phonetic_key(name_b))
+    edit = edit_similarity(name_a, name_b)
+    ngram = ngram_similarity(name_a, name_b)
+    
+    # Фонетичний ключ грубий, тому сам по собі не дає максимальної оцінки
+    score = max(0.4 * phonetic + 0.3 * edit + 0.3 * ngram, edit, ngram)
+    # Одна назва повністю входить в іншу (Apple / Apple Pay)
+    shorter, longer = sorted((name_a, name_b), key=len)
+    if len(shorter) >= 3 and shorter in longer:
+        score = max(score, 0.8)
+    
+    return {
+        'phonetic': round(phonetic * 100),
+        'edit': round(edit * 100),
+        'ngram': round(ngram * 100),
+        'score': round(score * 100)
+    }
+
+def should_skip_llm(desired_tm, existing_tm, prescreen, goods=None, threshold=None):
+    """Чи можна не відправляти пару до GPT за результатами скринінгу"""
+    threshold = TRIAGE_THRESHOLD if threshold is None else threshold
+    # Схожість логотипів локально не оцінюється, тому пари з двома зображеннями не пропускаємо
+    if desired_tm.get('image') and existing_tm.get('image'):
+        return False
+    if prescreen['score'] < threshold:
+        return True
+    # Неспоріднені товари/послуги: пропускаємо все, крім майже тотожних назв
+    return bool(goods and goods['known'] and goods['relatedness'] == 0 and prescreen['score'] < TRIAGE_IDENTICAL_SCORE)
+
+def create_prescreen_result(existing_tm, prescreen, goods):
+    """Дешевий результат для пари, відсіяної локальним скринінгом"""
+    note = (
+        f"Попередній локальний скринінг: схожість назв {prescreen['score']}% "
+        f"(поріг {TRIAGE_THRESHOLD:g}%), {describe_goods_services_score(goods).lower()}. "
+        f"Детальний аналіз GPT не проводився."
+    )
+    result = {
+        "trademark_info": {
+            "application_number": existing_tm.get('application_number', ''),
+            "owner": existing_tm.get('owner', ''),
+            "name": existing_tm.get('name', ''),
+            "classes": existing_tm.get('classes', '')
+        },
+        "identical_test": {
+            "is_identical": False,
+            "percentage": 0,
+            "details": note
+        },
+        "similarity_analysis": {
+            "phonetic": {"percentage": prescreen['phonetic'], "details": note},
+            "graphic": {"percentage": prescreen['edit'], "details": note},
+            "semantic": {"percentage": 0, "details": "Семантичний аналіз не проводився (локальний скринінг)"},
+            "visual": {"percentage": 0, "details": "Візуальний аналіз не проводився (локальний скринінг)"}
+        },
+        "goods_services_relation": {
+            "are_related": bool(goods['relatedness']),
+            "details": f"{describe_goods_services_score(goods)} (локальна оцінка за класами МКТП)"
+        },
+        "overall_risk": round(prescreen['score'] / 2),
+        "confusion_likelihood": "низька",
+        "recommendations": [
+            "Марки суттєво відрізняються за локальною оцінкою. За потреби проведіть повний аналіз без скринінгу."
+        ],
+        "prescreen": dict(prescreen, llm_skipped=True)
+    }
+    
+    if existing_tm.get('image'):
+        result['trademark_info']['image'] = existing_tm['image']
+    
+    return result
+
+def image_content_hash(base64_string):
+    """Повертає SHA-256 від байтів зображення (без data URL префікса)"""
+    if not base64_string:
+        return None
+    data = base64_string.split(',', 1)[1] if ',' in base64_string else base64_string
+    try:
+        return hashlib.sha256(base64.b64decode(data)).hexdigest()
+    except Exception:
+        return hashlib.sha256(data.encode('utf-8')).hexdigest()
+
+def normalize_mark_for_cache(tm):
+    """Нормалізує поля марки, що впливають на результат аналізу"""
+    return {
+        'name': ' '.join(str(tm.get('name') or '').lower().split()),
+        'classes': sorted(parse_nice_classes(tm.get('classes'))),
+        'description': ' '.join(str(tm.get('description') or '').lower().split()),
+        'image': image_content_hash(tm.get('image'))
+    }
+
+def iter_registry_records(path_or_file, file_format=None):
+    """Послідовно читає записи реєстру з CSV або JSONL (без завантаження всього файлу)"""
+    if isinstance(path_or_file, str):
+        file_format = file_format or ('jsonl' if path_or_file.lower().endswith(('.jsonl', '.json')) else 'csv')
+        with open(path_or_file, encoding='utf-8-sig', newline='') as f:
+            yield from iter_registry_records(f, file_format)
+        return
+    
+    if file_format == 'jsonl':
+        for line in path_or_file:
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                record = json.loads(line)
+            except json.JSONDecodeError:
+                continue
+            if record.get('name'):
+                yield record
+    else:
+        for record in csv.DictReader(path_or_file):
+            if record.get('name'):
+                yield record
+
+def registry_record_to_trademark(record):
+    """Приводить запис реєстру до формату existing_trademarks для /api/analyze"""
+    return {
+        'application_number': str(record.get('application_number') or ''),
+        'owner': str(record.get('owner') or ''),
+        'name': str(record.get('name') or ''),
+        'classes': str(record.get('classes') or '')
+    }
+
+def score_registry_candidate(desired_tm, trademark):
+    """Оцінка кандидата з реєстру: схожість назв плюс бонус за спорідненість класів"""
+    prescreen = prescreen_pair(desired_tm, trademark)
+    desired_bits = classes_to_bits(str(desired_tm.get('classes') or ''))
+    trademark_bits = classes_to_bits(trademark.get('classes') or '')
+    shared = bits_to_classes(desired_bits & trademark_bits)
+    bonus = 5 * class_relatedness(desired_bits, trademark_bits) / 100 if desired_bits and trademark_bits else 0
+    return prescreen['score'] + bonus, prescreen, shared
+
+class TrademarkRegistry:
+    """Індекс зареєстрованих ТМ у пам'яті: триграми назв, фонетичні ключі та класи МКТП"""
+    
+    def __init__(self, path=None):
+        self.path = path
+        self.entries = []
+        self.names = []
+        self.trigram_index = {}
+        self.phonetic_index = {}
+        self.class_index = {}
+        self.loaded_at = None
+        self.load_error = None
+        self._lock = threading.Lock()
+    
+    def ensure_loaded(self):
+        """Завантажує реєстр один раз; помилку запам'ятовує, щоб не перечитувати файл на кожен запит"""
+        if self.loaded_at or self.load_error or not self.path:
+            return
+        with self._lock:
+            if not self.loaded_at and not self.load_error:
+                try:
+                    self.load(self.path)
+                except Exception as e:
+                    self.load_error = str(e)
+                    print(f"❌ Помилка завантаження реєстру {self.path}: {e}")
+    
+    def load(self, path):
+        started = time.time()
+        entries, names = [], []
+        trigram_index, phonetic_index, class_index = {}, {}, {}
+        
+        for record in iter_registry_records(path):
+            entry_id = len(entries)
+            entry = registry_record_to_trademark(record)
+            name = normalize_mark_name(entry['name'])
+            entries.append(entry)
+            names.append(name)
             
-            if size_kb <= max_size_kb:
-                break
-            quality -= 5
-        
-        # Конвертуємо назад в base64
-        buffer.seek(0)
-        compressed_data = base64.b64encode(buffer.read()).decode('utf-8')
-        compressed_size_kb = len(compressed_data) / 1024
+            for gram in char_ngrams(name, 3):
+                trigram_index.setdefault(gram, []).append(entry_id)
+            phonetic_index.setdefault(phonetic_key(name), []).append(entry_id)
+            for nice_class in parse_nice_classes(entry['classes']):
+                class_index.setdefault(nice_class, []).append(entry_id)
+        
+        self.entries, self.names = entries, names
+        self.trigram_index, self.phonetic_index, self.class_index = trigram_index, phonetic_index, class_index
+        self.path = path
+        self.loaded_at = datetime.now()
+        print(f"📚 Реєстр завантажено: {len(entries)} ТМ за {time.time() - started:.1f} с")
+    
+    def search(self, name, classes=None, top_k=20, same_class_only=False):
+        """Повертає top-K найближчих зареєстрованих ТМ з оцінкою схожості"""
+        self.ensure_loaded()
+        query = normalize_mark_name(name)
+        if not query or not self.entries:
+            return []
+        
+        query_grams = char_ngrams(query, 3)
+        counts = Counter()
+        for gram in query_grams:
+            counts.update(self.trigram_index.get(gram, ()))
+        phonetic_matches = set(self.phonetic_index.get(phonetic_key(query), ()))
+        
+        query_classes = parse_nice_classes(classes)
+        if query_classes and same_class_only:
+            in_classes = set()
+            for nice_class in query_classes:
+                in_classes.update(self.class_index.get(nice_class, ()))
+            counts = Counter({entry_id: count for entry_id, count in counts.items() if entry_id in in_classes})
+            phonetic_matches &= in_classes
+        
+        # Грубий відбір за триграмами (коефіцієнт Дайса), потім точна оцінка кандидатів
+        shortlist = set(heapq.nlargest(
+            max(top_k * 10, 200),
+            counts,
+            key=lambda entry_id: counts[entry_id] / (len(query_grams) + len(self.names[entry_id]))
+        ))
+        shortlist.update(list(phonetic_matches)[:max(top_k * 10, 200)])
         
-        print(f"🗜️ Стиснення: {len(data)/1024:.1f}KB → {compressed_size_kb:.1f}KB (якість: {quality})")
+        scored = []
+        for entry_id in shortlist:
+            score, prescreen, shared = score_registry_candidate({'name': name, 'classes': classes}, self.entries[entry_id])
+            scored.append((score, entry_id, prescreen, shared))
+        scored.sort(key=lambda item: (-item[0], item[1]))
         
-        return f"{header},{compressed_data}"
-    
+        return [
+            dict(self.entries[entry_id], search_score=prescreen['score'], prescreen=prescreen, shared_classes=shared)
+            for _, entry_id, prescreen, shared in scored[:top_k]
+        ]
+
+trademark_registry = TrademarkRegistry(os.getenv('REGISTRY_PATH'))
+if trademark_registry.path and multiprocessing.parent_process() is None:
+    # Завантажуємо реєстр у фоні (лише в процесі воркера, не в пулі CPU-задач), щоб не затримувати старт воркера
+    threading.Thread(target=trademark_registry.ensure_loaded, daemon=True).start()
+
+# Нормалізовані (стиснуті) зображення у пам'яті, ключ - хеш вмісту
+IMAGE_CACHE_MAX_ITEMS = int(os.getenv('IMAGE_CACHE_MAX_ITEMS', '256'))
+VISION_IMAGE_MAX_KB = 80
+
+class ImageCache:
+    """LRU-кеш нормалізованих зображень у пам'яті процесу"""
+    
+    def __init__(self, max_items):
+        self.max_items = max_items
+        self.items = OrderedDict()
+        self._lock = threading.Lock()
+    
+    def get(self, key):
+        with self._lock:
+            value = self.items.get(key)
+            if value is not None:
+                self.items.move_to_end(key)
+            return value
+    
+    def put(self, key, value):
+        with self._lock:
+            self.items[key] = value
+            self.items.move_to_end(key)
+            while len(self.items) > self.max_items:
+                self.items.popitem(last=False)
+
+image_cache = ImageCache(IMAGE_CACHE_MAX_ITEMS)
+
+def image_cache_key(base64_string):
+    data = base64_string.split(',', 1)[1] if ',' in base64_string else base64_string
+    return hashlib.sha256(data.encode('ascii', 'ignore')).hexdigest()
+
+def normalize_image_data(source, max_size_kb):
+    """CPU-частина нормалізації (виконується в пулі процесів): стиснення та відбиток логотипу"""
+    normalized, img = compress_image(io.BytesIO(source) if isinstance(source, bytes) else source, max_size_kb)
+    return normalized, compute_logo_fingerprint(img)
+
+def run_normalize_task(source):
+    """Нормалізація в пулі; якщо пул зайнятий або не відповів - у поточному потоці, щоб не втратити зображення"""
+    try:
+        return image_pool.run(normalize_image_data, source, VISION_IMAGE_MAX_KB, timeout=IMAGE_TASK_TIMEOUT)
+    except CPUTaskError as e:
+        print(f"⚠️ Стискаємо зображення в потоці запиту: {e}")
+        return normalize_image_data(source, VISION_IMAGE_MAX_KB)
+
+def normalize_image(base64_string):
+    """Стискає зображення для GPT один раз; повторні виклики беруть результат з кешу"""
+    key = image_cache_key(base64_string)
+    cached = image_cache.get(key)
+    if cached is not None:
+        return cached
+    
+    data = base64_string.split(',', 1)[1] if ',' in base64_string else base64_string
+    try:
+        normalized, fingerprint = run_normalize_task(base64.b64decode(data))
     except Exception as e:
         print(f"⚠️ Помилка стиснення зображення: {e}")
-        return base64_string
+        normalized, fingerprint = base64_string, None
+    return remember_normalized_image(key, normalized, fingerprint)
+
+def normalize_image_upload(upload):
+    """Нормалізує завантажений файл, декодуючи його прямо з потоку (без base64 у пам'яті)"""
+    stream = upload.stream
+    digest = hashlib.sha256()
+    for chunk in iter(lambda: stream.read(65536), b''):
+        digest.update(chunk)
+    stream.seek(0)
+    
+    key = f"upload:{digest.hexdigest()}"
+    cached = image_cache.get(key)
+    if cached is not None:
+        return cached
+    
+    try:
+        # У пул процесів передаємо сирі байти файлу; без пулу декодуємо прямо з потоку
+        source = stream.read() if image_pool.enabled else stream
+        normalized, fingerprint = run_normalize_task(source)
+    except Exception as e:
+        print(f"⚠️ Не вдалося прочитати зображення '{upload.filename}': {e}")
+        return None
+    return remember_normalized_image(key, normalized, fingerprint)
+
+def remember_normalized_image(key, normalized, fingerprint):
+    """Кешує нормалізоване зображення та відбиток логотипу під вхідним і власним ключем"""
+    normalized_key = image_cache_key(normalized)
+    image_cache.put(key, normalized)
+    # Вже нормалізоване зображення також не обробляємо повторно
+    image_cache.put(normalized_key, normalized)
+    
+    if fingerprint is not None:
+        logo_fingerprints.put(key, fingerprint)
+        logo_fingerprints.put(normalized_key, fingerprint)
+    return normalized
+
+# Локальна візуальна схожість логотипів (перцептивні хеші, гістограми, структура)
+LOCAL_VISUAL_ENABLED = os.getenv('LOCAL_VISUAL_ENABLED', '0') == '1'
+VISUAL_IDENTICAL_SCORE = float(os.getenv('VISUAL_IDENTICAL_SCORE', '95'))
+VISUAL_DISTINCT_SCORE = float(os.getenv('VISUAL_DISTINCT_SCORE', '30'))
+
+logo_fingerprints = ImageCache(IMAGE_CACHE_MAX_ITEMS)
+
+# Таблиця косинусів для DCT 32x32 (перші 8 коефіцієнтів)
+DCT_COSINES = [[math.cos((2 * x + 1) * u * math.pi / 64) for x in range(32)] for u in range(8)]
+
+def trim_background(img):
+    """Обрізає однотонні поля навколо логотипу (колір беремо з лівого верхнього кута)"""
+    background = Image.new(img.mode, img.size, img.getpixel((0, 0)))
+    diff = ImageChops.difference(img, background).convert('L').point(lambda value: 255 if value > 24 else 0)
+    bbox = diff.getbbox()
+    return img.crop(bbox) if bbox else img
+
+def bits_from(values, threshold):
+    bits = 0
+    for value in values:
+        bits = (bits << 1) | (value > threshold)
+    return bits
+
+def compute_logo_fingerprint(img):
+    """Відбиток логотипу: aHash, dHash, pHash, кольорова гістограма та мініатюра 32x32"""
+    img = trim_background(img.convert('RGB'))
+    gray = img.convert('L')
+    
+    small = list(gray.resize((8, 8), Image.Resampling.BILINEAR).getdata())
+    ahash = bits_from(small, sum(small) / 64)
+    
+    wide = list(gray.resize((9, 8), Image.Resampling.BILINEAR).getdata())
+    dhash = bits_from((wide[row * 9 + col + 1] - wide[row * 9 + col] for row in range(8) for col in range(8)), 0)
+    
+    # pHash: 8x8 низькочастотних коефіцієнтів DCT (роздільно: рядки, потім стовпці)
+    thumb = list(gray.resize((32, 32), Image.Resampling.BILINEAR).getdata())
+    rows = [[sum(cosines[x] * thumb[y * 32 + x] for x in range(32)) for cosines in DCT_COSINES] for y in range(32)]
+    dct = [sum(DCT_COSINES[v][y] * rows[y][u] for y in range(32)) for v in range(8) for u in range(8)]
+    median = sorted(dct[1:])[31]
+    # Коефіцієнти біля медіани (часто нульові у симетричних логотипів) не повинні перемикати біти від шуму
+    margin = 0.02 * max(abs(value) for value in dct[1:])
+    phash = bits_from(dct, median + margin)
+    
+    # Гістограма 3x16 кошиків, нормалізована
+    histogram = img.resize((64, 64), Image.Resampling.BILINEAR).histogram()
+    binned = [sum(histogram[channel * 256 + start:channel * 256 + start + 16]) for channel in range(3) for start in range(0, 256, 16)]
+    total = sum(binned) or 1
+    
+    return {
+        'ahash': ahash,
+        'dhash': dhash,
+        'phash': phash,
+        'histogram': [value / total for value in binned],
+        'thumb': thumb
+    }
+
+def decode_image_data_url(base64_string):
+    """Декодує data URL у RGB-зображення (прозорість - на білому тлі)"""
+    data = base64_string.split(',', 1)[1] if ',' in base64_string else base64_string
+    img = Image.open(io.BytesIO(base64.b64decode(data)))
+    if img.mode in ('RGBA', 'LA', 'P', 'PA'):
+        img = img.convert('RGBA')
+        background = Image.new('RGB', img.size, (255, 255, 255))
+        background.paste(img, mask=img.split()[-1])
+        return background
+    return img.convert('RGB')
+
+def get_logo_fingerprint(base64_string):
+    """Відбиток логотипу з кешу або з декодованого зображення"""
+    key = image_cache_key(base64_string)
+    fingerprint = logo_fingerprints.get(key)
+    if fingerprint is None:
+        fingerprint = compute_logo_fingerprint(decode_image_data_url(base64_string))
+        logo_fingerprints.put(key, fingerprint)
+    return fingerprint
+
+def structural_similarity(a, b):
+    """Глобальний SSIM двох мініатюр у відтінках сірого (0-1)"""
+    n = len(a)
+    mean_a, mean_b = sum(a) / n, sum(b) / n
+    var_a = sum((x - mean_a) ** 2 for x in a) / n
+    var_b = sum((y - mean_b) ** 2 for y in b) / n
+    covariance = sum((x - mean_a) * (y - mean_b) for x, y in zip(a, b)) / n
+    c1, c2 = (0.01 * 255) ** 2, (0.03 * 255) ** 2
+    ssim = ((2 * mean_a * mean_b + c1) * (2 * covariance + c2)) / ((mean_a ** 2 + mean_b ** 2 + c1) * (var_a + var_b + c2))
+    return max(0.0, ssim)
+
+def compare_logos(image_a, image_b):
+    """Локальна оцінка візуальної схожості двох логотипів у відсотках"""
+    fp_a, fp_b = get_logo_fingerprint(image_a), get_logo_fingerprint(image_b)
+    hashes = {
+        name: 1 - bin(fp_a[name] ^ fp_b[name]).count('1') / 64
+        for name in ('ahash', 'dhash', 'phash')
+    }
+    color = sum(min(x, y) for x, y in zip(fp_a['histogram'], fp_b['histogram']))
+    structure = structural_similarity(fp_a['thumb'], fp_b['thumb'])
+    
+    # Випадкові хеші збігаються приблизно на 50%, тому масштабуємо їх у 0-1
+    hash_score = max(0.0, (sum(hashes.values()) / 3 - 0.5) * 2)
+    score = 0.5 * hash_score + 0.2 * color + 0.3 * structure
+    
+    return {
+        'percentage': round(score * 100),
+        'hashes': {name: round(value * 100) for name, value in hashes.items()},
+        'color': round(color * 100),
+        'structure': round(structure * 100)
+    }
+
+def describe_local_visual(visual):
+    if visual['percentage'] >= VISUAL_IDENTICAL_SCORE:
+        verdict = "логотипи практично ідентичні"
+    elif visual['percentage'] < VISUAL_DISTINCT_SCORE:
+        verdict = "логотипи явно різні"
+    else:
+        verdict = "логотипи мають певну схожість"
+    return (
+        f"Локальне порівняння зображень: {verdict} (схожість {visual['percentage']}%: "
+        f"перцептивні хеші {visual['hashes']['phash']}%, кольори {visual['color']}%, "
+        f"структура {visual['structure']}%)."
+    )
+
+def needs_vision_call(visual):
+    """Vision потрібен лише для неоднозначних випадків"""
+    if not LOCAL_VISUAL_ENABLED:
+        return True
+    return VISUAL_DISTINCT_SCORE <= visual['percentage'] < VISUAL_IDENTICAL_SCORE
+
+# Vision: вартість зображень у токенах за тайловою моделлю (detail=low - фіксовано, high - за тайлами 512x512)
+VISION_DETAIL = os.getenv('VISION_DETAIL', 'auto')  # auto | low | high
+VISION_MAX_TILES = max(1, int(os.getenv('VISION_MAX_TILES', '1')))
+VISION_COMPOSITE_ENABLED = os.getenv('VISION_COMPOSITE_ENABLED', '0') == '1'
+VISION_TILE_SIZE = 512
+VISION_BASE_TOKENS = 85
+VISION_TILE_TOKENS = 170
+VISION_COMPOSITE_CELL = 256
+VISION_COMPOSITE_LABEL = 28
+
+vision_image_cache = ImageCache(IMAGE_CACHE_MAX_ITEMS)
+
+def vision_tiles(width, height):
+    """Кількість тайлів для detail=high після масштабування на боці API (2048, потім 768 по меншій стороні)"""
+    scale = min(1.0, 2048 / max(width, height))
+    width, height = width * scale, height * scale
+    scale = min(1.0, 768 / min(width, height))
+    width, height = width * scale, height * scale
+    return math.ceil(width / VISION_TILE_SIZE) * math.ceil(height / VISION_TILE_SIZE)
+
+def vision_image_tokens(width, height, detail):
+    if detail == 'low':
+        return VISION_BASE_TOKENS
+    return VISION_BASE_TOKENS + VISION_TILE_TOKENS * vision_tiles(width, height)
+
+def fit_vision_size(width, height, max_tiles):
+    """Найбільший розмір зображення, що вкладається в max_tiles тайлів"""
+    if vision_tiles(width, height) <= max_tiles:
+        return width, height
+    # Кількість тайлів монотонна за масштабом, тому шукаємо його бісекцією
+    low, high = 0.0, 1.0
+    for _ in range(20):
+        scale = (low + high) / 2
+        if vision_tiles(int(width * scale), int(height * scale)) <= max_tiles:
+            low = scale
+        else:
+            high = scale
+    return max(1, int(width * low)), max(1, int(height * low))
+
+def choose_vision_detail(width, height):
+    if VISION_DETAIL in ('low', 'high'):
+        return VISION_DETAIL
+    # Зображення в межах одного тайла модель бачить повністю і в режимі low
+    return 'low' if max(width, height) <= VISION_TILE_SIZE else 'high'
+
+def encode_vision_image(img):
+    return f"data:image/jpeg;base64,{base64.b64encode(encode_jpeg(img, JPEG_MAX_QUALITY, optimize=True)).decode('utf-8')}"
+
+def prepare_vision_image(image_url):
+    """Зменшує зображення до бюджету тайлів; повертає (url, detail, оцінка токенів)"""
+    key = f"{image_cache_key(image_url)}:{VISION_DETAIL}:{VISION_MAX_TILES}"
+    prepared = vision_image_cache.get(key)
+    if prepared is not None:
+        return prepared
+    
+    img = decode_image_data_url(image_url)
+    # У режимі low модель бачить не більше 512x512, тому більше не передаємо
+    max_tiles = 1 if VISION_DETAIL == 'low' else VISION_MAX_TILES
+    size = fit_vision_size(*img.size, max_tiles)
+    url = image_url
+    if size != img.size:
+        img = img.resize(size, Image.Resampling.LANCZOS)
+        url = encode_vision_image(img)
+    detail = choose_vision_detail(*img.size)
+    prepared = (url, detail, vision_image_tokens(*img.size, detail))
+    vision_image_cache.put(key, prepared)
+    return prepared
+
+def load_label_font(size):
+    try:
+        return ImageFont.load_default(size=size)
+    except Exception:
+        return ImageFont.load_default()
+
+def build_vision_composite(desired_image, existing_image):
+    """Один підписаний кадр: ліворуч бажана ТМ (1), праворуч зареєстрована (2)"""
+    key = f"{image_cache_key(desired_image)}:{image_cache_key(existing_image)}:composite:{VISION_DETAIL}"
+    prepared = vision_image_cache.get(key)
+    if prepared is not None:
+        return prepared
+    
+    cell, label = VISION_COMPOSITE_CELL, VISION_COMPOSITE_LABEL
+    canvas = Image.new('RGB', (cell * 2, cell + label), (255, 255, 255))
+    draw = ImageDraw.Draw(canvas)
+    font = load_label_font(label - 8)
+    for position, image in enumerate((desired_image, existing_image)):
+        logo = decode_image_data_url(image)
+        logo.thumbnail((cell - 16, cell - 16), Image.Resampling.LANCZOS)
+        left = position * cell
+        canvas.paste(logo, (left + (cell - logo.width) // 2, label + (cell - logo.height) // 2))
+        draw.text((left + 8, 4), str(position + 1), fill=(0, 0, 0), font=font)
+    draw.line((cell, 0, cell, cell + label), fill=(160, 160, 160), width=2)
+    
+    detail = choose_vision_detail(*canvas.size)
+    prepared = (encode_vision_image(canvas), detail, vision_image_tokens(*canvas.size, detail))
+    vision_image_cache.put(key, prepared)
+    return prepared
+
+def image_size(image_url):
+    """Розміри з заголовка файлу, без декодування пікселів"""
+    data = image_url.split(',', 1)[1] if ',' in image_url else image_url
+    with Image.open(io.BytesIO(base64.b64decode(data))) as img:
+        return img.size
+
+def build_vision_content(text, desired_tm, existing_tm, has_desired_image, has_existing_image):
+    """Повідомлення для Vision та оцінка витрати токенів на зображення"""
+    messages_content = [{"type": "text", "text": text}]
+    images = [
+        (tm['image'], caption) for tm, present, caption in (
+            (desired_tm, has_desired_image,
+             f"☝️ Це логотип/зображення БАЖАНОЇ торговельної марки '{desired_tm.get('name', '')}'. Опиши його детально."),
+            (existing_tm, has_existing_image,
+             f"☝️ Це логотип/зображення ЗАРЕЄСТРОВАНОЇ торговельної марки '{existing_tm.get('name', '')}'. Опиши його детально та порівняй з попереднім.")
+        )
+        # Перевіряємо що це data URL
+        if present and tm['image'].startswith('data:image')
+    ]
+    
+    # Базова оцінка: кожне зображення повного розміру в режимі high
+    baseline = sum(vision_image_tokens(*image_size(image), 'high') for image, _ in images)
+    
+    if VISION_COMPOSITE_ENABLED and len(images) == 2:
+        prepared = [(build_vision_composite(images[0][0], images[1][0]), (
+            f"☝️ Ліворуч (1) - логотип БАЖАНОЇ торговельної марки '{desired_tm.get('name', '')}', "
+            f"праворуч (2) - логотип ЗАРЕЄСТРОВАНОЇ торговельної марки '{existing_tm.get('name', '')}'. "
+            f"Опиши кожен детально та порівняй їх."
+        ))]
+    else:
+        prepared = [(prepare_vision_image(image), caption) for image, caption in images]
+    
+    for (url, detail, _), caption in prepared:
+        messages_content.append({"type": "image_url", "image_url": {"url": url, "detail": detail}})
+        messages_content.append({"type": "text", "text": caption})
+    
+    usage = {
+        'images': len(prepared),
+        'detail': sorted({detail for (_, detail, _), _ in prepared}),
+        'estimated': sum(tokens for (_, _, tokens), _ in prepared),
+        'baseline': baseline
+    }
+    return messages_content, usage
+
+# Сховище зображень за хешем вмісту: результати та збережені аналізи містять лише посилання
+IMAGE_URL_PREFIX = '/api/images/'
+IMAGE_BLOB_PRUNE_INTERVAL = 3600
+
+def write_file_atomic(path, data):
+    """Записує файл через тимчасовий файл, щоб інші воркери не побачили його частково записаним"""
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(path))
+    with os.fdopen(fd, 'wb') as f:
+        f.write(data)
+    os.replace(temp_path, path)
+
+def prune_directory(root, max_age_seconds):
+    """Видаляє файли, змінені давніше за max_age_seconds; повертає їх кількість"""
+    now = time.time()
+    removed = 0
+    for directory, _, files in os.walk(root):
+        for name in files:
+            path = os.path.join(directory, name)
+            try:
+                if now - os.path.getmtime(path) > max_age_seconds:
+                    os.remove(path)
+                    removed += 1
+            except OSError:
+                pass
+    return removed
+
+class ImageBlobStore:
+    """Файли зображень у DATA_DIR/blobs/<2 символи>/<sha256>; кожне зображення зберігається один раз"""
+    
+    def __init__(self, root, retention_hours=168):
+        self.root = root
+        self.retention_seconds = retention_hours * 3600
+        self._last_prune = 0
+        os.makedirs(root, exist_ok=True)
+    
+    def _path(self, digest):
+        return os.path.join(self.root, digest[:2], digest)
+    
+    def put(self, data):
+        digest = hashlib.sha256(data).hexdigest()
+        path = self._path(digest)
+        if os.path.exists(path):
+            # Оновлюємо час, щоб зображення, на яке знову посилаються, не видалилось
+            os.utime(path)
+            return digest
+        write_file_atomic(path, data)
+        return digest
+    
+    def get(self, digest):
+        if not re.fullmatch(r'[0-9a-f]{64}', digest or ''):
+            return None
+        try:
+            with open(self._path(digest), 'rb') as f:
+                return f.read()
+        except FileNotFoundError:
+            return None
+    
+    def prune(self):
+        """Видаляє зображення, на які не посилались довше за термін зберігання аналізів (не частіше разу на годину)"""
+        now = time.time()
+        if now - self._last_prune < IMAGE_BLOB_PRUNE_INTERVAL:
+            return
+        self._last_prune = now
+        removed = prune_directory(self.root, self.retention_seconds)
+        if removed:
+            print(f"🧹 Видалено застарілих зображень: {removed}")
+
+image_blobs = ImageBlobStore(
+    os.path.join(DATA_DIR, 'blobs'),
+    retention_hours=float(os.getenv('ANALYSIS_RETENTION_HOURS', '168'))
+)
+
+def image_mime(data):
+    try:
+        return Image.MIME.get(Image.open(io.BytesIO(data)).format, 'application/octet-stream')
+    except Exception:
+        return 'application/octet-stream'
+
+def store_image_ref(image):
+    """Зберігає data URL у сховищі зображень і повертає посилання на нього"""
+    if not image or not image.startswith('data:'):
+        return image
+    try:
+        return IMAGE_URL_PREFIX + image_blobs.put(base64.b64decode(image.split(',', 1)[1]))
+    except Exception as e:
+        print(f"⚠️ Не вдалося зберегти зображення: {e}")
+        return image
+
+def load_image_bytes(image):
+    """Байти зображення з data URL або з посилання на сховище"""
+    if image.startswith(IMAGE_URL_PREFIX):
+        data = image_blobs.get(image[len(IMAGE_URL_PREFIX):])
+        if data is None:
+            raise ValueError(f"Зображення {image} не знайдено")
+        return data
+    return base64.b64decode(image.split(',', 1)[1])
+
+def resolve_image_ref(image):
+    """Посилання на сховище -> data URL для аналізу (інші значення без змін)"""
+    if not image or not image.startswith(IMAGE_URL_PREFIX):
+        return image
+    try:
+        data = load_image_bytes(image)
+    except ValueError as e:
+        print(f"⚠️ {e}")
+        return None
+    return f"data:{image_mime(data)};base64,{base64.b64encode(data).decode('utf-8')}"
+
+def with_image_ref(result):
+    """Замінює зображення в результаті пари посиланням на сховище"""
+    trademark_info = result.get('trademark_info') or {}
+    if trademark_info.get('image'):
+        trademark_info['image'] = store_image_ref(trademark_info['image'])
+    return result
+
+def has_image(tm):
+    return bool(tm.get('image')) and len(str(tm.get('image', ''))) > 100
+
+def prepare_images(desired_tm, existing_trademarks):
+    """Етап підготовки запиту: кожне унікальне зображення нормалізується рівно один раз"""
+    desired_tm = dict(desired_tm)
+    if has_image(desired_tm):
+        desired_tm['image'] = normalize_image(desired_tm['image'])
+    
+    prepared = []
+    for existing_tm in existing_trademarks:
+        existing_tm = dict(existing_tm)
+        if has_image(existing_tm):
+            existing_tm['image'] = normalize_image(existing_tm['image'])
+        prepared.append(existing_tm)
+    return desired_tm, prepared
 
 @app.route('/')
 def index():
@@ -227,6 +1548,14 @@ def index():
                     <h2>📋 Зареєстровані торговельні марки</h2>
                     <div id="existing-trademarks"></div>
                     <button type="button" class="btn btn-secondary" onclick="addExistingTM()">➕ Додати ТМ</button>
+                    <button type="button" class="btn btn-secondary" onclick="searchRegistry()">🔎 Знайти схожі в реєстрі</button>
+                </div>
+                
+                <div class="form-section">
+                    <label>
+                        <input type="checkbox" id="triage-mode" {{ 'checked' if triage_enabled }}>
+                        ⏭️ Швидкий скринінг: не відправляти на детальний аналіз явно відмінні ТМ
+                    </label>
                 </div>
                 
                 <div style="text-align: center;">
@@ -261,7 +1590,7 @@ def index():
                 }
             }
             
-            function addExistingTM() {
+            function addExistingTM(prefill) {
                 existingTMCount++;
                 const container = document.getElementById('existing-trademarks');
                 const tmDiv = document.createElement('div');
@@ -292,19 +1621,97 @@ def index():
                     <button type="button" class="btn btn-secondary" onclick="removeTM(this)">❌ Видалити</button>
                 `;
                 container.appendChild(tmDiv);
+                
+                // Заповнюємо поля даними з реєстру
+                if (prefill) {
+                    ['number', 'owner', 'name', 'classes'].forEach(field => {
+                        const key = field === 'number' ? 'application_number' : field;
+                        tmDiv.querySelector(`input[name="existing-${existingTMCount}-${field}"]`).value = prefill[key] || '';
+                    });
+                }
+            }
+            
+            async function searchRegistry() {
+                const name = document.getElementById('desired-name').value.trim();
+                if (!name) {
+                    alert('Спочатку вкажіть назву бажаної торговельної марки');
+                    return;
+                }
+                const classes = document.getElementById('desired-classes').value;
+                try {
+                    const response = await fetch(`/api/search?name=${encodeURIComponent(name)}&classes=${encodeURIComponent(classes)}&limit=10`);
+                    const result = await response.json();
+                    if (!response.ok) throw new Error(result.error || `HTTP ${response.status}`);
+                    
+                    // Прибираємо порожні блоки перед додаванням знайдених ТМ
+                    document.querySelectorAll('#existing-trademarks .existing-tm').forEach(tmDiv => {
+                        const nameInput = tmDiv.querySelector('input[name$="-name"]');
+                        if (nameInput && !nameInput.value) tmDiv.remove();
+                    });
+                    result.existing_trademarks.forEach(tm => addExistingTM(tm));
+                    console.log(`🔎 Знайдено ${result.existing_trademarks.length} ТМ за ${result.took_ms} мс`);
+                } catch (error) {
+                    alert(`Помилка пошуку: ${error.message}`);
+                }
             }
             
             function removeTM(button) { button.parentElement.remove(); }
             
             addExistingTM();
             
-            async function fileToBase64(file) {
-                return new Promise((resolve, reject) => {
-                    const reader = new FileReader();
-                    reader.onload = () => resolve(reader.result);
-                    reader.onerror = reject;
-                    reader.readAsDataURL(file);
-                });
+            // Зменшення логотипів у браузері з тими ж параметрами, що й compress_image_base64 на сервері
+            const IMAGE_MAX_DIMENSION = {{ image_max_dimension }};
+            const IMAGE_MAX_KB = {{ image_max_kb }};
+            const JPEG_MAX_QUALITY = {{ jpeg_max_quality }};
+            const JPEG_MIN_QUALITY = {{ jpeg_min_quality }};
+            
+            function canvasToJpeg(canvas, quality) {
+                if (canvas.convertToBlob) {
+                    return canvas.convertToBlob({ type: 'image/jpeg', quality: quality / 100 });
+                }
+                return new Promise(resolve => canvas.toBlob(resolve, 'image/jpeg', quality / 100));
+            }
+            
+            async function downscaleImage(file) {
+                try {
+                    const bitmap = await createImageBitmap(file);
+                    const ratio = Math.min(1, IMAGE_MAX_DIMENSION / Math.max(bitmap.width, bitmap.height));
+                    const width = Math.max(1, Math.floor(bitmap.width * ratio));
+                    const height = Math.max(1, Math.floor(bitmap.height * ratio));
+                    const canvas = typeof OffscreenCanvas !== 'undefined'
+                        ? new OffscreenCanvas(width, height)
+                        : Object.assign(document.createElement('canvas'), { width, height });
+                    const context = canvas.getContext('2d');
+                    // Прозорість - на білому тлі, як на сервері
+                    context.fillStyle = '#ffffff';
+                    context.fillRect(0, 0, width, height);
+                    context.imageSmoothingQuality = 'high';
+                    context.drawImage(bitmap, 0, 0, width, height);
+                    bitmap.close();
+                    
+                    let blob = await canvasToJpeg(canvas, JPEG_MAX_QUALITY);
+                    if (blob.size > IMAGE_MAX_KB * 1024) {
+                        // Бінарний пошук найвищої якості, що вкладається в ліміт
+                        let low = JPEG_MIN_QUALITY, high = JPEG_MAX_QUALITY - 1, best = null;
+                        while (low <= high) {
+                            const middle = Math.floor((low + high) / 2);
+                            const candidate = await canvasToJpeg(canvas, middle);
+                            if (candidate.size <= IMAGE_MAX_KB * 1024) {
+                                best = candidate;
+                                low = middle + 1;
+                            } else {
+                                high = middle - 1;
+                            }
+                        }
+                        blob = best || await canvasToJpeg(canvas, JPEG_MIN_QUALITY);
+                    }
+                    console.log(`🗜️ ${file.name}: ${(file.size / 1024).toFixed(1)}KB → ${(blob.size / 1024).toFixed(1)}KB`);
+                    return new File([blob], file.name.replace(/\.[^.]+$/, '') + '.jpg', { type: 'image/jpeg' });
+                } catch (error) {
+                    // Браузер не зміг декодувати - сервер стисне оригінал
+                    console.warn('Не вдалося зменшити зображення в браузері:', error);
+                    return file;
+                }
             }
             
             document.getElementById('tmAnalyzerForm').addEventListener('submit', async function(e) {
@@ -315,150 +1722,192 @@ def index():
                 
                 const formData = new FormData(e.target);
                 
-                let desiredImage = null;
-                const desiredImageFile = document.getElementById('desired-image').files[0];
-                if (desiredImageFile) {
-                    desiredImage = await fileToBase64(desiredImageFile);
-                }
-                
+                // Зображення надсилаємо окремими файлами multipart, а не base64 у JSON
+                const upload = new FormData();
                 const data = {
                     desired_trademark: {
                         name: document.getElementById('desired-name').value,
                         description: document.getElementById('desired-description').value,
-                        classes: document.getElementById('desired-classes').value,
-                        image: desiredImage
+                        classes: document.getElementById('desired-classes').value
                     },
-                    existing_trademarks: []
+                    existing_trademarks: [],
+                    triage: document.getElementById('triage-mode').checked
                 };
                 
+                const desiredImageInput = document.getElementById('desired-image').files[0];
+                const desiredImageFile = desiredImageInput ? await downscaleImage(desiredImageInput) : null;
+                if (desiredImageFile) {
+                    upload.append('desired_image', desiredImageFile);
+                }
+                
                 for (let i = 1; i <= existingTMCount; i++) {
                     const name = formData.get(`existing-${i}-name`);
                     if (name) {
-                        let existingImage = null;
                         const existingImageInput = document.querySelector(`input[name="existing-${i}-image"]`);
                         if (existingImageInput && existingImageInput.files[0]) {
-                            existingImage = await fileToBase64(existingImageInput.files[0]);
+                            upload.append(`existing_image_${data.existing_trademarks.length}`, await downscaleImage(existingImageInput.files[0]));
                         }
                         
                         data.existing_trademarks.push({
                             application_number: formData.get(`existing-${i}-number`) || '',
                             owner: formData.get(`existing-${i}-owner`) || '',
                             name: name,
-                            classes: formData.get(`existing-${i}-classes`) || '',
-                            image: existingImage
+                            classes: formData.get(`existing-${i}-classes`) || ''
                         });
                     }
                 }
+                upload.append('payload', JSON.stringify(data));
                 
                 try {
-                    const response = await fetch('/api/analyze', {
+                    const response = await fetch('/api/analyze?stream=1', {
                         method: 'POST',
-                        headers: { 'Content-Type': 'application/json' },
-                        body: JSON.stringify(data)
+                        headers: { 'Accept': 'application/x-ndjson' },
+                        body: upload
                     });
                     
                     if (!response.ok) throw new Error(`HTTP ${response.status}`);
                     
-                    const results = await response.json();
-                    analysisId = results.analysis_id;
-                    
+                    // Готуємо місця для карток, щоб зберегти порядок ТМ
+                    const container = document.getElementById('analysis-results');
+                    container.innerHTML = '<h2>📊 Результати аналізу</h2>' +
+                        renderDesiredCard({
+                            ...data.desired_trademark,
+                            image: desiredImageFile ? URL.createObjectURL(desiredImageFile) : null
+                        }) +
+                        data.existing_trademarks.map((tm, index) => `
+                            <div id="result-slot-${index}" class="result-card">
+                                <h3>⏳ ТМ №${tm.application_number || (index + 1)}: ${tm.name}</h3>
+                                <p>Аналізуємо...</p>
+                            </div>
+                        `).join('') +
+                        '<div id="analysis-summary"></div>';
+                    container.style.display = 'block';
                     document.getElementById('loading').style.display = 'none';
-                    displayResults(results);
+                    
+                    // Читаємо NDJSON потік і відображаємо кожен результат одразу
+                    const reader = response.body.getReader();
+                    const decoder = new TextDecoder();
+                    let buffer = '';
+                    while (true) {
+                        const { done, value } = await reader.read();
+                        if (done) break;
+                        buffer += decoder.decode(value, { stream: true });
+                        const lines = buffer.split('\\n');
+                        buffer = lines.pop();
+                        lines.filter(line => line.trim()).forEach(line => handleStreamEvent(JSON.parse(line)));
+                    }
+                    if (buffer.trim()) handleStreamEvent(JSON.parse(buffer));
                 } catch (error) {
+                    document.getElementById('loading').style.display = 'block';
                     document.getElementById('loading').innerHTML = `<p style="color: red;">Помилка: ${error.message}</p>`;
                 }
             });
             
-            function displayResults(results) {
-                const container = document.getElementById('analysis-results');
-                let html = '<h2>📊 Результати аналізу</h2>';
-                
-                // Зберігаємо analysisId глобально
-                if (results.analysis_id) {
-                    window.currentAnalysisId = results.analysis_id;
+            function handleStreamEvent(event) {
+                if (event.type === 'result') {
+                    const slot = document.getElementById(`result-slot-${event.index}`);
+                    if (slot) slot.outerHTML = renderResultCard(event.result, event.index);
+                } else if (event.type === 'summary') {
+                    analysisId = event.analysis_id;
+                    window.currentAnalysisId = event.analysis_id;
+                    document.getElementById('analysis-summary').innerHTML = renderConclusion(event);
+                    console.log('✅ Результати відображено');
+                    console.log('📊 Analysis ID:', window.currentAnalysisId);
+                } else if (event.type === 'error') {
+                    throw new Error(event.error);
                 }
-                
-                html += `
+            }
+            
+            function renderDesiredCard(desired) {
+                return `
                     <div class="result-card" style="background: #f0f8ff; border-left: 5px solid #007bff;">
                         <h3>🎯 Бажана торговельна марка</h3>
                         <div class="tm-images-container">
                             <div>
-                                <p><strong>Назва:</strong> ${results.desired_trademark.name}</p>
-                                <p><strong>Опис:</strong> ${results.desired_trademark.description || 'Не вказано'}</p>
-                                <p><strong>Класи МКТП:</strong> ${results.desired_trademark.classes || 'Не вказано'}</p>
+                                <p><strong>Назва:</strong> ${desired.name}</p>
+                                <p><strong>Опис:</strong> ${desired.description || 'Не вказано'}</p>
+                                <p><strong>Класи МКТП:</strong> ${desired.classes || 'Не вказано'}</p>
                             </div>
-                            ${results.desired_trademark.image ? `
+                            ${desired.image ? `
                                 <div class="image-preview">
-                                    <img src="${results.desired_trademark.image}" class="tm-image" alt="Бажана ТМ">
+                                    <img src="${desired.image}" class="tm-image" alt="Бажана ТМ">
                                 </div>
                             ` : ''}
                         </div>
                     </div>
                 `;
-                
-                results.results.forEach((result, index) => {
-                    const riskClass = result.overall_risk > 60 ? 'risk-high' : result.overall_risk > 30 ? 'risk-medium' : 'risk-low';
-                    html += `
-                        <div class="result-card ${riskClass}">
-                            <h3>📄 Порівняння з ТМ №${result.trademark_info.application_number || (index + 1)}</h3>
-                            
-                            <div class="tm-images-container">
-                                <div style="flex: 1;">
-                                    <p><strong>Власник:</strong> ${result.trademark_info.owner}</p>
-                                    <p><strong>Назва:</strong> ${result.trademark_info.name}</p>
-                                    <p><strong>Класи МКТП:</strong> ${result.trademark_info.classes}</p>
-                                    <div class="percentage" style="margin-top: 15px;">${result.overall_risk}%</div>
-                                    <p>Ризик змішування: <strong>${result.confusion_likelihood}</strong></p>
-                                </div>
-                                ${result.trademark_info.image ? `
-                                    <div class="image-preview">
-                                        <img src="${result.trademark_info.image}" class="tm-image" alt="Зареєстрована ТМ">
-                                        <p>Зареєстрована ТМ</p>
-                                    </div>
+            }
+            
+            function renderResultCard(result, index) {
+                const riskClass = result.overall_risk > 60 ? 'risk-high' : result.overall_risk > 30 ? 'risk-medium' : 'risk-low';
+                return `
+                    <div class="result-card ${riskClass}">
+                        <h3>📄 Порівняння з ТМ №${result.trademark_info.application_number || (index + 1)}</h3>
+                        
+                        <div class="tm-images-container">
+                            <div style="flex: 1;">
+                                <p><strong>Власник:</strong> ${result.trademark_info.owner}</p>
+                                <p><strong>Назва:</strong> ${result.trademark_info.name}</p>
+                                <p><strong>Класи МКТП:</strong> ${result.trademark_info.classes}</p>
+                                <div class="percentage" style="margin-top: 15px;">${result.overall_risk}%</div>
+                                <p>Ризик змішування: <strong>${result.confusion_likelihood}</strong></p>
+                                ${result.goods_services_score && result.goods_services_score.known ? `
+                                    <p>📦 Спорідненість класів МКТП: <strong>${result.goods_services_score.relatedness}%</strong></p>
                                 ` : ''}
-                            </div>
-                            
-                            ${result.similarity_analysis && result.similarity_analysis.phonetic ? `
-                                <div style="margin: 10px 0; padding: 10px; background: #f8f9fa; border-radius: 5px;">
-                                    <strong>🔊 Фонетична схожість:</strong> ${result.similarity_analysis.phonetic.percentage}%
-                                    <p>${result.similarity_analysis.phonetic.details}</p>
-                                </div>
-                            ` : ''}
-                            
-                            ${result.similarity_analysis && result.similarity_analysis.semantic ? `
-                                <div style="margin: 10px 0; padding: 10px; background: #f8f9fa; border-radius: 5px;">
-                                    <strong>💭 Семантична схожість:</strong> ${result.similarity_analysis.semantic.percentage}%
-                                    <p>${result.similarity_analysis.semantic.details}</p>
-                                </div>
-                            ` : ''}
-                            
-                            ${result.recommendations && result.recommendations.length > 0 ? `
-                                <div style="margin: 10px 0; padding: 10px; background: #fff3e0; border-radius: 5px;">
-                                    <strong>💡 Рекомендації:</strong>
-                                    <ul style="margin-left: 20px; margin-top: 5px;">
-                                        ${result.recommendations.map(rec => `<li>${rec}</li>`).join('')}
-                                    </ul>
+                                ${result.local_visual ? `
+                                    <p>🖼️ Локальна схожість логотипів: <strong>${result.local_visual.percentage}%</strong>${result.local_visual.vision_skipped ? ' (без Vision)' : ''}</p>
+                                ` : ''}
+                                ${result.prescreen && result.prescreen.llm_skipped ? `
+                                    <p style="color: #6c757d;">⏭️ Локальний скринінг (схожість назв ${result.prescreen.score}%): детальний аналіз не проводився</p>
+                                ` : ''}
+                            </div>
+                            ${result.trademark_info.image ? `
+                                <div class="image-preview">
+                                    <img src="${result.trademark_info.image}" class="tm-image" alt="Зареєстрована ТМ">
+                                    <p>Зареєстрована ТМ</p>
                                 </div>
                             ` : ''}
                         </div>
-                    `;
-                });
-                
-                const chanceColor = results.overall_chance > 70 ? '#4caf50' : results.overall_chance > 40 ? '#ff9800' : '#f44336';
-                html += `
+                        
+                        ${result.similarity_analysis && result.similarity_analysis.phonetic ? `
+                            <div style="margin: 10px 0; padding: 10px; background: #f8f9fa; border-radius: 5px;">
+                                <strong>🔊 Фонетична схожість:</strong> ${result.similarity_analysis.phonetic.percentage}%
+                                <p>${result.similarity_analysis.phonetic.details}</p>
+                            </div>
+                        ` : ''}
+                        
+                        ${result.similarity_analysis && result.similarity_analysis.semantic ? `
+                            <div style="margin: 10px 0; padding: 10px; background: #f8f9fa; border-radius: 5px;">
+                                <strong>💭 Семантична схожість:</strong> ${result.similarity_analysis.semantic.percentage}%
+                                <p>${result.similarity_analysis.semantic.details}</p>
+                            </div>
+                        ` : ''}
+                        
+                        ${result.recommendations && result.recommendations.length > 0 ? `
+                            <div style="margin: 10px 0; padding: 10px; background: #fff3e0; border-radius: 5px;">
+                                <strong>💡 Рекомендації:</strong>
+                                <ul style="margin-left: 20px; margin-top: 5px;">
+                                    ${result.recommendations.map(rec => `<li>${rec}</li>`).join('')}
+                                </ul>
+                            </div>
+                        ` : ''}
+                    </div>
+                `;
+            }
+            
+            function renderConclusion(summary) {
+                const chanceColor = summary.overall_chance > 70 ? '#4caf50' : summary.overall_chance > 40 ? '#ff9800' : '#f44336';
+                return `
                     <div class="final-conclusion">
                         <h2>📋 Загальний висновок</h2>
                         <div class="success-chance" style="color: ${chanceColor}">
-                            ✅ Шанс успішної реєстрації: ${results.overall_chance}%
+                            ✅ Шанс успішної реєстрації: ${summary.overall_chance}%
                         </div>
                         <p style="text-align: center; margin-top: 10px;">
-                            <small>Дата аналізу: ${new Date(results.analysis_date).toLocaleString('uk-UA')}</small>
+                            <small>Дата аналізу: ${new Date(summary.analysis_date).toLocaleString('uk-UA')}</small>
                         </p>
                     </div>
-                `;
-                
-                // ОБОВ'ЯЗКОВО додаємо кнопки експорту
-                html += `
+                    
                     <div class="export-buttons" style="margin: 30px 0; padding: 20px; background: white; border-radius: 8px; box-shadow: 0 2px 4px rgba(0,0,0,0.1);">
                         <h3 style="text-align: center; margin-bottom: 20px;">📥 Завантажити звіт</h3>
                         <div style="display: flex; justify-content: center; gap: 15px; flex-wrap: wrap;">
@@ -468,19 +1917,15 @@ def index():
                             <button class="btn btn-success" onclick="exportReport('pdf')" style="font-size: 16px; padding: 15px 30px;">
                                 📑 Завантажити PDF
                             </button>
+                            <button class="btn btn-success" onclick="exportReport('bundle')" style="font-size: 16px; padding: 15px 30px;">
+                                🗜️ Завантажити все (ZIP)
+                            </button>
                         </div>
                         <p style="text-align: center; margin-top: 15px; font-size: 14px; color: #666;">
                             Звіт містить всі результати аналізу та зображення торговельних марок
                         </p>
                     </div>
                 `;
-                
-                container.innerHTML = html;
-                container.style.display = 'block';
-                
-                // Логування для діагностики
-                console.log('✅ Результати відображено');
-                console.log('📊 Analysis ID:', window.currentAnalysisId);
             }
             
             function exportReport(format) {
@@ -499,7 +1944,14 @@ def index():
     </body>
     </html>
     """
-    return render_template_string(html_code)
+    return render_template_string(
+        html_code,
+        image_max_dimension=IMAGE_MAX_DIMENSION,
+        image_max_kb=VISION_IMAGE_MAX_KB,
+        jpeg_max_quality=JPEG_MAX_QUALITY,
+        jpeg_min_quality=JPEG_MIN_QUALITY,
+        triage_enabled=TRIAGE_ENABLED
+    )
 
 @app.route('/api/analyze', methods=['POST', 'OPTIONS'])
 def analyze_trademarks():
@@ -514,141 +1966,929 @@ def analyze_trademarks():
         print(f"📦 Content-Type: {request.content_type}")
         print(f"📦 Origin: {request.headers.get('Origin', 'No origin')}")
         
-        data = request.json
-        print(f"📦 Data received: {len(str(data))} chars")
+        data = read_analysis_request()
+        print(f"📦 Data received: {len(data.get('existing_trademarks') or [])} existing TMs")
         
         instructions = instruction_manager.get_instructions()
         
-        results = []
-        for i, existing_tm in enumerate(data['existing_trademarks'], 1):
-            print(f"🔄 Обробка ТМ {i}/{len(data['existing_trademarks'])}")
-            
-            analysis = analyze_single_pair(
-                desired_tm=data['desired_trademark'].copy(),  # Копія щоб не змінювати оригінал
-                existing_tm=existing_tm,
-                instructions=instructions['content']
-            )
-            results.append(analysis)
-            
-            # Звільняємо пам'ять після кожної ітерації
-            gc.collect()
-            print(f"✅ ТМ {i} оброблена, пам'ять звільнена")
-        
-        overall_chance = calculate_registration_chance(results)
+        slim = wants_slim()
+        if wants_stream():
+            return stream_analysis(data, instructions['content'], slim=slim)
         
-        analysis_id = datetime.now().strftime('%Y%m%d%H%M%S')
+        results = analyze_pairs(
+            desired_tm=data['desired_trademark'],
+            existing_trademarks=data['existing_trademarks'],
+            instructions=instructions['content'],
+            triage=data.get('triage')
+        )
         
-        analysis_storage[analysis_id] = {
-            'desired_trademark': data['desired_trademark'],
-            'results': results,
-            'overall_chance': overall_chance,
-            'analysis_date': datetime.now().isoformat()
-        }
+        analysis_id, record = save_analysis(data['desired_trademark'], results)
         
         print(f"✅ Analysis complete, ID: {analysis_id}")
         
-        return jsonify({
+        response = {
             'analysis_id': analysis_id,
-            'desired_trademark': data['desired_trademark'],
-            'results': results,
-            'overall_chance': overall_chance,
-            'analysis_date': datetime.now().isoformat()
-        })
+            'desired_trademark': record['desired_trademark'],
+            'results': record['results'],
+            'overall_chance': record['overall_chance'],
+            'analysis_date': record['analysis_date'],
+            'cache_hits': record['cache_hits']
+        }
+        if slim:
+            # Бажану ТМ та зображення клієнт уже має - не повертаємо їх
+            del response['desired_trademark']
+            response['results'] = [slim_result(result) for result in results]
+        return jsonify(response)
     except Exception as e:
         print(f"❌ Error: {e}")
         import traceback
         print(traceback.format_exc())
         return jsonify({'error': str(e)}), 500
 
+def read_analysis_request():
+    """Дані аналізу з JSON або multipart/form-data.
+    
+    Multipart: поле payload - JSON без зображень, файли desired_image та existing_image_<i>
+    (i - індекс у existing_trademarks). Великі файли werkzeug тримає у тимчасових файлах.
+    """
+    multipart = request.mimetype == 'multipart/form-data'
+    if multipart:
+        data = json.loads(request.form.get('payload') or '{}')
+    else:
+        data = request.get_json(silent=True) or {}
+    desired_trademark = data.setdefault('desired_trademark', {})
+    
+    # Посилання на вже збережені зображення (/api/images/<hash>) перетворюємо назад на дані
+    for trademark in [desired_trademark] + list(data.get('existing_trademarks') or []):
+        if trademark.get('image'):
+            trademark['image'] = resolve_image_ref(trademark['image'])
+    
+    if multipart:
+        upload = request.files.get('desired_image')
+        if upload:
+            desired_trademark['image'] = normalize_image_upload(upload)
+        
+        for index, trademark in enumerate(data.get('existing_trademarks') or []):
+            upload = request.files.get(f'existing_image_{index}')
+            if upload:
+                trademark['image'] = normalize_image_upload(upload)
+    
+    return data
+
+def wants_slim():
+    """Чи просить клієнт скорочену відповідь (?profile=slim або Accept: application/json; profile=slim)"""
+    if request.args.get('profile', '').lower() == 'slim':
+        return True
+    return 'profile=slim' in request.headers.get('Accept', '').replace(' ', '').lower()
+
+def slim_result(result):
+    """Результат пари без зображення зареєстрованої ТМ"""
+    if not result or not result.get('trademark_info', {}).get('image'):
+        return result
+    trademark_info = {key: value for key, value in result['trademark_info'].items() if key != 'image'}
+    return dict(result, trademark_info=trademark_info)
+
+def wants_stream():
+    """Чи просить клієнт потокову відповідь (?stream=1 або Accept: application/x-ndjson)"""
+    if request.args.get('stream', '').lower() in ('1', 'true', 'yes'):
+        return True
+    return 'application/x-ndjson' in request.headers.get('Accept', '')
+
+def stream_analysis(data, instructions, slim=False):
+    """Надсилає результати пар у форматі NDJSON по мірі їх готовності"""
+    desired_trademark = data['desired_trademark']
+    existing_trademarks = data['existing_trademarks']
+    
+    def event(payload):
+        return json.dumps(payload, ensure_ascii=False) + '\n'
+    
+    def generate():
+        yield event({'type': 'start', 'pairs_total': len(existing_trademarks)})
+        
+        results = [None] * len(existing_trademarks)
+        try:
+            for done, (index, result) in enumerate(iter_pair_analyses(
+                desired_tm=desired_trademark,
+                existing_trademarks=existing_trademarks,
+                instructions=instructions,
+                triage=data.get('triage')
+            ), 1):
+                results[index] = result
+                yield event({
+                    'type': 'result',
+                    'index': index,
+                    'pairs_done': done,
+                    'pairs_total': len(existing_trademarks),
+                    'result': slim_result(result) if slim else result
+                })
+            
+            analysis_id, record = save_analysis(desired_trademark, results)
+            print(f"✅ Streamed analysis complete, ID: {analysis_id}")
+            
+            yield event({
+                'type': 'summary',
+                'analysis_id': analysis_id,
+                'overall_chance': record['overall_chance'],
+                'analysis_date': record['analysis_date'],
+                'cache_hits': record['cache_hits']
+            })
+        except Exception as e:
+            print(f"❌ Stream error: {e}")
+            import traceback
+            print(traceback.format_exc())
+            yield event({'type': 'error', 'error': str(e)})
+        finally:
+            gc.collect()
+    
+    response = Response(stream_with_context(generate()), mimetype='application/x-ndjson')
+    # Вимикаємо буферизацію проксі, щоб події доходили одразу
+    response.headers['Cache-Control'] = 'no-cache'
+    response.headers['X-Accel-Buffering'] = 'no'
+    return response
+
+def save_analysis(desired_trademark, results, analysis_id=None):
+    """Розраховує загальний шанс та зберігає аналіз для подальшого експорту"""
+    if analysis_id is None:
+        analysis_id = new_analysis_id()
+    
+    if desired_trademark.get('image'):
+        desired_trademark = dict(desired_trademark, image=store_image_ref(desired_trademark['image']))
+    
+    record = {
+        'desired_trademark': desired_trademark,
+        'results': results,
+        'overall_chance': calculate_registration_chance(results),
+        'analysis_date': datetime.now().isoformat(),
+        'cache_hits': sum(1 for result in results if result.get('cache_hit'))
+    }
+    analysis_storage.put(analysis_id, record)
+    image_blobs.prune()
+    if EXPORT_PRERENDER_ENABLED:
+        export_executor.submit(prerender_exports, analysis_id, record)
+    return analysis_id, record
+
+def create_job(pairs_total, **fields):
+    """Реєструє нову задачу аналізу та повертає її ідентифікатор"""
+    job_id = uuid.uuid4().hex
+    with jobs_lock:
+        analysis_jobs[job_id] = {
+            'job_id': job_id,
+            'status': 'queued',
+            'pairs_total': pairs_total,
+            'pairs_done': 0,
+            'results': [None] * pairs_total,
+            'overall_chance': None,
+            'analysis_id': None,
+            'analysis_date': None,
+            'cache_hits': 0,
+            'error': None,
+            'created': datetime.now().isoformat(),
+            'started': None,
+            'finished': None,
+            **fields
+        }
+    publish_job(job_id, force=True)
+    start_job_heartbeat()
+    return job_id
+
+def start_job_heartbeat():
+    """Запускає (один раз на процес) потік, що періодично публікує активні задачі"""
+    global job_heartbeat_thread
+    with jobs_lock:
+        if job_heartbeat_thread is not None:
+            return
+        job_heartbeat_thread = threading.Thread(target=job_heartbeat, daemon=True, name='job-heartbeat')
+    job_heartbeat_thread.start()
+
+def job_heartbeat():
+    while True:
+        time.sleep(JOB_HEARTBEAT_INTERVAL)
+        with jobs_lock:
+            active = [job_id for job_id, job in analysis_jobs.items() if job['status'] in ('queued', 'running')]
+        for job_id in active:
+            publish_job(job_id, force=True, active_only=True)
+
+def publish_job(job_id, force=False, active_only=False):
+    """Зберігає знімок задачі у спільне сховище (не частіше JOB_PUBLISH_INTERVAL, якщо не force)"""
+    # Знімок і запис - під одним блокуванням: старіший знімок не може перезаписати новіший
+    with job_publish_lock:
+        now = time.time()
+        with jobs_lock:
+            job = analysis_jobs.get(job_id)
+            if job is None or (not force and now - job_published.get(job_id, 0) < JOB_PUBLISH_INTERVAL):
+                return
+            # Heartbeat не чіпає завершених задач - їх фінальний знімок публікує execute_job
+            if active_only and job['status'] not in ('queued', 'running'):
+                return
+            job_published[job_id] = now
+            snapshot = dict(job, results=list(job['results']), updated=datetime.fromtimestamp(now).isoformat())
+        
+        try:
+            job_store.save(job_id, json.dumps(snapshot, ensure_ascii=False).encode('utf-8'), now)
+        except Exception as e:
+            print(f"⚠️ Помилка збереження стану задачі {job_id}: {e}")
+
+def execute_job(job_id, work, *args):
+    """Виконує задачу у фоновому потоці, оновлюючи її статус"""
+    with jobs_lock:
+        job = analysis_jobs[job_id]
+        job['status'] = 'running'
+        job['started'] = datetime.now().isoformat()
+    publish_job(job_id, force=True)
+    
+    try:
+        work(job, *args)
+        print(f"✅ Задача {job_id} завершена")
+    except Exception as e:
+        print(f"❌ Помилка задачі {job_id}: {e}")
+        import traceback
+        print(traceback.format_exc())
+        with jobs_lock:
+            job['status'] = 'failed'
+            job['error'] = str(e)
+            job['finished'] = datetime.now().isoformat()
+    finally:
+        publish_job(job_id, force=True)
+        gc.collect()
+
+def run_job_pairs(job, desired_trademark, existing_trademarks, triage=None):
+    """Аналізує пари задачі та зберігає завершений аналіз"""
+    instructions = instruction_manager.get_instructions()
+    
+    for index, result in iter_pair_analyses(
+        desired_tm=desired_trademark,
+        existing_trademarks=existing_trademarks,
+        instructions=instructions['content'],
+        triage=triage
+    ):
+        with jobs_lock:
+            job['results'][index] = result
+            job['pairs_done'] += 1
+        publish_job(job['job_id'])
+    
+    # Ідентифікатор задачі використовується як ID аналізу для експорту
+    analysis_id, record = save_analysis(desired_trademark, job['results'], analysis_id=job['job_id'])
+    
+    with jobs_lock:
+        job['status'] = 'completed'
+        job['analysis_id'] = analysis_id
+        job['overall_chance'] = record['overall_chance']
+        job['analysis_date'] = record['analysis_date']
+        job['cache_hits'] = record['cache_hits']
+        job['finished'] = datetime.now().isoformat()
+
+def run_analysis_job(job, data):
+    run_job_pairs(job, data['desired_trademark'], data['existing_trademarks'], data.get('triage'))
+
+def screen_registry(desired_tm, records, shortlist_size, min_score, on_progress=None):
+    """Потоково відбирає з реєстру top-N кандидатів за локальною оцінкою (пам'ять O(N))"""
+    heap = []
+    scanned = 0
+    
+    for scanned, record in enumerate(records, 1):
+        trademark = registry_record_to_trademark(record)
+        score, prescreen, shared = score_registry_candidate(desired_tm, trademark)
+        if score >= min_score:
+            item = (score, -scanned, dict(trademark, search_score=prescreen['score'], prescreen=prescreen, shared_classes=shared))
+            if len(heap) < shortlist_size:
+                heapq.heappush(heap, item)
+            elif item[:2] > heap[0][:2]:
+                heapq.heapreplace(heap, item)
+        
+        if on_progress and scanned % 1000 == 0:
+            on_progress(scanned, len(heap))
+    
+    if on_progress:
+        on_progress(scanned, len(heap))
+    
+    return [item[2] for item in sorted(heap, key=lambda item: item[:2], reverse=True)]
+
+def run_bulk_job(job, desired_trademark, registry_path, shortlist_size, min_score, remove_file):
+    """Скринінг усього реєстру, а потім детальний аналіз лише відібраних кандидатів"""
+    started = time.time()
+    
+    def on_progress(scanned, kept):
+        elapsed = time.time() - started
+        with jobs_lock:
+            job['entries_scanned'] = scanned
+            job['candidates_kept'] = kept
+            job['entries_per_second'] = round(scanned / elapsed) if elapsed > 0 else None
+        publish_job(job['job_id'])
+    
+    try:
+        shortlist = screen_registry(
+            desired_trademark, iter_registry_records(registry_path), shortlist_size, min_score, on_progress
+        )
+    finally:
+        if remove_file and os.path.exists(registry_path):
+            os.remove(registry_path)
+    
+    with jobs_lock:
+        job['phase'] = 'analyzing'
+        job['screening_seconds'] = round(time.time() - started, 2)
+        job['pairs_total'] = len(shortlist)
+        job['results'] = [None] * len(shortlist)
+    publish_job(job['job_id'], force=True)
+    print(f"🧮 Скринінг: {job['entries_scanned']} записів за {job['screening_seconds']} с, відібрано {len(shortlist)}")
+    
+    # Кандидати вже відібрані локально, тому повторний скринінг не потрібен
+    run_job_pairs(job, desired_trademark, shortlist, triage=False)
+    
+    with jobs_lock:
+        job['phase'] = 'completed'
+
+def cleanup_jobs():
+    """Видаляє завершені задачі, старші за JOB_RETENTION_HOURS"""
+    threshold = (datetime.now() - timedelta(hours=JOB_RETENTION_HOURS)).isoformat()
+    with jobs_lock:
+        expired = [
+            job_id for job_id, job in analysis_jobs.items()
+            if job.get('finished') and job['finished'] < threshold
+        ]
+        for job_id in expired:
+            del analysis_jobs[job_id]
+            job_published.pop(job_id, None)
+    try:
+        job_store.prune(time.time() - JOB_RETENTION_HOURS * 3600)
+    except Exception as e:
+        print(f"⚠️ Помилка очищення задач: {e}")
+    if expired:
+        print(f"🧹 Видалено застарілих задач: {len(expired)}")
+
+@app.route('/api/jobs', methods=['POST', 'OPTIONS'])
+def submit_analysis_job():
+    if request.method == 'OPTIONS':
+        return jsonify({'status': 'ok'}), 200
+    
+    try:
+        data = read_analysis_request()
+    except json.JSONDecodeError:
+        return jsonify({'error': 'payload має бути JSON'}), 400
+    if not data.get('desired_trademark') or not isinstance(data.get('existing_trademarks'), list):
+        return jsonify({'error': 'Потрібні поля desired_trademark та existing_trademarks'}), 400
+    
+    cleanup_jobs()
+    
+    job_id = create_job(len(data['existing_trademarks']))
+    job_executor.submit(execute_job, job_id, run_analysis_job, data)
+    print(f"📥 Задача {job_id} поставлена в чергу ({len(data['existing_trademarks'])} ТМ)")
+    
+    return jsonify({
+        'job_id': job_id,
+        'status': 'queued',
+        'pairs_total': len(data['existing_trademarks'])
+    }), 202
+
+@app.route('/api/bulk', methods=['POST', 'OPTIONS'])
+def submit_bulk_job():
+    if request.method == 'OPTIONS':
+        return jsonify({'status': 'ok'}), 200
+    
+    # Multipart: файл реєстру + desired_trademark як JSON-рядок; або JSON з use_registry
+    if request.files.get('registry'):
+        params = request.form
+        try:
+            desired_trademark = json.loads(params.get('desired_trademark') or '{}')
+        except json.JSONDecodeError:
+            return jsonify({'error': 'desired_trademark має бути JSON'}), 400
+    else:
+        params = request.get_json(silent=True) or {}
+        desired_trademark = params.get('desired_trademark') or {}
+    
+    if not desired_trademark.get('name'):
+        return jsonify({'error': 'Потрібна назва бажаної ТМ (desired_trademark.name)'}), 400
+    
+    try:
+        shortlist_size = min(max(int(params.get('shortlist_size', BULK_SHORTLIST_SIZE)), 1), BULK_MAX_SHORTLIST)
+        min_score = float(params.get('min_score', TRIAGE_THRESHOLD))
+    except (TypeError, ValueError):
+        return jsonify({'error': 'Неправильні shortlist_size або min_score'}), 400
+    
+    cleanup_jobs()
+    
+    upload = request.files.get('registry')
+    if upload:
+        extension = '.jsonl' if (upload.filename or '').lower().endswith(('.jsonl', '.json')) else '.csv'
+        fd, registry_path = tempfile.mkstemp(suffix=extension, dir=BULK_UPLOAD_DIR)
+        os.close(fd)
+        upload.save(registry_path)
+        remove_file = True
+    elif str(params.get('use_registry', '')).lower() in ('1', 'true', 'yes') and trademark_registry.path:
+        registry_path = trademark_registry.path
+        remove_file = False
+    else:
+        return jsonify({'error': 'Завантажте файл registry або вкажіть use_registry для налаштованого реєстру'}), 400
+    
+    job_id = create_job(
+        0,
+        mode='bulk',
+        phase='screening',
+        entries_scanned=0,
+        candidates_kept=0,
+        entries_per_second=None,
+        screening_seconds=None,
+        shortlist_size=shortlist_size,
+        min_score=min_score
+    )
+    job_executor.submit(
+        execute_job, job_id, run_bulk_job,
+        desired_trademark, registry_path, shortlist_size, min_score, remove_file
+    )
+    print(f"📥 Масова перевірка {job_id} поставлена в чергу")
+    
+    return jsonify({'job_id': job_id, 'status': 'queued', 'mode': 'bulk'}), 202
+
+@app.route('/api/jobs/<job_id>')
+def get_analysis_job(job_id):
+    with jobs_lock:
+        job = analysis_jobs.get(job_id)
+        # Знімок стану, щоб не тримати блокування під час серіалізації
+        snapshot = dict(job, results=list(job['results'])) if job is not None else None
+    
+    if snapshot is None:
+        # Задача іншого воркера - беремо її останній знімок зі спільного сховища
+        try:
+            stored = job_store.load(job_id, created_after=time.time() - JOB_RETENTION_HOURS * 3600)
+        except Exception as e:
+            print(f"⚠️ Помилка читання задачі {job_id}: {e}")
+            stored = None
+        if stored is None:
+            return jsonify({'error': 'Задачу не знайдено'}), 404
+        snapshot = json.loads(stored[0])
+        # Воркер, що виконував задачу, зупинився (перезапуск gunicorn) - знімок більше не оновлюється
+        if snapshot['status'] in ('queued', 'running') and time.time() - stored[1] > JOB_STALE_AFTER:
+            snapshot['status'] = 'failed'
+            snapshot['error'] = 'Воркер перезапущено, задачу перервано. Запустіть аналіз повторно.'
+    
+    if wants_slim():
+        snapshot['results'] = [slim_result(result) for result in snapshot['results']]
+    return jsonify(snapshot)
+
+@app.route('/api/search')
+def search_registry():
+    name = request.args.get('name', '').strip()
+    if not name:
+        return jsonify({'error': 'Потрібен параметр name'}), 400
+    if not trademark_registry.path:
+        return jsonify({'error': 'Реєстр не налаштовано (REGISTRY_PATH)'}), 503
+    
+    trademark_registry.ensure_loaded()
+    if trademark_registry.load_error:
+        return jsonify({'error': f'Реєстр недоступний: {trademark_registry.load_error}'}), 503
+    
+    try:
+        top_k = min(max(int(request.args.get('limit', 20)), 1), 200)
+    except ValueError:
+        top_k = 20
+    
+    started = time.time()
+    results = trademark_registry.search(
+        name,
+        classes=request.args.get('classes'),
+        top_k=top_k,
+        same_class_only=request.args.get('same_class_only', '').lower() in ('1', 'true', 'yes')
+    )
+    
+    return jsonify({
+        'query': name,
+        'registry_size': len(trademark_registry.entries),
+        'took_ms': round((time.time() - started) * 1000, 2),
+        # Формат existing_trademarks, можна одразу передати в /api/analyze
+        'existing_trademarks': results
+    })
+
+@app.route('/api/images/<digest>')
+def get_image(digest):
+    data = image_blobs.get(digest)
+    if data is None:
+        return jsonify({'error': 'Зображення не знайдено'}), 404
+    # Вміст адресується хешем, тому відповідь незмінна
+    response = Response(data, mimetype=image_mime(data))
+    response.headers['Cache-Control'] = 'public, max-age=31536000, immutable'
+    response.set_etag(digest)
+    return response.make_conditional(request)
+
+# Шрифти для PDF: DejaVu з репозиторію (fonts/) або системних каталогів, без мережі
+PDF_FONT_DIRS = [
+    path for path in [
+        os.getenv('PDF_FONT_DIR'),
+        os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fonts'),
+        '/usr/share/fonts/truetype/dejavu',
+        '/usr/share/fonts/dejavu',
+        '/usr/share/fonts/TTF',
+        '/usr/share/fonts',
+        '/usr/local/share/fonts',
+        '/Library/Fonts',
+        os.path.expanduser('~/.fonts')
+    ] if path
+]
+
+class PDFFontManager:
+    """Знаходить шрифти з кирилицею локально та реєструє їх у reportlab один раз на процес"""
+    
+    FONT_FILES = {'regular': 'DejaVuSans.ttf', 'bold': 'DejaVuSans-Bold.ttf'}
+    
+    def __init__(self, search_dirs):
+        self.search_dirs = search_dirs
+        self.regular = 'Helvetica'
+        self.bold = 'Helvetica-Bold'
+        self.paths = {}
+        self.unicode = False
+    
+    def find(self, filename):
+        for directory in self.search_dirs:
+            if not os.path.isdir(directory):
+                continue
+            direct = os.path.join(directory, filename)
+            if os.path.isfile(direct):
+                return direct
+            for root, _, files in os.walk(directory):
+                if filename in files:
+                    return os.path.join(root, filename)
+        return None
+    
+    def register(self):
+        paths = {style: self.find(filename) for style, filename in self.FONT_FILES.items()}
+        if not all(paths.values()):
+            print(f"⚠️ Шрифти DejaVu не знайдено в {', '.join(self.search_dirs)}: PDF з транслітерацією (Helvetica)")
+            return self
+        try:
+            pdfmetrics.registerFont(TTFont('DejaVu', paths['regular']))
+            pdfmetrics.registerFont(TTFont('DejaVu-Bold', paths['bold']))
+            # Щоб <b> у Paragraph перемикав на жирний DejaVu
+            addMapping('DejaVu', 0, 0, 'DejaVu')
+            addMapping('DejaVu', 1, 0, 'DejaVu-Bold')
+            addMapping('DejaVu', 0, 1, 'DejaVu')
+            addMapping('DejaVu', 1, 1, 'DejaVu-Bold')
+        except Exception as e:
+            print(f"⚠️ Не вдалося зареєструвати DejaVu: {e}")
+            return self
+        self.regular, self.bold, self.paths, self.unicode = 'DejaVu', 'DejaVu-Bold', paths, True
+        print(f"🔤 PDF шрифти: {paths['regular']}, {paths['bold']}")
+        return self
+    
+    def text(self, value):
+        """Текст для PDF: кирилиця як є, якщо шрифт її підтримує, інакше транслітерація"""
+        return value if self.unicode else translit(value)
+    
+    def status(self):
+        return {
+            'regular': self.regular,
+            'bold': self.bold,
+            'unicode': self.unicode,
+            'paths': self.paths,
+            'search_dirs': self.search_dirs
+        }
+
+pdf_fonts = PDFFontManager(PDF_FONT_DIRS).register()
+
+@app.route('/api/fonts')
+def get_pdf_fonts():
+    return jsonify(pdf_fonts.status())
+
+# Версія шаблонів звітів: змініть при зміні вигляду звітів, щоб не віддавати старі файли з кешу
+EXPORT_TEMPLATE_VERSION = 4
+EXPORT_PRERENDER_ENABLED = os.getenv('EXPORT_PRERENDER_ENABLED', '0') == '1'
+EXPORT_CACHE_MAX_AGE = int(os.getenv('EXPORT_CACHE_MAX_AGE', '3600'))
+# ZIP-архів більший за цей розмір збирається на диску, а не в пам'яті
+EXPORT_BUNDLE_SPOOL_BYTES = int(os.getenv('EXPORT_BUNDLE_SPOOL_MB', '8')) * 1024 * 1024
+
+class ExportCache:
+    """Готові файли звітів у DATA_DIR/exports, спільні для воркерів"""
+    
+    def __init__(self, root, retention_hours=168):
+        self.root = root
+        self.retention_seconds = retention_hours * 3600
+        self._last_prune = 0
+        os.makedirs(root, exist_ok=True)
+    
+    def path(self, analysis_id, format):
+        return os.path.join(self.root, f"{export_etag(analysis_id, format)}.{format}")
+    
+    def get(self, analysis_id, format):
+        """Шлях до готового звіту або None"""
+        path = self.path(analysis_id, format)
+        return path if os.path.exists(path) else None
+    
+    def store(self, analysis_id, format, rendered_path):
+        """Переносить сформований файл у кеш (атомарно, в межах одного диска)"""
+        path = self.path(analysis_id, format)
+        os.replace(rendered_path, path)
+        now = time.time()
+        if now - self._last_prune >= IMAGE_BLOB_PRUNE_INTERVAL:
+            self._last_prune = now
+            prune_directory(self.root, self.retention_seconds)
+        return path
+
+export_cache = ExportCache(
+    os.path.join(DATA_DIR, 'exports'),
+    retention_hours=float(os.getenv('ANALYSIS_RETENTION_HOURS', '168'))
+)
+export_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='export')
+
+def export_etag(analysis_id, format):
+    # Збережений аналіз не змінюється, тому ETag не залежить від вмісту файлу
+    key = f"{analysis_id}:{format}:{EXPORT_TEMPLATE_VERSION}:{pdf_fonts.regular}"
+    return hashlib.sha256(key.encode('utf-8')).hexdigest()[:32]
+
+# Зображення у звітах зменшуємо до розміру друку, а не вбудовуємо оригінали
+EXPORT_PRINT_DPI = int(os.getenv('EXPORT_PRINT_DPI', '150'))
+
+def print_image_file(image, width_inches, work_dir):
+    """Зберігає зображення у work_dir у розмірі друку (width_inches при EXPORT_PRINT_DPI); повертає шлях"""
+    img = Image.open(io.BytesIO(load_image_bytes(image)))
+    max_pixels = max(1, int(width_inches * EXPORT_PRINT_DPI))
+    if img.format == 'JPEG':
+        img.draft('RGB', (max_pixels, max_pixels))
+    if img.mode in ('RGBA', 'LA', 'P', 'PA'):
+        img = img.convert('RGBA')
+        background = Image.new('RGB', img.size, (255, 255, 255))
+        background.paste(img, mask=img.split()[-1])
+        img = background
+    elif img.mode not in ('RGB', 'L'):
+        img = img.convert('RGB')
+    img.thumbnail((max_pixels, max_pixels), Image.Resampling.LANCZOS)
+    
+    fd, path = tempfile.mkstemp(suffix='.jpg', dir=work_dir)
+    with os.fdopen(fd, 'wb') as f:
+        img.save(f, format='JPEG', quality=80, optimize=True)
+    return path
+
+def render_exports(analysis_id, formats, analysis_data=None):
+    """Повертає {формат: шлях} з кешу; відсутні формати формує з однієї моделі звіту. None - якщо аналіз не знайдено"""
+    paths = {format: export_cache.get(analysis_id, format) for format in formats}
+    missing = [format for format, path in paths.items() if path is None]
+    if not missing:
+        return paths
+    
+    if analysis_data is None:
+        analysis_data = analysis_storage.get(analysis_id)
+        if analysis_data is None:
+            return None
+    
+    # Верстка звітів - CPU-робота, тому виконується в пулі процесів
+    started = time.time()
+    paths.update(export_pool.run(write_report_files, analysis_id, missing, analysis_data, timeout=EXPORT_TASK_TIMEOUT))
+    print(f"📄 Звіти {', '.join(format.upper() for format in missing)} для {analysis_id} сформовано за {time.time() - started:.2f} с")
+    return paths
+
+def write_report_files(analysis_id, formats, analysis_data):
+    """Формує звіти у кеш з однієї моделі; повертає {формат: шлях}"""
+    # Модель (і зменшені зображення) будуються один раз для всіх форматів; звіти пишемо одразу у файли
+    paths = {}
+    with tempfile.TemporaryDirectory(dir=export_cache.root) as work_dir:
+        model = build_report_model(analysis_data, analysis_id, work_dir)
+        for format in formats:
+            output_path = os.path.join(work_dir, f'report.{format}')
+            EXPORT_FORMATS[format]['emit'](model, output_path)
+            paths[format] = export_cache.store(analysis_id, format, output_path)
+    return paths
+
+def render_export(analysis_id, format, analysis_data=None):
+    """Повертає шлях до звіту з кешу або формує його; None - якщо аналіз не знайдено"""
+    paths = render_exports(analysis_id, [format], analysis_data)
+    return paths[format] if paths is not None else None
+
+def prerender_exports(analysis_id, record):
+    """Формує звіти у фоні одразу після завершення аналізу"""
+    try:
+        render_exports(analysis_id, list(EXPORT_FORMATS), record)
+    except Exception as e:
+        print(f"⚠️ Помилка попереднього формування звітів для {analysis_id}: {e}")
+
+def export_available(analysis_id, formats):
+    """Чи можна віддати звіт: він уже в кеші або аналіз є у сховищі"""
+    if all(export_cache.get(analysis_id, format) for format in formats):
+        return True
+    return analysis_storage.get(analysis_id) is not None
+
 @app.route('/api/export/<format>/<analysis_id>')
 def export_report(format, analysis_id):
-    if analysis_id not in analysis_storage:
+    if format not in EXPORT_FORMATS:
+        return jsonify({'error': 'Невідомий формат'}), 400
+    
+    etag = export_etag(analysis_id, format)
+    if request.if_none_match.contains(etag) and export_available(analysis_id, [format]):
+        return Response(status=304, headers={'ETag': f'"{etag}"'})
+    
+    try:
+        path = render_export(analysis_id, format)
+    except CPUTaskError as e:
+        print(f"⚠️ Звіт для {analysis_id} не сформовано: {e}")
+        return jsonify({'error': 'Сервер перевантажений, спробуйте пізніше'}), 503, {'Retry-After': '10'}
+    if path is None:
         return jsonify({'error': 'Аналіз не знайдено'}), 404
     
-    analysis_data = analysis_storage[analysis_id]
+    # Файл віддається потоком з диска, без читання в пам'ять
+    export_format = EXPORT_FORMATS[format]
+    response = send_file(
+        path,
+        mimetype=export_format['mimetype'],
+        as_attachment=True,
+        download_name=export_format['download_name'].format(analysis_id=analysis_id),
+        etag=etag,
+        max_age=EXPORT_CACHE_MAX_AGE
+    )
+    response.headers['Cache-Control'] = f'private, max-age={EXPORT_CACHE_MAX_AGE}'
+    return response
+
+@app.route('/api/export/bundle/<analysis_id>')
+def export_bundle(analysis_id):
+    """ZIP з кількома форматами звіту за один прохід: ?formats=docx,pdf,json,csv"""
+    formats = [f.strip().lower() for f in request.args.get('formats', 'docx,pdf').split(',') if f.strip()]
+    formats = list(dict.fromkeys(formats))
+    unknown = [f for f in formats if f not in EXPORT_FORMATS]
+    if not formats or unknown:
+        return jsonify({'error': f"Невідомий формат: {', '.join(unknown) or '-'}"}), 400
+    
+    etag = hashlib.sha256(':'.join(export_etag(analysis_id, f) for f in formats).encode('utf-8')).hexdigest()[:32]
+    if request.if_none_match.contains(etag) and export_available(analysis_id, formats):
+        return Response(status=304, headers={'ETag': f'"{etag}"'})
     
-    if format == 'docx':
-        return export_docx(analysis_data, analysis_id)
-    elif format == 'pdf':
-        return export_pdf(analysis_data, analysis_id)
-    else:
-        return jsonify({'error': 'Невідомий формат'}), 400
+    try:
+        paths = render_exports(analysis_id, formats)
+    except CPUTaskError as e:
+        print(f"⚠️ Звіт для {analysis_id} не сформовано: {e}")
+        return jsonify({'error': 'Сервер перевантажений, спробуйте пізніше'}), 503, {'Retry-After': '10'}
+    if paths is None:
+        return jsonify({'error': 'Аналіз не знайдено'}), 404
+    
+    # Архів збирається з готових файлів кешу; великий - скидається на диск
+    bundle = tempfile.SpooledTemporaryFile(max_size=EXPORT_BUNDLE_SPOOL_BYTES, dir=export_cache.root)
+    with zipfile.ZipFile(bundle, 'w', compression=zipfile.ZIP_DEFLATED) as archive:
+        for format in formats:
+            archive.write(paths[format], EXPORT_FORMATS[format]['download_name'].format(analysis_id=analysis_id))
+    bundle.seek(0)
+    
+    response = send_file(
+        bundle,
+        mimetype='application/zip',
+        as_attachment=True,
+        download_name=f'Analiz_TM_{analysis_id}.zip',
+        etag=etag,
+        max_age=EXPORT_CACHE_MAX_AGE
+    )
+    response.headers['Cache-Control'] = f'private, max-age={EXPORT_CACHE_MAX_AGE}'
+    return response
+
+# Спільна модель звіту: дані, оцінки та кольори рахуються один раз для всіх форматів
+REPORT_TITLE = 'ЗВІТ ПРО АНАЛІЗ ТОРГОВЕЛЬНОЇ МАРКИ'
+REPORT_SECTIONS = {
+    'desired': '1. БАЖАНА ДЛЯ РЕЄСТРАЦІЇ ТОРГОВЕЛЬНА МАРКА',
+    'results': '2. РЕЗУЛЬТАТИ ПОРІВНЯННЯ З ЗАРЕЄСТРОВАНИМИ ТМ',
+    'conclusion': '3. ЗАГАЛЬНИЙ ВИСНОВОК'
+}
+REPORT_SIMILARITY_LABELS = [
+    ('phonetic', 'Фонетична схожість'),
+    ('graphic', 'Графічна схожість'),
+    ('semantic', 'Семантична схожість'),
+    ('visual', 'Візуальна схожість')
+]
+REPORT_COLORS = {'good': '#388e3c', 'warning': '#f57c00', 'danger': '#d32f2f'}
+REPORT_VERDICTS = {
+    'good': 'Висока ймовірність успішної реєстрації.',
+    'warning': 'Середня ймовірність реєстрації. Рекомендується детальніше вивчити конфліктні ТМ.',
+    'danger': 'Низька ймовірність реєстрації. Рекомендується внести зміни до торговельної марки.'
+}
+REPORT_CSV_COLUMNS = [
+    'index', 'application_number', 'name', 'owner', 'classes', 'overall_risk', 'confusion_likelihood',
+    'phonetic', 'graphic', 'semantic', 'visual', 'recommendations'
+]
+
+def risk_level(risk):
+    return 'danger' if risk > 60 else 'warning' if risk > 30 else 'good'
+
+def chance_level(chance):
+    return 'good' if chance > 70 else 'warning' if chance > 40 else 'danger'
+
+def build_report_model(analysis_data, analysis_id, work_dir):
+    """Будує модель звіту; кожне зображення декодується й зменшується до розміру друку один раз"""
+    print_images = {}
+    
+    def report_image(image, width_inches):
+        if not image:
+            return {'image': None, 'image_ref': None, 'image_error': False}
+        if image not in print_images:
+            try:
+                print_images[image] = print_image_file(image, width_inches, work_dir)
+            except Exception as e:
+                print(f"⚠️ Зображення для звіту не вдалося підготувати: {e}")
+                print_images[image] = None
+        return {
+            'image': print_images[image],
+            'image_ref': image if image.startswith(IMAGE_URL_PREFIX) else None,
+            'image_error': print_images[image] is None
+        }
+    
+    desired = analysis_data['desired_trademark']
+    marks = []
+    for index, result in enumerate(analysis_data['results'], 1):
+        tm_info = result['trademark_info']
+        similarity = result.get('similarity_analysis') or {}
+        risk = result.get('overall_risk', 0)
+        marks.append({
+            'index': index,
+            'application_number': tm_info.get('application_number') or index,
+            'owner': tm_info.get('owner', ''),
+            'name': tm_info.get('name', ''),
+            'classes': tm_info.get('classes', ''),
+            **report_image(tm_info.get('image'), 2),
+            'overall_risk': risk,
+            'risk_level': risk_level(risk),
+            'confusion_likelihood': result.get('confusion_likelihood', ''),
+            'similarity': [
+                {
+                    'key': key,
+                    'label': label,
+                    'percentage': similarity[key].get('percentage', 0),
+                    'details': similarity[key].get('details', '')
+                }
+                for key, label in REPORT_SIMILARITY_LABELS if similarity.get(key)
+            ],
+            'recommendations': result.get('recommendations') or []
+        })
+    
+    chance = analysis_data['overall_chance']
+    level = chance_level(chance)
+    return {
+        'analysis_id': analysis_id,
+        'title': REPORT_TITLE,
+        'sections': REPORT_SECTIONS,
+        'generated': datetime.now().strftime('%d.%m.%Y %H:%M'),
+        'analysis_date': analysis_data.get('analysis_date'),
+        'desired': {
+            'name': desired.get('name', ''),
+            'description': desired.get('description', ''),
+            'classes': desired.get('classes', ''),
+            **report_image(desired.get('image'), 2.5)
+        },
+        'marks': marks,
+        'overall_chance': chance,
+        'chance_level': level,
+        'verdict': REPORT_VERDICTS[level]
+    }
 
-def export_docx(analysis_data, analysis_id):
+def emit_docx(model, output_path):
+    """DOCX-звіт з моделі"""
     doc = Document()
     
-    title = doc.add_heading('ЗВІТ ПРО АНАЛІЗ ТОРГОВЕЛЬНОЇ МАРКИ', 0)
+    title = doc.add_heading(model['title'], 0)
     title.alignment = WD_ALIGN_PARAGRAPH.CENTER
     
-    doc.add_paragraph(f"Дата аналізу: {datetime.now().strftime('%d.%m.%Y %H:%M')}")
+    doc.add_paragraph(f"Дата аналізу: {model['generated']}")
     doc.add_paragraph()
     
-    doc.add_heading('1. БАЖАНА ДЛЯ РЕЄСТРАЦІЇ ТОРГОВЕЛЬНА МАРКА', 1)
-    desired = analysis_data['desired_trademark']
+    doc.add_heading(model['sections']['desired'], 1)
+    desired = model['desired']
     
     doc.add_paragraph(f"Назва: {desired['name']}")
-    if desired.get('description'):
+    if desired['description']:
         doc.add_paragraph(f"Опис: {desired['description']}")
-    if desired.get('classes'):
+    if desired['classes']:
         doc.add_paragraph(f"Класи МКТП: {desired['classes']}")
     
-    if desired.get('image'):
-        try:
-            image_data = base64.b64decode(desired['image'].split(',')[1])
-            image_stream = io.BytesIO(image_data)
-            doc.add_picture(image_stream, width=Inches(2))
-        except:
-            doc.add_paragraph("Зображення не вдалося додати")
+    if desired['image']:
+        doc.add_picture(desired['image'], width=Inches(2))
+    elif desired['image_error']:
+        doc.add_paragraph("Зображення не вдалося додати")
     
     doc.add_page_break()
     
-    doc.add_heading('2. РЕЗУЛЬТАТИ ПОРІВНЯННЯ З ЗАРЕЄСТРОВАНИМИ ТМ', 1)
+    doc.add_heading(model['sections']['results'], 1)
     
-    for idx, result in enumerate(analysis_data['results'], 1):
-        tm_info = result['trademark_info']
+    for mark in model['marks']:
+        doc.add_heading(f"2.{mark['index']}. Торговельна марка №{mark['application_number']}", 2)
         
-        doc.add_heading(f'2.{idx}. Торговельна марка №{tm_info.get("application_number", idx)}', 2)
+        doc.add_paragraph(f"Власник: {mark['owner']}")
+        doc.add_paragraph(f"Назва: {mark['name']}")
+        doc.add_paragraph(f"Класи МКТП: {mark['classes']}")
         
-        doc.add_paragraph(f"Власник: {tm_info['owner']}")
-        doc.add_paragraph(f"Назва: {tm_info['name']}")
-        doc.add_paragraph(f"Класи МКТП: {tm_info['classes']}")
-        
-        if tm_info.get('image'):
-            try:
-                image_data = base64.b64decode(tm_info['image'].split(',')[1])
-                image_stream = io.BytesIO(image_data)
-                doc.add_picture(image_stream, width=Inches(2))
-            except:
-                doc.add_paragraph("Зображення не вдалося додати")
+        if mark['image']:
+            doc.add_picture(mark['image'], width=Inches(2))
+        elif mark['image_error']:
+            doc.add_paragraph("Зображення не вдалося додати")
         
         doc.add_paragraph()
         
         p = doc.add_paragraph()
-        p.add_run(f"РИЗИК ЗМІШУВАННЯ: {result['overall_risk']}%").bold = True
-        p.add_run(f" ({result['confusion_likelihood']})")
+        risk_run = p.add_run(f"РИЗИК ЗМІШУВАННЯ: {mark['overall_risk']}%")
+        risk_run.bold = True
+        risk_run.font.color.rgb = RGBColor.from_string(REPORT_COLORS[mark['risk_level']][1:])
+        p.add_run(f" ({mark['confusion_likelihood']})")
         
-        if result.get('similarity_analysis'):
+        if mark['similarity']:
             doc.add_paragraph()
             doc.add_paragraph("Детальний аналіз схожості:")
-            
-            if result['similarity_analysis'].get('phonetic'):
+            for section in mark['similarity']:
                 doc.add_paragraph(
-                    f"• Фонетична схожість: {result['similarity_analysis']['phonetic']['percentage']}% - "
-                    f"{result['similarity_analysis']['phonetic']['details']}",
-                    style='List Bullet'
-                )
-            
-            if result['similarity_analysis'].get('semantic'):
-                doc.add_paragraph(
-                    f"• Семантична схожість: {result['similarity_analysis']['semantic']['percentage']}% - "
-                    f"{result['similarity_analysis']['semantic']['details']}",
+                    f"{section['label']}: {section['percentage']}% - {section['details']}",
                     style='List Bullet'
                 )
         
-        if result.get('recommendations'):
+        if mark['recommendations']:
             doc.add_paragraph()
             doc.add_paragraph("Рекомендації:")
-            for rec in result['recommendations']:
+            for rec in mark['recommendations']:
                 doc.add_paragraph(rec, style='List Bullet')
         
         doc.add_paragraph()
@@ -656,63 +2896,24 @@ def export_docx(analysis_data, analysis_id):
         doc.add_paragraph()
     
     doc.add_page_break()
-    doc.add_heading('3. ЗАГАЛЬНИЙ ВИСНОВОК', 1)
+    doc.add_heading(model['sections']['conclusion'], 1)
     
     conclusion = doc.add_paragraph()
-    conclusion.add_run(
-        f"Шанс успішної реєстрації торговельної марки '{desired['name']}': "
-    )
-    chance_run = conclusion.add_run(f"{analysis_data['overall_chance']}%")
+    conclusion.add_run(f"Шанс успішної реєстрації торговельної марки '{desired['name']}': ")
+    chance_run = conclusion.add_run(f"{model['overall_chance']}%")
     chance_run.bold = True
     chance_run.font.size = Pt(16)
+    chance_run.font.color.rgb = RGBColor.from_string(REPORT_COLORS[model['chance_level']][1:])
+    doc.add_paragraph(model['verdict'])
     
-    if analysis_data['overall_chance'] > 70:
-        chance_run.font.color.rgb = RGBColor(0, 128, 0)
-        doc.add_paragraph("Висока ймовірність успішної реєстрації.")
-    elif analysis_data['overall_chance'] > 40:
-        chance_run.font.color.rgb = RGBColor(255, 165, 0)
-        doc.add_paragraph("Середня ймовірність реєстрації. Рекомендується детальніше вивчити конфліктні ТМ.")
-    else:
-        chance_run.font.color.rgb = RGBColor(255, 0, 0)
-        doc.add_paragraph("Низька ймовірність реєстрації. Рекомендується внести зміни до торговельної марки.")
-    
-    doc_io = io.BytesIO()
-    doc.save(doc_io)
-    doc_io.seek(0)
-    
-    return send_file(
-        doc_io,
-        mimetype='application/vnd.openxmlformats-officedocument.wordprocessingml.document',
-        as_attachment=True,
-        download_name=f'Аналіз_ТМ_{analysis_id}.docx'
-    )
+    doc.save(output_path)
 
-def export_pdf(analysis_data, analysis_id):
-    """Експорт у PDF без кирилиці (транслітерація)"""
-    buffer = io.BytesIO()
-    
-    # Функція транслітерації
-    def translit(text):
-        """Транслітерація українського тексту"""
-        ukr_to_lat = {
-            'А':'A', 'Б':'B', 'В':'V', 'Г':'H', 'Ґ':'G', 'Д':'D', 'Е':'E', 'Є':'Ye', 
-            'Ж':'Zh', 'З':'Z', 'И':'Y', 'І':'I', 'Ї':'Yi', 'Й':'Y', 'К':'K', 'Л':'L', 
-            'М':'M', 'Н':'N', 'О':'O', 'П':'P', 'Р':'R', 'С':'S', 'Т':'T', 'У':'U', 
-            'Ф':'F', 'Х':'Kh', 'Ц':'Ts', 'Ч':'Ch', 'Ш':'Sh', 'Щ':'Shch', 'Ь':'', 
-            'Ю':'Yu', 'Я':'Ya',
-            'а':'a', 'б':'b', 'в':'v', 'г':'h', 'ґ':'g', 'д':'d', 'е':'e', 'є':'ye',
-            'ж':'zh', 'з':'z', 'и':'y', 'і':'i', 'ї':'yi', 'й':'y', 'к':'k', 'л':'l',
-            'м':'m', 'н':'n', 'о':'o', 'п':'p', 'р':'r', 'с':'s', 'т':'t', 'у':'u',
-            'ф':'f', 'х':'kh', 'ц':'ts', 'ч':'ch', 'ш':'sh', 'щ':'shch', 'ь':'',
-            'ю':'yu', 'я':'ya', '₴':'UAH', '№':'#'
-        }
-        result = ''
-        for char in str(text):
-            result += ukr_to_lat.get(char, char)
-        return result
+def emit_pdf(model, output_path):
+    """PDF-звіт з моделі (кирилиця шрифтом DejaVu; без нього - транслітерація)"""
+    text = pdf_fonts.text
     
     doc = SimpleDocTemplate(
-        buffer,
+        output_path,
         pagesize=A4,
         topMargin=0.75*inch,
         bottomMargin=0.75*inch,
@@ -721,11 +2922,13 @@ def export_pdf(analysis_data, analysis_id):
     )
     story = []
     styles = getSampleStyleSheet()
+    styles['Normal'].fontName = pdf_fonts.regular
     
     # Стилі
     title_style = ParagraphStyle(
         'Title',
         parent=styles['Heading1'],
+        fontName=pdf_fonts.bold,
         fontSize=22,
         textColor=colors.HexColor('#1a237e'),
         alignment=TA_CENTER,
@@ -735,6 +2938,7 @@ def export_pdf(analysis_data, analysis_id):
     heading_style = ParagraphStyle(
         'Heading',
         parent=styles['Heading2'],
+        fontName=pdf_fonts.bold,
         fontSize=16,
         textColor=colors.HexColor('#0d47a1'),
         spaceAfter=12,
@@ -742,100 +2946,66 @@ def export_pdf(analysis_data, analysis_id):
     )
     
     # Заголовок
-    story.append(Paragraph(translit('ЗВІТ ПРО АНАЛІЗ ТОРГОВЕЛЬНОЇ МАРКИ'), title_style))
+    story.append(Paragraph(text(model['title']), title_style))
     story.append(Spacer(1, 0.2*inch))
-    story.append(Paragraph(f"Data: {datetime.now().strftime('%d.%m.%Y %H:%M')}", styles['Normal']))
+    story.append(Paragraph(f"{text('Дата')}: {model['generated']}", styles['Normal']))
     story.append(Spacer(1, 0.3*inch))
     story.append(Paragraph('='*60, styles['Normal']))
     story.append(Spacer(1, 0.3*inch))
     
     # Бажана ТМ
-    story.append(Paragraph(translit('1. БАЖАНА ТОРГОВЕЛЬНА МАРКА'), heading_style))
-    desired = analysis_data['desired_trademark']
+    story.append(Paragraph(text(model['sections']['desired']), heading_style))
+    desired = model['desired']
     
-    story.append(Paragraph(f"<b>Nazva:</b> {translit(desired['name'])}", styles['Normal']))
-    if desired.get('description'):
-        story.append(Paragraph(f"<b>Opys:</b> {translit(desired['description'])}", styles['Normal']))
-    if desired.get('classes'):
-        story.append(Paragraph(f"<b>Klasy MKTP:</b> {desired['classes']}", styles['Normal']))
+    story.append(Paragraph(f"<b>{text('Назва')}:</b> {text(desired['name'])}", styles['Normal']))
+    if desired['description']:
+        story.append(Paragraph(f"<b>{text('Опис')}:</b> {text(desired['description'])}", styles['Normal']))
+    if desired['classes']:
+        story.append(Paragraph(f"<b>{text('Класи МКТП')}:</b> {desired['classes']}", styles['Normal']))
     
     story.append(Spacer(1, 0.2*inch))
     
-    # Зображення
-    if desired.get('image'):
-        try:
-            image_data = base64.b64decode(desired['image'].split(',')[1])
-            image_stream = io.BytesIO(image_data)
-            img = RLImage(image_stream, width=2.5*inch, height=2.5*inch)
-            story.append(img)
-        except:
-            pass
+    # Зображення; lazy=2 - файл відкривається лише під час малювання сторінки
+    if desired['image']:
+        story.append(RLImage(desired['image'], width=2.5*inch, height=2.5*inch, lazy=2))
     
     story.append(PageBreak())
     
     # Результати
-    story.append(Paragraph(translit('2. РЕЗУЛЬТАТИ ПОРІВНЯННЯ'), heading_style))
+    story.append(Paragraph(text(model['sections']['results']), heading_style))
     story.append(Spacer(1, 0.2*inch))
     
-    for idx, result in enumerate(analysis_data['results'], 1):
-        tm_info = result['trademark_info']
-        
-        story.append(Paragraph(f'2.{idx}. TM #{tm_info.get("application_number", idx)}', heading_style))
-        story.append(Paragraph(f"<b>Vlasnyk:</b> {translit(tm_info['owner'])}", styles['Normal']))
-        story.append(Paragraph(f"<b>Nazva:</b> {translit(tm_info['name'])}", styles['Normal']))
-        story.append(Paragraph(f"<b>Klasy:</b> {tm_info['classes']}", styles['Normal']))
+    for mark in model['marks']:
+        story.append(Paragraph(f'2.{mark["index"]}. {text("ТМ")} #{mark["application_number"]}', heading_style))
+        story.append(Paragraph(f"<b>{text('Власник')}:</b> {text(mark['owner'])}", styles['Normal']))
+        story.append(Paragraph(f"<b>{text('Назва')}:</b> {text(mark['name'])}", styles['Normal']))
+        story.append(Paragraph(f"<b>{text('Класи')}:</b> {mark['classes']}", styles['Normal']))
         story.append(Spacer(1, 0.15*inch))
         
-        # Зображення
-        if tm_info.get('image'):
-            try:
-                image_data = base64.b64decode(tm_info['image'].split(',')[1])
-                image_stream = io.BytesIO(image_data)
-                img = RLImage(image_stream, width=2*inch, height=2*inch)
-                story.append(img)
-                story.append(Spacer(1, 0.15*inch))
-            except:
-                pass
+        if mark['image']:
+            story.append(RLImage(mark['image'], width=2*inch, height=2*inch, lazy=2))
+            story.append(Spacer(1, 0.15*inch))
         
         # Ризик
-        risk = result['overall_risk']
         story.append(Paragraph(
-            f'<para backColor="{"#d32f2f" if risk > 60 else "#f57c00" if risk > 30 else "#388e3c"}" textColor="white">'
-            f'<b>RYZYK: {risk}%</b> ({translit(result.get("confusion_likelihood", ""))})'
+            f'<para backColor="{REPORT_COLORS[mark["risk_level"]]}" textColor="white">'
+            f'<b>{text("РИЗИК")}: {mark["overall_risk"]}%</b> ({text(mark["confusion_likelihood"])})'
             f'</para>',
             styles['Normal']
         ))
         story.append(Spacer(1, 0.2*inch))
         
         # Аналіз
-        if result.get('similarity_analysis'):
-            sim = result['similarity_analysis']
-            
-            if sim.get('phonetic'):
-                story.append(Paragraph(f'<b>Fonetychna: {sim["phonetic"]["percentage"]}%</b>', styles['Normal']))
-                story.append(Paragraph(translit(sim["phonetic"]["details"]), styles['Normal']))
-                story.append(Spacer(1, 0.1*inch))
-            
-            if sim.get('graphic'):
-                story.append(Paragraph(f'<b>Hrafichna: {sim["graphic"]["percentage"]}%</b>', styles['Normal']))
-                story.append(Paragraph(translit(sim["graphic"]["details"]), styles['Normal']))
-                story.append(Spacer(1, 0.1*inch))
-            
-            if sim.get('semantic'):
-                story.append(Paragraph(f'<b>Semantychna: {sim["semantic"]["percentage"]}%</b>', styles['Normal']))
-                story.append(Paragraph(translit(sim["semantic"]["details"]), styles['Normal']))
-                story.append(Spacer(1, 0.1*inch))
-            
-            if sim.get('visual'):
-                story.append(Paragraph(f'<b>Vizualna: {sim["visual"]["percentage"]}%</b>', styles['Normal']))
-                story.append(Paragraph(translit(sim["visual"]["details"]), styles['Normal']))
-                story.append(Spacer(1, 0.1*inch))
+        for section in mark['similarity']:
+            story.append(Paragraph(f'<b>{text(section["label"])}: {section["percentage"]}%</b>', styles['Normal']))
+            story.append(Paragraph(text(section['details']), styles['Normal']))
+            story.append(Spacer(1, 0.1*inch))
         
         # Рекомендації
-        if result.get('recommendations'):
-            story.append(Paragraph('<b>Rekomendatsii:</b>', styles['Normal']))
-            for rec in result['recommendations']:
-                story.append(Paragraph(f'- {translit(rec)}', styles['Normal']))
+        if mark['recommendations']:
+            story.append(Paragraph(f'<b>{text("Рекомендації")}:</b>', styles['Normal']))
+            for rec in mark['recommendations']:
+                story.append(Paragraph(f'- {text(rec)}', styles['Normal']))
         
         story.append(Spacer(1, 0.2*inch))
         story.append(Paragraph('- - - - - - - -', styles['Normal']))
@@ -843,462 +3013,221 @@ def export_pdf(analysis_data, analysis_id):
     
     # Висновок
     story.append(PageBreak())
-    story.append(Paragraph(translit('3. ВИСНОВОК'), heading_style))
+    story.append(Paragraph(text(model['sections']['conclusion']), heading_style))
     story.append(Spacer(1, 0.3*inch))
     
-    chance = analysis_data['overall_chance']
     story.append(Paragraph(
         f'<para alignment="center" fontSize="18">'
-        f'Shans reyestratsiyi TM "{translit(desired["name"])}":'
+        f'{text("Шанс реєстрації ТМ")} "{text(desired["name"])}":'
         f'</para>',
         styles['Normal']
     ))
     story.append(Spacer(1, 0.2*inch))
     
     story.append(Paragraph(
-        f'<para alignment="center" fontSize="36" textColor="{"#388e3c" if chance > 70 else "#f57c00" if chance > 40 else "#d32f2f"}">'
-        f'<b>{chance}%</b>'
+        f'<para alignment="center" fontSize="36" textColor="{REPORT_COLORS[model["chance_level"]]}">'
+        f'<b>{model["overall_chance"]}%</b>'
         f'</para>',
         styles['Normal']
     ))
+    story.append(Spacer(1, 0.4*inch))
+    story.append(Paragraph(f'<para alignment="center">{text(model["verdict"])}</para>', styles['Normal']))
     
     doc.build(story)
-    buffer.seek(0)
-    
-    return send_file(
-        buffer,
-        mimetype='application/pdf',
-        as_attachment=True,
-        download_name=f'Analiz_TM_{analysis_id}.pdf'
-    )
-    buffer = io.BytesIO()
-    
-    # Завантажуємо шрифт DejaVu для кирилиці
-    try:
-        # Завантажуємо DejaVu Sans з CDN
-        dejavu_url = "https://github.com/dejavu-fonts/dejavu-fonts/raw/master/ttf/DejaVuSans.ttf"
-        dejavu_bold_url = "https://github.com/dejavu-fonts/dejavu-fonts/raw/master/ttf/DejaVuSans-Bold.ttf"
-        
-        # Завантажуємо шрифти
-        dejavu_data = urllib.request.urlopen(dejavu_url).read()
-        dejavu_bold_data = urllib.request.urlopen(dejavu_bold_url).read()
-        
-        # Зберігаємо тимчасово
-        with open('/tmp/DejaVuSans.ttf', 'wb') as f:
-            f.write(dejavu_data)
-        with open('/tmp/DejaVuSans-Bold.ttf', 'wb') as f:
-            f.write(dejavu_bold_data)
-        
-        # Реєструємо шрифти
-        pdfmetrics.registerFont(TTFont('DejaVu', '/tmp/DejaVuSans.ttf'))
-        pdfmetrics.registerFont(TTFont('DejaVu-Bold', '/tmp/DejaVuSans-Bold.ttf'))
-        font_name = 'DejaVu'
-        font_bold = 'DejaVu-Bold'
-    except:
-        print("⚠️ Не вдалося завантажити DejaVu, використовуємо Helvetica")
-        font_name = 'Helvetica'
-        font_bold = 'Helvetica-Bold'
-    
-    doc = SimpleDocTemplate(
-        buffer, 
-        pagesize=A4,
-        topMargin=0.75*inch,
-        bottomMargin=0.75*inch,
-        leftMargin=0.75*inch,
-        rightMargin=0.75*inch
-    )
-    story = []
-    
-    # Стилі з кирилицею
-    title_style = ParagraphStyle(
-        'Title',
-        fontName=font_bold,
-        fontSize=24,
-        textColor=colors.HexColor('#1a237e'),
-        alignment=TA_CENTER,
-        spaceAfter=20,
-        spaceBefore=10
-    )
-    
-    heading1_style = ParagraphStyle(
-        'Heading1',
-        fontName=font_bold,
-        fontSize=18,
-        textColor=colors.HexColor('#0d47a1'),
-        spaceAfter=15,
-        spaceBefore=20
-    )
-    
-    heading2_style = ParagraphStyle(
-        'Heading2',
-        fontName=font_bold,
-        fontSize=14,
-        textColor=colors.HexColor('#1565c0'),
-        spaceAfter=10,
-        spaceBefore=15
-    )
-    
-    normal_style = ParagraphStyle(
-        'Normal',
-        fontName=font_name,
-        fontSize=11,
-        leading=16,
-        spaceAfter=8
-    )
-    
-    bold_style = ParagraphStyle(
-        'Bold',
-        fontName=font_bold,
-        fontSize=11,
-        leading=16,
-        spaceAfter=8
-    )
-    
-    # Заголовок звіту
-    story.append(Paragraph('ЗВІТ ПРО АНАЛІЗ ТОРГОВЕЛЬНОЇ МАРКИ', title_style))
-    story.append(Spacer(1, 0.2*inch))
-    
-    # Дата
-    date_text = f"Дата аналізу: {datetime.now().strftime('%d.%m.%Y о %H:%M')}"
-    story.append(Paragraph(date_text, normal_style))
-    story.append(Spacer(1, 0.3*inch))
-    
-    # Лінія-розділювач
-    story.append(Paragraph('<para alignment="center">━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━</para>', normal_style))
-    story.append(Spacer(1, 0.3*inch))
-    
-    # 1. БАЖАНА ТМ
-    story.append(Paragraph('1. БАЖАНА ДЛЯ РЕЄСТРАЦІЇ ТОРГОВЕЛЬНА МАРКА', heading1_style))
-    
-    desired = analysis_data['desired_trademark']
-    
-    # Таблиця з інформацією
-    data_table = [
-        [Paragraph('<b>Назва:</b>', bold_style), Paragraph(desired['name'], normal_style)],
-        [Paragraph('<b>Опис:</b>', bold_style), Paragraph(desired.get('description') or 'Не вказано', normal_style)],
-        [Paragraph('<b>Класи МКТП:</b>', bold_style), Paragraph(desired.get('classes') or 'Не вказано', normal_style)],
-    ]
-    
-    table = Table(data_table, colWidths=[2*inch, 4.5*inch])
-    table.setStyle(TableStyle([
-        ('VALIGN', (0, 0), (-1, -1), 'TOP'),
-        ('LEFTPADDING', (0, 0), (-1, -1), 8),
-        ('RIGHTPADDING', (0, 0), (-1, -1), 8),
-        ('TOPPADDING', (0, 0), (-1, -1), 6),
-        ('BOTTOMPADDING', (0, 0), (-1, -1), 6),
-    ]))
-    story.append(table)
-    story.append(Spacer(1, 0.2*inch))
-    
-    # Зображення бажаної ТМ
-    if desired.get('image'):
-        try:
-            image_data = base64.b64decode(desired['image'].split(',')[1])
-            image_stream = io.BytesIO(image_data)
-            img = RLImage(image_stream, width=2.5*inch, height=2.5*inch)
-            story.append(Paragraph('<para alignment="center"><b>Зображення торговельної марки:</b></para>', bold_style))
-            story.append(Spacer(1, 0.1*inch))
-            story.append(img)
-        except Exception as e:
-            print(f"Помилка додавання зображення: {e}")
+
+def public_report_model(model):
+    """Модель без локальних шляхів до зображень (для JSON)"""
+    strip = lambda item: {key: value for key, value in item.items() if key not in ('image', 'image_error')}
+    return dict(model, desired=strip(model['desired']), marks=[strip(mark) for mark in model['marks']])
+
+def emit_json(model, output_path):
+    """JSON-звіт з моделі; зображення - посиланнями /api/images/<hash>"""
+    with open(output_path, 'w', encoding='utf-8') as f:
+        json.dump(public_report_model(model), f, ensure_ascii=False, indent=2)
+
+def emit_csv(model, output_path):
+    """CSV-таблиця результатів: один рядок на зареєстровану ТМ"""
+    # utf-8-sig, щоб Excel коректно відкривав кирилицю
+    with open(output_path, 'w', encoding='utf-8-sig', newline='') as f:
+        writer = csv.DictWriter(f, fieldnames=REPORT_CSV_COLUMNS)
+        writer.writeheader()
+        for mark in model['marks']:
+            percentages = {section['key']: section['percentage'] for section in mark['similarity']}
+            writer.writerow({
+                'index': mark['index'],
+                'application_number': mark['application_number'],
+                'name': mark['name'],
+                'owner': mark['owner'],
+                'classes': mark['classes'],
+                'overall_risk': mark['overall_risk'],
+                'confusion_likelihood': mark['confusion_likelihood'],
+                **{key: percentages.get(key, '') for key, _ in REPORT_SIMILARITY_LABELS},
+                'recommendations': ' | '.join(mark['recommendations'])
+            })
+
+EXPORT_FORMATS = {
+    'docx': {
+        'emit': emit_docx,
+        'mimetype': 'application/vnd.openxmlformats-officedocument.wordprocessingml.document',
+        'download_name': 'Аналіз_ТМ_{analysis_id}.docx'
+    },
+    'pdf': {
+        'emit': emit_pdf,
+        'mimetype': 'application/pdf',
+        'download_name': 'Analiz_TM_{analysis_id}.pdf'
+    },
+    'json': {
+        'emit': emit_json,
+        'mimetype': 'application/json',
+        'download_name': 'Analiz_TM_{analysis_id}.json'
+    },
+    'csv': {
+        'emit': emit_csv,
+        'mimetype': 'text/csv',
+        'download_name': 'Analiz_TM_{analysis_id}.csv'
+    }
+}
+
+SYSTEM_PROMPT = "Ти експерт з торговельних марок з 20-річним досвідом. Твої аналізи завжди ДЕТАЛЬНІ та ОБҐРУНТОВАНІ. Ти пишеш мінімум 3-5 речень для кожного критерію. Відповідай ВИКЛЮЧНО валідним JSON."
+
+PAIR_RESULT_FIELDS = '''"identical_test":{"is_identical":false,"percentage":0,"details":"Детальне обґрунтування (3-5 речень) чому марки тотожні або різні"}, "similarity_analysis":{"phonetic":{"percentage":0,"details":"ДЕТАЛЬНИЙ опис (3-5 речень): які звуки співпадають, які відрізняються, як це впливає на сприйняття, чи легко переплутати при вимові"}, "graphic":{"percentage":0,"details":"ДЕТАЛЬНИЙ опис (3-5 речень): які літери схожі, чим відрізняється візуально, чи легко переплутати при читанні, особливості шрифту"}, "semantic":{"percentage":0,"details":"ДЕТАЛЬНИЙ опис (3-5 речень): що означає кожна марка, які асоціації викликає, чи є логічний звязок між значеннями, що відчує споживач"}, "visual":{"percentage":0,"details":"ДЕТАЛЬНИЙ опис (5-7 речень якщо є зображення): точні кольори, графічні елементи, композиція, стиль, чи можна переплутати візуально. Якщо немає зображень - напиши що аналіз не проведено"}}, "goods_services_relation":{"are_related":false,"details":"Стислий опис (1-2 речення) з урахуванням розрахованої спорідненості класів: чи орієнтовані товари/послуги на одну аудиторію"}, "overall_risk":0, "confusion_likelihood":"низька/середня/висока", "recommendations":["Конкретна детальна рекомендація 1 (2-3 речення)","Конкретна детальна рекомендація 2 (2-3 речення)"]'''
+
+def get_openai_client():
+    """Повертає глобальний клієнт OpenAI або створює тимчасовий"""
+    api_key = os.getenv('OPENAI_API_KEY')
+    if not api_key:
+        raise Exception("OpenAI API ключ не налаштований")
+    return client if client is not None else OpenAI(api_key=api_key)
+
+def clean_json_content(content):
+    """Очищує відповідь GPT від markdown та коментарів"""
+    content = content.strip().replace("```json", "").replace("```", "").strip()
+    lines = content.split('\n')
+    cleaned_lines = [line for line in lines if not line.strip().startswith('//')]
+    return '\n'.join(cleaned_lines)
+
+def finalize_pair_result(result, existing_tm, images_analyzed=False):
+    """Доповнює результат GPT обов'язковими полями та зображенням ТМ"""
+    # Перевірка обов'язкових полів
+    if "trademark_info" not in result:
+        result["trademark_info"] = {
+            "application_number": existing_tm.get('application_number', ''),
+            "owner": existing_tm.get('owner', ''),
+            "name": existing_tm.get('name', ''),
+            "classes": existing_tm.get('classes', '')
+        }
     
-    story.append(PageBreak())
+    # Додаємо зображення до результату
+    if existing_tm.get('image'):
+        result['trademark_info']['image'] = existing_tm['image']
     
-    # 2. РЕЗУЛЬТАТИ ПОРІВНЯННЯ
-    story.append(Paragraph('2. РЕЗУЛЬТАТИ ПОРІВНЯННЯ З ЗАРЕЄСТРОВАНИМИ ТМ', heading1_style))
-    story.append(Spacer(1, 0.2*inch))
+    if "similarity_analysis" not in result:
+        result["similarity_analysis"] = {
+            "phonetic": {"percentage": 0, "details": "Аналіз недоступний"},
+            "graphic": {"percentage": 0, "details": "Аналіз недоступний"},
+            "semantic": {"percentage": 0, "details": "Аналіз недоступний"},
+            "visual": {"percentage": 0, "details": "Аналіз недоступний"}
+        }
     
-    for idx, result in enumerate(analysis_data['results'], 1):
-        tm_info = result['trademark_info']
-        
-        # Підзаголовок
-        story.append(Paragraph(f'2.{idx}. Торговельна марка №{tm_info.get("application_number", idx)}', heading2_style))
-        
-        # Інфо про ТМ
-        tm_data = [
-            [Paragraph('<b>Власник:</b>', bold_style), Paragraph(tm_info['owner'], normal_style)],
-            [Paragraph('<b>Назва:</b>', bold_style), Paragraph(tm_info['name'], normal_style)],
-            [Paragraph('<b>Класи МКТП:</b>', bold_style), Paragraph(tm_info['classes'], normal_style)],
-        ]
-        
-        tm_table = Table(tm_data, colWidths=[2*inch, 4.5*inch])
-        tm_table.setStyle(TableStyle([
-            ('VALIGN', (0, 0), (-1, -1), 'TOP'),
-            ('LEFTPADDING', (0, 0), (-1, -1), 8),
-            ('TOPPADDING', (0, 0), (-1, -1), 6),
-            ('BOTTOMPADDING', (0, 0), (-1, -1), 6),
-        ]))
-        story.append(tm_table)
-        story.append(Spacer(1, 0.15*inch))
-        
-        # Зображення зареєстрованої ТМ
-        if tm_info.get('image'):
-            try:
-                image_data = base64.b64decode(tm_info['image'].split(',')[1])
-                image_stream = io.BytesIO(image_data)
-                img = RLImage(image_stream, width=2*inch, height=2*inch)
-                story.append(img)
-                story.append(Spacer(1, 0.15*inch))
-            except:
-                pass
-        
-        # РИЗИК - у кольоровій рамці
-        risk = result['overall_risk']
-        risk_color = '#d32f2f' if risk > 60 else '#f57c00' if risk > 30 else '#388e3c'
+    if "overall_risk" not in result:
+        result["overall_risk"] = 50
         
-        risk_para = Paragraph(
-            f'<para alignment="center" backColor="{risk_color}" textColor="white" '
-            f'leftIndent="10" rightIndent="10" spaceAfter="10" spaceBefore="10">'
-            f'<b>РИЗИК ЗМІШУВАННЯ: {risk}%</b> ({result.get("confusion_likelihood", "невідомо")})'
-            f'</para>',
-            bold_style
-        )
-        story.append(risk_para)
-        story.append(Spacer(1, 0.2*inch))
-        
-        # Детальний аналіз
-        story.append(Paragraph('<b>Детальний аналіз схожості:</b>', bold_style))
-        story.append(Spacer(1, 0.1*inch))
+    if "confusion_likelihood" not in result:
+        result["confusion_likelihood"] = "середня"
         
-        if result.get('similarity_analysis'):
-            sim = result['similarity_analysis']
-            
-            if sim.get('phonetic'):
-                story.append(Paragraph(
-                    f'🔊 <b>Фонетична схожість: {sim["phonetic"]["percentage"]}%</b>',
-                    bold_style
-                ))
-                story.append(Paragraph(sim["phonetic"]["details"], normal_style))
-                story.append(Spacer(1, 0.1*inch))
-            
-            if sim.get('graphic'):
-                story.append(Paragraph(
-                    f'✍️ <b>Графічна схожість: {sim["graphic"]["percentage"]}%</b>',
-                    bold_style
-                ))
-                story.append(Paragraph(sim["graphic"]["details"], normal_style))
-                story.append(Spacer(1, 0.1*inch))
-            
-            if sim.get('semantic'):
-                story.append(Paragraph(
-                    f'💭 <b>Семантична схожість: {sim["semantic"]["percentage"]}%</b>',
-                    bold_style
-                ))
-                story.append(Paragraph(sim["semantic"]["details"], normal_style))
-                story.append(Spacer(1, 0.1*inch))
-            
-            if sim.get('visual'):
-                story.append(Paragraph(
-                    f'🎨 <b>Візуальна схожість: {sim["visual"]["percentage"]}%</b>',
-                    bold_style
-                ))
-                story.append(Paragraph(sim["visual"]["details"], normal_style))
-                story.append(Spacer(1, 0.1*inch))
-        
-        # Спорідненість товарів
-        if result.get('goods_services_relation'):
-            goods = result['goods_services_relation']
-            story.append(Paragraph(
-                f'📦 <b>Спорідненість товарів/послуг: {"ТАК" if goods.get("are_related") else "НІ"}</b>',
-                bold_style
-            ))
-            story.append(Paragraph(goods.get("details", ""), normal_style))
-            story.append(Spacer(1, 0.15*inch))
-        
-        # Рекомендації
-        if result.get('recommendations') and len(result['recommendations']) > 0:
-            story.append(Paragraph('<b>💡 Рекомендації:</b>', bold_style))
-            for rec in result['recommendations']:
-                story.append(Paragraph(f'• {rec}', normal_style))
-        
-        # Розділювач між ТМ
-        if idx < len(analysis_data['results']):
-            story.append(Spacer(1, 0.2*inch))
-            story.append(Paragraph('<para alignment="center">• • •</para>', normal_style))
-            story.append(Spacer(1, 0.2*inch))
+    if "recommendations" not in result or not result["recommendations"]:
+        result["recommendations"] = ["Рекомендується детальніше проаналізувати можливі конфлікти"]
     
-    # 3. ВИСНОВОК
-    story.append(PageBreak())
-    story.append(Paragraph('3. ЗАГАЛЬНИЙ ВИСНОВОК', heading1_style))
-    story.append(Spacer(1, 0.3*inch))
-    
-    chance = analysis_data['overall_chance']
-    chance_color = '#388e3c' if chance > 70 else '#f57c00' if chance > 40 else '#d32f2f'
-    
-    story.append(Paragraph(
-        f'<para alignment="center" fontSize="20">'
-        f'Шанс успішної реєстрації торговельної марки<br/>'
-        f'<b>"{desired["name"]}"</b>:'
-        f'</para>',
-        normal_style
-    ))
-    story.append(Spacer(1, 0.2*inch))
-    
-    story.append(Paragraph(
-        f'<para alignment="center" fontSize="36" textColor="{chance_color}">'
-        f'<b>{chance}%</b>'
-        f'</para>',
-        bold_style
-    ))
-    story.append(Spacer(1, 0.3*inch))
-    
-    # Інтерпретація
-    if chance > 70:
-        interpretation = "✅ <b>Висока ймовірність успішної реєстрації.</b> Торговельна марка має хороші шанси бути зареєстрованою без конфліктів."
-    elif chance > 40:
-        interpretation = "⚠️ <b>Середня ймовірність реєстрації.</b> Рекомендується детальніше вивчити конфліктні торговельні марки та, можливо, внести незначні зміни."
-    else:
-        interpretation = "❌ <b>Низька ймовірність реєстрації.</b> Виявлено значні конфлікти. Настійно рекомендується внести суттєві зміни до торговельної марки."
+    # Додаємо мітку що аналіз зображень виконано
+    if images_analyzed:
+        if 'similarity_analysis' in result and 'visual' in result['similarity_analysis']:
+            result['similarity_analysis']['visual']['images_analyzed'] = True
     
-    story.append(Paragraph(interpretation, normal_style))
-    
-    # Генеруємо PDF
-    doc.build(story)
-    buffer.seek(0)
-    
-    return send_file(
-        buffer,
-        mimetype='application/pdf',
-        as_attachment=True,
-        download_name=f'Аналіз_ТМ_{analysis_id}.pdf'
-    )
-    buffer = io.BytesIO()
-    doc = SimpleDocTemplate(buffer, pagesize=A4, topMargin=50, bottomMargin=50)
-    story = []
-    styles = getSampleStyleSheet()
-    
-    # Створюємо стилі з підтримкою кирилиці
-    title_style = ParagraphStyle(
-        'CustomTitle',
-        parent=styles['Heading1'],
-        fontSize=20,
-        textColor=colors.HexColor('#000000'),
-        spaceAfter=30,
-        alignment=1,  # CENTER
-        fontName='Helvetica-Bold'
-    )
-    
-    heading_style = ParagraphStyle(
-        'CustomHeading',
-        parent=styles['Heading2'],
-        fontSize=16,
-        textColor=colors.HexColor('#000000'),
-        spaceAfter=12,
-        fontName='Helvetica-Bold'
-    )
-    
-    normal_style = ParagraphStyle(
-        'CustomNormal',
-        parent=styles['Normal'],
-        fontSize=11,
-        fontName='Helvetica'
-    )
-    
-    # Заголовок
-    story.append(Paragraph('ZVIT PRO ANALIZ TORGOVELNOI MARKY', title_style))
-    story.append(Spacer(1, 0.3*inch))
-    story.append(Paragraph(f"Data analizu: {datetime.now().strftime('%d.%m.%Y %H:%M')}", normal_style))
-    story.append(Spacer(1, 0.5*inch))
-    
-    # Бажана ТМ
-    story.append(Paragraph('1. BAZHANA TORGOVELNA MARKA', heading_style))
-    story.append(Spacer(1, 0.2*inch))
-    
-    desired = analysis_data['desired_trademark']
-    story.append(Paragraph(f"<b>Nazva:</b> {desired['name']}", normal_style))
-    if desired.get('description'):
-        story.append(Paragraph(f"<b>Opys:</b> {desired['description']}", normal_style))
-    if desired.get('classes'):
-        story.append(Paragraph(f"<b>Klasy MKTP:</b> {desired['classes']}", normal_style))
-    
-    story.append(Spacer(1, 0.2*inch))
-    
-    # Зображення бажаної ТМ
-    if desired.get('image'):
-        try:
-            image_data = base64.b64decode(desired['image'].split(',')[1])
-            image_stream = io.BytesIO(image_data)
-            img = RLImage(image_stream, width=2*inch, height=2*inch)
-            story.append(img)
-        except:
-            story.append(Paragraph("Zobrazhennya ne vdalosya dodaty", normal_style))
-    
-    story.append(PageBreak())
-    
-    # Результати
-    story.append(Paragraph('2. REZULTATY PORIVNYANNYA', heading_style))
-    story.append(Spacer(1, 0.3*inch))
+    return result
+
+LOGO_DESCRIPTION_VERSION = 1
+
+LOGO_DESCRIPTION_PROMPT = """Опиши логотип торговельної марки так, щоб його можна було порівняти з іншими логотипами лише за текстом.
+Відповідь у JSON форматі:
+{"colors":["точні назви кольорів"], "elements":["графічні елементи: що саме зображено"], "text":"написи на логотипі або порожній рядок", "style":"стиль (мінімалізм, корпоративний, креативний тощо)", "composition":"як розташовані елементи", "description":"детальний опис логотипу (4-6 речень)"}"""
+
+logo_description_locks = {}
+logo_description_locks_guard = threading.Lock()
+
+def logo_description_key(image):
+    """Ключ опису: вміст зображення, модель та версія промпту"""
+    payload = f"{image_content_hash(image)}:{OPENAI_MODEL}:{LOGO_DESCRIPTION_VERSION}"
+    return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+def describe_logo(temp_client, image):
+    """Текстовий опис логотипу; Vision викликається один раз на унікальне зображення"""
+    key = logo_description_key(image)
+    with logo_description_locks_guard:
+        lock = logo_description_locks.setdefault(key, threading.Lock())
     
-    for idx, result in enumerate(analysis_data['results'], 1):
-        tm_info = result['trademark_info']
-        
-        sub_heading = ParagraphStyle('SubHead', parent=heading_style, fontSize=14)
-        story.append(Paragraph(f'2.{idx}. TM #{tm_info.get("application_number", idx)}', sub_heading))
-        story.append(Spacer(1, 0.1*inch))
-        
-        story.append(Paragraph(f"<b>Vlasnyk:</b> {tm_info['owner']}", normal_style))
-        story.append(Paragraph(f"<b>Nazva:</b> {tm_info['name']}", normal_style))
-        story.append(Paragraph(f"<b>Klasy:</b> {tm_info['classes']}", normal_style))
-        story.append(Spacer(1, 0.1*inch))
-        
-        # Зображення зареєстрованої ТМ
-        if tm_info.get('image'):
-            try:
-                image_data = base64.b64decode(tm_info['image'].split(',')[1])
-                image_stream = io.BytesIO(image_data)
-                img = RLImage(image_stream, width=2*inch, height=2*inch)
-                story.append(img)
-                story.append(Spacer(1, 0.1*inch))
-            except:
-                pass
-        
-        # Ризик
-        story.append(Paragraph(
-            f"<b>RYZYK ZMISHUVANNYA: {result['overall_risk']}%</b> ({result['confusion_likelihood']})",
-            normal_style
-        ))
-        story.append(Spacer(1, 0.2*inch))
-        
-        # Аналіз
-        if result.get('similarity_analysis'):
-            story.append(Paragraph("<b>Detalnyi analiz:</b>", normal_style))
-            
-            if result['similarity_analysis'].get('phonetic'):
-                story.append(Paragraph(
-                    f"• Fonetychna: {result['similarity_analysis']['phonetic']['percentage']}%",
-                    normal_style
-                ))
+    # Паралельні пари з тим самим логотипом чекають на перший запит замість дублювання
+    try:
+        with lock:
+            description = logo_description_cache.get(key)
+            if description is not None:
+                print(f"💾 Кеш: опис логотипу {key[:12]}")
+                return description
             
-            if result['similarity_analysis'].get('semantic'):
-                story.append(Paragraph(
-                    f"• Semantychna: {result['similarity_analysis']['semantic']['percentage']}%",
-                    normal_style
-                ))
-        
-        story.append(Spacer(1, 0.3*inch))
-        story.append(Paragraph('_' * 80, normal_style))
-        story.append(Spacer(1, 0.2*inch))
-    
-    # Висновок
-    story.append(PageBreak())
-    story.append(Paragraph('3. VYSNOVOK', heading_style))
-    story.append(Spacer(1, 0.3*inch))
-    
-    story.append(Paragraph(
-        f"Shans uspishnoyi reyestratsiyi: <b>{analysis_data['overall_chance']}%</b>",
-        normal_style
-    ))
-    
-    doc.build(story)
-    buffer.seek(0)
-    
-    return send_file(
-        buffer,
-        mimetype='application/pdf',
-        as_attachment=True,
-        download_name=f'Analiz_TM_{analysis_id}.pdf'
+            url, detail, tokens = prepare_vision_image(image)
+            print(f"🎨 Опис логотипу через Vision {key[:12]} (~{tokens} токенів зображення)")
+            response = temp_client.chat.completions.create(
+                model=OPENAI_MODEL,
+                messages=[
+                    {"role": "system", "content": "Ти експерт з дизайну торговельних марок. Відповідай ВИКЛЮЧНО валідним JSON."},
+                    {"role": "user", "content": [
+                        {"type": "text", "text": LOGO_DESCRIPTION_PROMPT},
+                        {"type": "image_url", "image_url": {"url": url, "detail": detail}}
+                    ]}
+                ],
+                response_format={"type": "json_object"},
+                max_tokens=800,
+                temperature=0.2
+            )
+            description = json.loads(clean_json_content(response.choices[0].message.content))
+            logo_description_cache.put(key, description)
+    finally:
+        # Блокування прибираємо і після помилки Vision, інакше воно лишається в словнику назавжди
+        with logo_description_locks_guard:
+            logo_description_locks.pop(key, None)
+    return description
+
+def format_logo_description(title, description):
+    return (
+        f"{title}:\n"
+        f"- Кольори: {', '.join(description.get('colors') or []) or 'не вказано'}\n"
+        f"- Елементи: {', '.join(description.get('elements') or []) or 'не вказано'}\n"
+        f"- Написи: {description.get('text') or 'немає'}\n"
+        f"- Стиль: {description.get('style', 'не вказано')}\n"
+        f"- Композиція: {description.get('composition', 'не вказано')}\n"
+        f"- Опис: {description.get('description', '')}"
     )
 
+def describe_pair_logos(temp_client, desired_tm, existing_tm, has_desired_image, has_existing_image):
+    """Блок промпту з описами логотипів пари; None - якщо описати не вдалося"""
+    try:
+        parts = []
+        if has_desired_image:
+            parts.append(format_logo_description(
+                f"ЛОГОТИП БАЖАНОЇ МАРКИ '{desired_tm.get('name', '')}'", describe_logo(temp_client, desired_tm['image'])
+            ))
+        else:
+            parts.append("Бажана марка не має зображення.")
+        if has_existing_image:
+            parts.append(format_logo_description(
+                f"ЛОГОТИП ЗАРЕЄСТРОВАНОЇ МАРКИ '{existing_tm.get('name', '')}'", describe_logo(temp_client, existing_tm['image'])
+            ))
+        else:
+            parts.append("Зареєстрована марка не має зображення.")
+        return "\n\n".join(parts)
+    except Exception as e:
+        print(f"⚠️ Не вдалося описати логотипи, використовуємо Vision: {e}")
+        return None
+
 def analyze_single_pair(desired_tm, existing_tm, instructions):
     """Аналізує пару торговельних марок, включаючи зображення"""
     
@@ -1311,6 +3240,9 @@ def analyze_single_pair(desired_tm, existing_tm, instructions):
     if existing_tm.get('image'):
         print(f"   Розмір зображення зареєстрованої: {len(existing_tm['image'])} символів")
     
+    # Спорідненість класів рахуємо локально, щоб GPT не виводив її з нуля
+    goods = goods_services_score(desired_tm, existing_tm)
+    
     # Детальний промпт з інструкціями
     text_prompt = f"""Ти експерт з торговельних марок. Проаналізуй дві марки максимально детально.
 
@@ -1322,6 +3254,9 @@ def analyze_single_pair(desired_tm, existing_tm, instructions):
 Власник: {existing_tm.get('owner', 'не вказано')}
 Класи МКТП: {existing_tm.get('classes', 'не вказано')}
 
+СПОРІДНЕНІСТЬ КЛАСІВ (розраховано заздалегідь, використай як основу для goods_services_relation):
+{describe_goods_services_score(goods)}
+
 === КРИТЕРІЇ АНАЛІЗУ (ДУЖЕ ВАЖЛИВО) ===
 {instructions[:4000]}
 
@@ -1339,81 +3274,72 @@ def analyze_single_pair(desired_tm, existing_tm, instructions):
 - Чи можна їх переплутати візуально
 
 Відповідь у JSON форматі:
-{{"trademark_info":{{"application_number":"{existing_tm.get('application_number','')}","owner":"{existing_tm.get('owner','')}","name":"{existing_tm.get('name','')}","classes":"{existing_tm.get('classes','')}"}}, "identical_test":{{"is_identical":false,"percentage":0,"details":"Детальне обґрунтування (3-5 речень) чому марки тотожні або різні"}}, "similarity_analysis":{{"phonetic":{{"percentage":0,"details":"ДЕТАЛЬНИЙ опис (3-5 речень): які звуки співпадають, які відрізняються, як це впливає на сприйняття, чи легко переплутати при вимові"}}, "graphic":{{"percentage":0,"details":"ДЕТАЛЬНИЙ опис (3-5 речень): які літери схожі, чим відрізняється візуально, чи легко переплутати при читанні, особливості шрифту"}}, "semantic":{{"percentage":0,"details":"ДЕТАЛЬНИЙ опис (3-5 речень): що означає кожна марка, які асоціації викликає, чи є логічний звязок між значеннями, що відчує споживач"}}, "visual":{{"percentage":0,"details":"ДЕТАЛЬНИЙ опис (5-7 речень якщо є зображення): точні кольори, графічні елементи, композиція, стиль, чи можна переплутати візуально. Якщо немає зображень - напиши що аналіз не проведено"}}}}, "goods_services_relation":{{"are_related":false,"details":"ДЕТАЛЬНИЙ опис (3-5 речень): для чого використовуються товари/послуги, чи орієнтовані на одну аудиторію, чи можуть конкурувати"}}, "overall_risk":0, "confusion_likelihood":"низька/середня/висока", "recommendations":["Конкретна детальна рекомендація 1 (2-3 речення)","Конкретна детальна рекомендація 2 (2-3 речення)"]}}"""
+{{"trademark_info":{{"application_number":"{existing_tm.get('application_number','')}","owner":"{existing_tm.get('owner','')}","name":"{existing_tm.get('name','')}","classes":"{existing_tm.get('classes','')}"}}, {PAIR_RESULT_FIELDS}}}"""
     
     try:
-        api_key = os.getenv('OPENAI_API_KEY')
-        if not api_key:
-            raise Exception("OpenAI API ключ не налаштований")
-        
-        if client is None:
-            temp_client = OpenAI(api_key=api_key)
-        else:
-            temp_client = client
+        temp_client = get_openai_client()
         
         # Перевіряємо чи є зображення
-        has_desired_image = desired_tm.get('image') and len(str(desired_tm.get('image', ''))) > 100
-        has_existing_image = existing_tm.get('image') and len(str(existing_tm.get('image', ''))) > 100
+        has_desired_image = has_image(desired_tm)
+        has_existing_image = has_image(existing_tm)
         
-        # Стискаємо зображення перед відправкою
+        # Стискаємо зображення перед відправкою (вже нормалізовані беруться з кешу)
         if has_desired_image:
-            print(f"🗜️ Стискаю зображення бажаної ТМ...")
-            desired_tm['image'] = compress_image_base64(desired_tm['image'], max_size_kb=80)
+            desired_tm['image'] = normalize_image(desired_tm['image'])
         
         if has_existing_image:
-            print(f"🗜️ Стискаю зображення зареєстрованої ТМ...")
-            existing_tm['image'] = compress_image_base64(existing_tm['image'], max_size_kb=80)
+            existing_tm['image'] = normalize_image(existing_tm['image'])
         
         print(f"✅ Перевірка зображень:")
         print(f"   Бажана ТМ: {has_desired_image}")
         print(f"   Зареєстрована ТМ: {has_existing_image}")
         
-        if has_desired_image or has_existing_image:
+        # Локальне порівняння логотипів; для очевидних випадків Vision не потрібен
+        local_visual = None
+        visual_decided_locally = False
+        use_vision = has_desired_image or has_existing_image
+        if has_desired_image and has_existing_image:
+            try:
+                local_visual = compare_logos(desired_tm['image'], existing_tm['image'])
+                print(f"🖼️ Локальна схожість логотипів: {local_visual['percentage']}%")
+                if not needs_vision_call(local_visual):
+                    visual_decided_locally = True
+                    use_vision = False
+                    text_prompt += (
+                        "\n\nЗОБРАЖЕННЯ порівняно локально, оцінку visual візьми з цього результату:\n"
+                        + describe_local_visual(local_visual)
+                    )
+            except Exception as e:
+                print(f"⚠️ Помилка локального порівняння логотипів: {e}")
+        
+        # Замість повторної передачі зображень порівнюємо їх кешовані текстові описи
+        if use_vision and LOGO_DESCRIPTIONS_ENABLED:
+            logo_descriptions = describe_pair_logos(
+                temp_client, desired_tm, existing_tm, has_desired_image, has_existing_image
+            )
+            if logo_descriptions:
+                use_vision = False
+                text_prompt += (
+                    "\n\nОПИСИ ЗОБРАЖЕНЬ (складені експертом з дизайну), порівняй логотипи за ними:\n"
+                    + logo_descriptions
+                )
+        
+        if use_vision:
             print(f"🎨 ВИКОРИСТОВУЄМО GPT-4o Vision для аналізу зображень")
             # Використовуємо GPT-4o Vision для аналізу зображень
-            messages_content = [
-                {
-                    "type": "text",
-                    "text": text_prompt + "\n\nУВАГА: Тобі надано зображення торговельних марок. ОБОВ'ЯЗКОВО проаналізуй їх візуальну схожість детально!"
-                }
-            ]
-            
-            # Додаємо зображення бажаної ТМ (якщо є)
-            if has_desired_image:
-                # Перевіряємо що це data URL
-                if desired_tm['image'].startswith('data:image'):
-                    messages_content.append({
-                        "type": "image_url",
-                        "image_url": {
-                            "url": desired_tm['image']
-                        }
-                    })
-                    messages_content.append({
-                        "type": "text",
-                        "text": f"☝️ Це логотип/зображення БАЖАНОЇ торговельної марки '{desired_tm.get('name', '')}'. Опиши його детально."
-                    })
-            
-            # Додаємо зображення зареєстрованої ТМ (якщо є)
-            if has_existing_image:
-                if existing_tm['image'].startswith('data:image'):
-                    messages_content.append({
-                        "type": "image_url",
-                        "image_url": {
-                            "url": existing_tm['image']
-                        }
-                    })
-                    messages_content.append({
-                        "type": "text",
-                        "text": f"☝️ Це логотип/зображення ЗАРЕЄСТРОВАНОЇ торговельної марки '{existing_tm.get('name', '')}'. Опиши його детально та порівняй з попереднім."
-                    })
+            messages_content, vision_tokens = build_vision_content(
+                text_prompt + "\n\nУВАГА: Тобі надано зображення торговельних марок. ОБОВ'ЯЗКОВО проаналізуй їх візуальну схожість детально!",
+                desired_tm, existing_tm, has_desired_image, has_existing_image
+            )
+            print(f"🧮 Vision: {vision_tokens['images']} зобр., ~{vision_tokens['estimated']} токенів (без оптимізації ~{vision_tokens['baseline']})")
             
             # Запит до GPT-4o Vision
             response = temp_client.chat.completions.create(
-                model="gpt-4o",
+                model=OPENAI_MODEL,
                 messages=[
                     {
                         "role": "system",
-                        "content": "Ти експерт з торговельних марок з 20-річним досвідом. Твої аналізи завжди ДЕТАЛЬНІ та ОБҐРУНТОВАНІ. Ти пишеш мінімум 3-5 речень для кожного критерію. Відповідай ВИКЛЮЧНО валідним JSON."
+                        "content": SYSTEM_PROMPT
                     },
                     {
                         "role": "user",
@@ -1427,11 +3353,11 @@ def analyze_single_pair(desired_tm, existing_tm, instructions):
         else:
             # Звичайний текстовий аналіз без зображень
             response = temp_client.chat.completions.create(
-                model="gpt-4o",
+                model=OPENAI_MODEL,
                 messages=[
                     {
                         "role": "system",
-                        "content": "Ти експерт з торговельних марок з 20-річним досвідом. Твої аналізи завжди ДЕТАЛЬНІ та ОБҐРУНТОВАНІ. Ти пишеш мінімум 3-5 речень для кожного критерію. Відповідай ВИКЛЮЧНО валідним JSON."
+                        "content": SYSTEM_PROMPT
                     },
                     {
                         "role": "user",
@@ -1443,52 +3369,25 @@ def analyze_single_pair(desired_tm, existing_tm, instructions):
                 max_tokens=4000  # Зменшено для економії пам'яті
             )
         
-        content = response.choices[0].message.content.strip()
-        
-        # Очищення від markdown
-        content = content.replace("```json", "").replace("```", "").strip()
-        lines = content.split('\n')
-        cleaned_lines = [line for line in lines if not line.strip().startswith('//')]
-        content = '\n'.join(cleaned_lines)
+        content = clean_json_content(response.choices[0].message.content)
         
         print(f"✅ GPT Response успішна (перші 500 символів): {content[:500]}...")
         
-        result = json.loads(content)
-        
-        # Додаємо зображення до результату
-        if existing_tm.get('image'):
-            result['trademark_info']['image'] = existing_tm['image']
-        
-        # Перевірка обов'язкових полів
-        if "trademark_info" not in result:
-            result["trademark_info"] = {
-                "application_number": existing_tm.get('application_number', ''),
-                "owner": existing_tm.get('owner', ''),
-                "name": existing_tm.get('name', ''),
-                "classes": existing_tm.get('classes', '')
-            }
-        
-        if "similarity_analysis" not in result:
-            result["similarity_analysis"] = {
-                "phonetic": {"percentage": 0, "details": "Аналіз недоступний"},
-                "graphic": {"percentage": 0, "details": "Аналіз недоступний"},
-                "semantic": {"percentage": 0, "details": "Аналіз недоступний"},
-                "visual": {"percentage": 0, "details": "Аналіз недоступний"}
-            }
+        result = finalize_pair_result(
+            json.loads(content), existing_tm, images_analyzed=bool(has_desired_image or has_existing_image)
+        )
         
-        if "overall_risk" not in result:
-            result["overall_risk"] = 50
-            
-        if "confusion_likelihood" not in result:
-            result["confusion_likelihood"] = "середня"
-            
-        if "recommendations" not in result or not result["recommendations"]:
-            result["recommendations"] = ["Рекомендується детальніше проаналізувати можливі конфлікти"]
+        if use_vision:
+            result['vision_tokens'] = vision_tokens
         
-        # Додаємо мітку що аналіз зображень виконано
-        if (has_desired_image or has_existing_image):
-            if 'similarity_analysis' in result and 'visual' in result['similarity_analysis']:
-                result['similarity_analysis']['visual']['images_analyzed'] = True
+        if local_visual is not None:
+            result['local_visual'] = dict(local_visual, vision_skipped=visual_decided_locally)
+            if visual_decided_locally:
+                result['similarity_analysis']['visual'] = {
+                    'percentage': local_visual['percentage'],
+                    'details': describe_local_visual(local_visual),
+                    'images_analyzed': True
+                }
         
         # Очищуємо пам'ять
         gc.collect()
@@ -1506,6 +3405,269 @@ def analyze_single_pair(desired_tm, existing_tm, instructions):
         print(f"Full traceback: {traceback.format_exc()}")
         return create_default_result(existing_tm, str(e))
 
+def get_cached_result(key, existing_tm):
+    """Повертає результат з кешу, оновлений даними поточного запиту"""
+    cached = analysis_cache.get(key)
+    if cached is None:
+        return None
+    
+    print(f"💾 Кеш: знайдено результат для '{existing_tm.get('name')}'")
+    # Дані реєстрації беремо з поточного запиту, а не з кешу
+    cached['trademark_info'].update({
+        'application_number': existing_tm.get('application_number', ''),
+        'owner': existing_tm.get('owner', ''),
+        'name': existing_tm.get('name', ''),
+        'classes': existing_tm.get('classes', '')
+    })
+    if existing_tm.get('image'):
+        cached['trademark_info']['image'] = existing_tm['image']
+    cached['cache_hit'] = True
+    return cached
+
+def store_cached_result(key, result):
+    # Результати з помилками не кешуємо
+    if not result.get('error'):
+        cacheable = json.loads(json.dumps(result))
+        cacheable['trademark_info'].pop('image', None)
+        analysis_cache.put(key, cacheable)
+
+def analyze_pair_cached(desired_tm, existing_tm, instructions):
+    """Аналізує пару з використанням дискового кешу результатів"""
+    if not ANALYSIS_CACHE_ENABLED:
+        result = analyze_single_pair(desired_tm, existing_tm, instructions)
+        result['cache_hit'] = False
+        return result
+    
+    key = analysis_cache.make_key(desired_tm, existing_tm, instructions, OPENAI_MODEL)
+    cached = get_cached_result(key, existing_tm)
+    if cached is not None:
+        return cached
+    
+    result = analyze_single_pair(desired_tm, existing_tm, instructions)
+    store_cached_result(key, result)
+    
+    result['cache_hit'] = False
+    return result
+
+def estimate_tokens(text):
+    """Груба оцінка кількості токенів (кирилиця ~3 символи на токен)"""
+    return len(text) // 3 + 1
+
+def format_batch_mark(number, existing_tm, desired_tm):
+    return (
+        f"МАРКА {number} (зареєстрована): \"{existing_tm.get('name', '')}\"\n"
+        f"Власник: {existing_tm.get('owner', 'не вказано')}\n"
+        f"Класи МКТП: {existing_tm.get('classes', 'не вказано')}\n"
+        f"Спорідненість класів: {describe_goods_services_score(goods_services_score(desired_tm, existing_tm))}\n"
+    )
+
+def build_batch_prompt(desired_tm, existing_tms, instructions):
+    """Один промпт для кількох зареєстрованих марок: бажана марка та інструкції передаються один раз"""
+    marks = '\n'.join(
+        format_batch_mark(number, existing_tm, desired_tm)
+        for number, existing_tm in enumerate(existing_tms, 1)
+    )
+    return f"""Ти експерт з торговельних марок. Порівняй бажану марку з КОЖНОЮ із зареєстрованих марок окремо, максимально детально.
+
+БАЖАНА МАРКА: "{desired_tm.get('name', '')}"
+Класи МКТП: {desired_tm.get('classes', 'не вказано')}
+Опис: {desired_tm.get('description', 'не вказано')}
+
+ЗАРЕЄСТРОВАНІ МАРКИ ({len(existing_tms)}):
+{marks}
+=== КРИТЕРІЇ АНАЛІЗУ (ДУЖЕ ВАЖЛИВО) ===
+{instructions[:4000]}
+
+=== ВАЖЛИВО ===
+Кожна відповідь має бути ДЕТАЛЬНОЮ (мінімум 3-5 речень).
+Використовуй КОНКРЕТНІ приклади з назв марок.
+Поясни ЧОМУ ти поставив саме такий відсоток.
+Кожну пару аналізуй незалежно від інших.
+
+Відповідь у JSON форматі: масив results рівно з {len(existing_tms)} елементів у тому ж порядку, pair_index - номер зареєстрованої марки:
+{{"results":[{{"pair_index":1, {PAIR_RESULT_FIELDS}}}]}}"""
+
+def plan_batches(desired_tm, indexes, existing_trademarks, instructions, workers):
+    """Ділить пари на пакети за бюджетом токенів, не залишаючи потоки без роботи"""
+    base_tokens = estimate_tokens(build_batch_prompt(desired_tm, [], instructions))
+    max_by_output = max(1, BATCH_MAX_OUTPUT_TOKENS // BATCH_OUTPUT_TOKENS_PER_PAIR)
+    # Пакети не більші, ніж потрібно, щоб завантажити всі потоки паралельно
+    max_by_workers = -(-len(indexes) // workers)
+    max_size = max(1, min(BATCH_MAX_SIZE, max_by_output, max_by_workers))
+    
+    batches, current, current_tokens = [], [], base_tokens
+    for index in indexes:
+        mark_tokens = estimate_tokens(format_batch_mark(len(current) + 1, existing_trademarks[index], desired_tm))
+        if current and (len(current) >= max_size or current_tokens + mark_tokens > BATCH_INPUT_TOKEN_BUDGET):
+            batches.append(current)
+            current, current_tokens = [], base_tokens
+        current.append(index)
+        current_tokens += mark_tokens
+    if current:
+        batches.append(current)
+    return batches
+
+def analyze_batch(desired_tm, existing_tms, instructions):
+    """Аналізує кілька текстових пар одним запитом; при невалідній відповіді кидає ValueError"""
+    print(f"📦 Пакетний аналіз: '{desired_tm.get('name')}' vs {len(existing_tms)} ТМ")
+    response = get_openai_client().chat.completions.create(
+        model=OPENAI_MODEL,
+        messages=[
+            {"role": "system", "content": SYSTEM_PROMPT},
+            {"role": "user", "content": build_batch_prompt(desired_tm, existing_tms, instructions)}
+        ],
+        response_format={"type": "json_object"},
+        temperature=0.3,
+        max_tokens=min(BATCH_MAX_OUTPUT_TOKENS, BATCH_OUTPUT_TOKENS_PER_PAIR * len(existing_tms) + 500)
+    )
+    
+    if response.choices[0].finish_reason == 'length':
+        raise ValueError("Відповідь обрізана за лімітом токенів")
+    
+    items = json.loads(clean_json_content(response.choices[0].message.content)).get('results')
+    if not isinstance(items, list) or len(items) != len(existing_tms):
+        raise ValueError(f"Очікувалось {len(existing_tms)} результатів, отримано {len(items) if isinstance(items, list) else 0}")
+    
+    by_number = {item.get('pair_index'): item for item in items if isinstance(item, dict)}
+    if sorted(by_number) != list(range(1, len(existing_tms) + 1)):
+        # pair_index відсутні або дублюються - покладаємось на порядок елементів
+        by_number = dict(enumerate(items, 1))
+    
+    results = []
+    for number, existing_tm in enumerate(existing_tms, 1):
+        item = by_number[number]
+        if not isinstance(item, dict):
+            raise ValueError(f"Некоректний результат для марки {number}")
+        item.pop('pair_index', None)
+        item.pop('trademark_info', None)
+        results.append(finalize_pair_result(item, existing_tm))
+    return results
+
+def analyze_batch_cached(desired_tm, existing_tms, instructions):
+    """Пакетний аналіз з кешем; якщо пакет не вдався - аналізує його пари поодинці"""
+    results = [None] * len(existing_tms)
+    keys = {}
+    misses = []
+    for position, existing_tm in enumerate(existing_tms):
+        if ANALYSIS_CACHE_ENABLED:
+            keys[position] = analysis_cache.make_key(desired_tm, existing_tm, instructions, OPENAI_MODEL, prompt='batch')
+            results[position] = get_cached_result(keys[position], existing_tm)
+        if results[position] is None:
+            misses.append(position)
+    
+    if len(misses) == 1:
+        position = misses[0]
+        results[position] = analyze_pair_cached(desired_tm.copy(), existing_tms[position], instructions)
+        return results
+    
+    if misses:
+        try:
+            batch_results = analyze_batch(desired_tm, [existing_tms[position] for position in misses], instructions)
+            prompt = 'batch'
+        except Exception as e:
+            print(f"⚠️ Пакет не вдався ({e}), аналізуємо {len(misses)} ТМ поодинці")
+            batch_results = [analyze_single_pair(desired_tm.copy(), existing_tms[position], instructions) for position in misses]
+            prompt = 'pair'
+        
+        for position, result in zip(misses, batch_results):
+            if position in keys:
+                # Результат окремого промпту кешуємо під ключем окремої пари
+                key = keys[position] if prompt == 'batch' else analysis_cache.make_key(
+                    desired_tm, existing_tms[position], instructions, OPENAI_MODEL
+                )
+                store_cached_result(key, result)
+            result['cache_hit'] = False
+            results[position] = result
+    
+    return results
+
+def iter_pair_analyses(desired_tm, existing_trademarks, instructions, max_workers=None, triage=None):
+    """Паралельно аналізує пари та повертає (індекс, результат) по мірі готовності"""
+    total = len(existing_trademarks)
+    if total == 0:
+        return
+    
+    triage = TRIAGE_ENABLED if triage is None else triage
+    done = 0
+    
+    # Кожне зображення запиту стискаємо один раз, а не для кожної пари
+    desired_tm, existing_trademarks = prepare_images(desired_tm, existing_trademarks)
+    
+    # Локальний скринінг: явно різні пари не відправляємо до GPT
+    llm_indexes = []
+    prescreens = {}
+    goods_scores = {}
+    for index, existing_tm in enumerate(existing_trademarks):
+        prescreen = prescreen_pair(desired_tm, existing_tm)
+        goods = goods_services_score(desired_tm, existing_tm)
+        prescreens[index] = prescreen
+        goods_scores[index] = goods
+        if triage and should_skip_llm(desired_tm, existing_tm, prescreen, goods):
+            done += 1
+            print(f"⏭️ ТМ {index + 1} відсіяна скринінгом (схожість {prescreen['score']}%) ({done}/{total})")
+            result = create_prescreen_result(existing_tm, prescreen, goods)
+            result['goods_services_score'] = goods
+            yield index, with_image_ref(result)
+        else:
+            llm_indexes.append(index)
+    
+    if not llm_indexes:
+        return
+    
+    workers = min(max_workers or ANALYSIS_MAX_WORKERS, len(llm_indexes))
+    
+    # Текстові пари можна об'єднати в пакети; пари із зображеннями аналізуються окремо
+    if BATCH_ANALYSIS_ENABLED:
+        text_indexes = [
+            index for index in llm_indexes
+            if not desired_tm.get('image') and not existing_trademarks[index].get('image')
+        ]
+        image_indexes = sorted(set(llm_indexes) - set(text_indexes))
+        tasks = [[index] for index in image_indexes]
+        tasks += plan_batches(desired_tm, text_indexes, existing_trademarks, instructions, workers)
+    else:
+        tasks = [[index] for index in llm_indexes]
+    
+    workers = min(workers, len(tasks))
+    print(f"🚀 Паралельний аналіз {len(llm_indexes)} ТМ ({len(tasks)} запитів), потоків: {workers}")
+    
+    def run_task(task):
+        if len(task) == 1:
+            return [analyze_pair_cached(
+                desired_tm=desired_tm.copy(),  # Копія щоб не змінювати оригінал
+                existing_tm=existing_trademarks[task[0]],
+                instructions=instructions
+            )]
+        return analyze_batch_cached(desired_tm.copy(), [existing_trademarks[index] for index in task], instructions)
+    
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = {executor.submit(run_task, task): task for task in tasks}
+        
+        for future in as_completed(futures):
+            task = futures[future]
+            try:
+                task_results = future.result()
+            except Exception as e:
+                print(f"❌ Помилка аналізу ТМ {', '.join(str(index + 1) for index in task)}: {e}")
+                task_results = [create_default_result(existing_trademarks[index], str(e)) for index in task]
+            
+            for index, result in zip(task, task_results):
+                result['prescreen'] = dict(prescreens[index], llm_skipped=False)
+                result['goods_services_score'] = goods_scores[index]
+                done += 1
+                print(f"✅ ТМ {index + 1} оброблена ({done}/{total})")
+                yield index, with_image_ref(result)
+
+def analyze_pairs(desired_tm, existing_trademarks, instructions, max_workers=None, triage=None):
+    """Аналізує всі пари паралельно, зберігаючи порядок вхідних даних"""
+    results = [None] * len(existing_trademarks)
+    for index, result in iter_pair_analyses(desired_tm, existing_trademarks, instructions, max_workers, triage):
+        results[index] = result
+    
+    # Звільняємо пам'ять після аналізу
+    gc.collect()
+    return results
+
 def create_default_result(existing_tm, error_msg):
     result = {
         "trademark_info": {
@@ -1543,6 +3705,7 @@ def create_default_result(existing_tm, error_msg):
         },
         "overall_risk": 0,
         "confusion_likelihood": "невідомо",
+        "error": error_msg,
         "recommendations": [
             "Сталася технічна помилка при аналізі",
             "Рекомендується повторити спробу",
@@ -1555,10 +3718,21 @@ def create_default_result(existing_tm, error_msg):
     
     return result
 
+def effective_risk(result):
+    """Ризик пари з урахуванням локальної спорідненості товарів/послуг"""
+    risk = result.get('overall_risk', 0)
+    goods = result.get('goods_services_score')
+    # GPT вже отримує спорідненість класів у промпті, тому масштабуємо лише ризик пар, що до нього не дійшли
+    skipped = (result.get('prescreen') or {}).get('llm_skipped')
+    if skipped and goods and goods.get('known'):
+        # Неспоріднені класи вдвічі зменшують ризик, спільні класи залишають без змін
+        risk = risk * (0.5 + 0.5 * goods['relatedness'] / 100)
+    return risk
+
 def calculate_registration_chance(results):
     if not results:
         return 95
-    max_risk = max([result.get('overall_risk', 0) for result in results])
+    max_risk = max([effective_risk(result) for result in results])
     if max_risk > 80:
         return 10
     elif max_risk > 60:
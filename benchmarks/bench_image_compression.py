@@ -0,0 +1,94 @@
+"""Бенчмарк нормалізації зображень: CPU-час на одне зображення.
+
+Порівнює поточну compress_image_base64 з попередньою реалізацією
+(повне декодування, LANCZOS, лінійний перебір якості з optimize=True)
+на великих фото з телефону та PNG-логотипах.
+
+Запуск: python benchmarks/bench_image_compression.py [кількість повторів]
+"""
+import base64
+import io
+import os
+import sys
+import time
+from contextlib import redirect_stdout
+
+from PIL import Image, ImageDraw, ImageFilter
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from app import compress_image_base64, VISION_IMAGE_MAX_KB  # noqa: E402
+
+
+def legacy_compress_image_base64(base64_string, max_size_kb=100):
+    """Попередня реалізація для порівняння"""
+    header, data = base64_string.split(',', 1)
+    img = Image.open(io.BytesIO(base64.b64decode(data)))
+    if img.mode in ('RGBA', 'LA', 'P'):
+        background = Image.new('RGB', img.size, (255, 255, 255))
+        if img.mode == 'P':
+            img = img.convert('RGBA')
+        background.paste(img, mask=img.split()[-1] if img.mode in ('RGBA', 'LA') else None)
+        img = background
+    if max(img.size) > 800:
+        ratio = 800 / max(img.size)
+        img = img.resize(tuple(int(dim * ratio) for dim in img.size), Image.Resampling.LANCZOS)
+    quality = 85
+    while quality > 20:
+        buffer = io.BytesIO()
+        img.save(buffer, format='JPEG', quality=quality, optimize=True)
+        if len(buffer.getvalue()) / 1024 <= max_size_kb:
+            break
+        quality -= 5
+    return f"{header},{base64.b64encode(buffer.getvalue()).decode('utf-8')}"
+
+
+def to_data_url(img, image_format, mime):
+    buffer = io.BytesIO()
+    img.save(buffer, format=image_format, quality=92) if image_format == 'JPEG' else img.save(buffer, format=image_format)
+    return f"data:{mime};base64,{base64.b64encode(buffer.getvalue()).decode('utf-8')}"
+
+
+def phone_photo(width=4032, height=3024):
+    """Синтетичне фото: градієнти та шум, що погано стискаються, як справжні фото"""
+    noise = Image.effect_noise((width, height), 60).filter(ImageFilter.GaussianBlur(2))
+    gradient = Image.linear_gradient('L').resize((width, height))
+    radial = Image.radial_gradient('L').resize((width, height))
+    return to_data_url(Image.merge('RGB', (noise, gradient, radial)), 'JPEG', 'image/jpeg')
+
+
+def png_logo(size=2048):
+    """Синтетичний логотип з прозорістю"""
+    img = Image.new('RGBA', (size, size), (0, 0, 0, 0))
+    draw = ImageDraw.Draw(img)
+    draw.ellipse((size // 8, size // 8, size * 7 // 8, size * 7 // 8), fill=(200, 30, 40, 255))
+    draw.rectangle((size // 3, size // 3, size * 2 // 3, size * 2 // 3), fill=(255, 255, 255, 255))
+    draw.text((size // 2.4, size // 2.2), 'TM', fill=(0, 0, 0, 255))
+    return to_data_url(img, 'PNG', 'image/png')
+
+
+def measure(function, image, repeats):
+    started = time.process_time()
+    with redirect_stdout(io.StringIO()):
+        for _ in range(repeats):
+            result = function(image, max_size_kb=VISION_IMAGE_MAX_KB)
+    return (time.process_time() - started) / repeats * 1000, len(result.split(',', 1)[1]) * 3 // 4 // 1024
+
+
+def main():
+    repeats = int(sys.argv[1]) if len(sys.argv) > 1 else 3
+    samples = [
+        ('Фото з телефону 4032x3024 JPEG', phone_photo()),
+        ('Фото з телефону 3000x4000 JPEG', phone_photo(3000, 4000)),
+        ('Логотип 2048x2048 PNG (RGBA)', png_logo()),
+        ('Логотип 512x512 PNG (RGBA)', png_logo(512)),
+    ]
+
+    print(f"{'Зображення':<34}{'було, мс':>10}{'стало, мс':>11}{'прискорення':>13}{'КБ (було/стало)':>18}")
+    for title, image in samples:
+        legacy_ms, legacy_kb = measure(legacy_compress_image_base64, image, repeats)
+        current_ms, current_kb = measure(compress_image_base64, image, repeats)
+        print(f"{title:<34}{legacy_ms:>10.0f}{current_ms:>11.0f}{legacy_ms / current_ms:>12.1f}x{f'{legacy_kb}/{current_kb}':>18}")
+
+
+if __name__ == '__main__':
+    main()